@@ -47,10 +47,12 @@ def unnormalize_tensor(img):
     img = img * 255.0
     return img.clamp(0, 255).byte().cpu().numpy()
 
-# Global anchor parameters
+# Global anchor parameters (9 anchors per position; rpn_utils' shared config has 15)
 ratios = [0.5, 1, 2]
 anchor_scales = [8, 16, 32]
 
+from rpn_utils import generate_anchor_grid_np
+
 import ijson
 
 
@@ -205,11 +207,14 @@ def compute_iou_vectorized(anchors, gt_boxes):
 # Revised bbox_generation Function (Vectorized and Padded)
 # -----------------------
 
-def bbox_generation(images, targets, X_FM, Y_FM):
+def bbox_generation(images, targets, X_FM, Y_FM, stride=None):
     """
     Compute regression targets and classification labels for all anchors.
     All anchors (generated over the full feature map) receive a target;
     anchors outside the image are ignored (label = -1).
+    X_FM / Y_FM are the feature map width / height; stride is the backbone
+    stride, so the anchors match the ones decoded at inference
+    (rpn_utils.generate_anchor_grid_np).
     Returns:
        anchor_locations_all_merge: (B, total_anchors, 4)
        anchor_labels_all_merge: (B, total_anchors)
@@ -218,34 +223,9 @@ def bbox_generation(images, targets, X_FM, Y_FM):
     num_batch = len(images)
     C, H_IMG, W_IMG = images[0].shape
 
-    # Generate full grid anchors over feature map
-    total_positions = X_FM * Y_FM
-    num_anchor_per_pos = len(ratios) * len(anchor_scales)
-    total_anchors = total_positions * num_anchor_per_pos
-
-    # Generate grid centers (using strides)
-    sub_sampling_x = float(W_IMG) / X_FM
-    sub_sampling_y = float(H_IMG) / Y_FM
-
-    shift_x = np.arange(sub_sampling_x, (X_FM+1)*sub_sampling_x, sub_sampling_x)
-    shift_y = np.arange(sub_sampling_y, (Y_FM+1)*sub_sampling_y, sub_sampling_y)
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)  # shape (Y_FM, X_FM)
-    centers = np.stack([shift_y.ravel() - sub_sampling_y/2, shift_x.ravel() - sub_sampling_x/2], axis=1)  # (total_positions, 2)
-
-    # For each center, generate anchors
-    anchors = []
-    for center in centers:
-        cy, cx = center
-        for ratio in ratios:
-            for scale in anchor_scales:
-                h = sub_sampling_y * scale * np.sqrt(ratio)
-                w = sub_sampling_x * scale * np.sqrt(1.0/ratio)
-                y1 = cy - h/2.
-                x1 = cx - w/2.
-                y2 = cy + h/2.
-                x2 = cx + w/2.
-                anchors.append([y1, x1, y2, x2])
-    anchors = np.array(anchors, dtype=np.float32)  # shape (total_anchors, 4)
+    # Full anchor grid over the feature map, converted to [y1, x1, y2, x2]
+    anchors = generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales, stride=stride)[:, [1, 0, 3, 2]]
+    anchors = anchors.astype(np.float32)  # shape (total_anchors, 4)
 
     # Create ground-truth arrays for all anchors (padded to total_anchors)
     # Initialize labels to -1 (ignore) and loc targets to zeros.
@@ -324,38 +304,6 @@ def bbox_generation(images, targets, X_FM, Y_FM):
     anchor_locs_all_merge = np.stack(anchor_locs_all, axis=0)        # (B, total_anchors, 4)
     return anchor_locs_all_merge, anchor_labels_all_merge, anchors
 
-class CBAM(nn.Module):
-    def __init__(self, channels, reduction=4, kernel_size=3):  # Reduced reduction ratio
-        super().__init__()
-        # Channel attention with more conservative reduction
-        self.avg_pool = nn.AdaptiveAvgPool2d(1)
-        self.max_pool = nn.AdaptiveMaxPool2d(1)
-        self.fc = nn.Sequential(
-            nn.Linear(channels, channels//reduction, bias=False),
-            nn.ReLU(),
-            nn.Linear(channels//reduction, channels, bias=False)
-        )
-        self.sigmoid = nn.Sigmoid()
-
-        # Spatial attention with smaller kernel
-        self.conv = nn.Conv2d(2, 1, kernel_size, padding=kernel_size//2, bias=False)
-
-    def forward(self, x):
-        # Channel attention
-        b, c, _, _ = x.size()
-        y_avg = self.avg_pool(x).view(b, c)
-        y_max = self.max_pool(x).view(b, c)
-        y = self.fc(y_avg) + self.fc(y_max)  # More efficient than conv implementation
-        scale = self.sigmoid(y).view(b, c, 1, 1)
-        x = x * scale.expand_as(x)
-
-        # Spatial attention
-        avg_out = torch.mean(x, dim=1, keepdim=True)
-        max_out, _ = torch.max(x, dim=1, keepdim=True)
-        y = torch.cat([avg_out, max_out], dim=1)
-        scale = self.sigmoid(self.conv(y))
-        return x * scale
-
 def visualize_attention(feat, title=""):
     """Visualize the attention maps from CBAM"""
     plt.figure(figsize=(10,5))
@@ -370,78 +318,23 @@ def visualize_attention(feat, title=""):
     plt.title(f"{title} - Channel Max")
     plt.show()
 
-vgg_model = torchvision.models.vgg16(pretrained=True).to(device)
-vgg_model.eval()
-for param in vgg_model.features.parameters():
-    param.requires_grad = False
-req_features = [layer for layer in list(vgg_model.features)[:30]]
-
-class EnhancedRPN(nn.Module):
-    def __init__(self, in_channels=512, mid_channels=256, n_anchor=9):
-        super(EnhancedRPN, self).__init__()
-        # Convolutional layers with reduced capacity
-        self.conv1 = nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1)
-        self.conv2 = nn.Conv2d(mid_channels, mid_channels, kernel_size=3, padding=1)
-        self.conv3 = nn.Conv2d(mid_channels, mid_channels, kernel_size=3, padding=1)
-
-        # Improved CBAM modules
-        self.cbam1 = CBAM(mid_channels, reduction=4, kernel_size=3)
-        self.cbam2 = CBAM(mid_channels, reduction=4, kernel_size=3)
-
-        # Output layers
-        self.reg_layer = nn.Conv2d(mid_channels, n_anchor*4, kernel_size=1)
-        self.cls_layer = nn.Conv2d(mid_channels, n_anchor*2, kernel_size=1)
-
-        # Skip connection - always create but use identity if same dims
-        self.skip_conv = nn.Conv2d(in_channels, mid_channels, kernel_size=1)
-        if in_channels == mid_channels:
-            # If dimensions match, make it an identity mapping
-            nn.init.eye_(self.skip_conv.weight)
-            nn.init.zeros_(self.skip_conv.bias)
-            self.skip_conv.weight.requires_grad = False
-            self.skip_conv.bias.requires_grad = False
-
-        # Initialize weights
-        self._initialize_weights()
-
-    def _initialize_weights(self):
-        for layer in [self.conv1, self.conv2, self.conv3, self.reg_layer, self.cls_layer]:
-            nn.init.normal_(layer.weight, std=0.01)
-            if layer.bias is not None:
-                nn.init.constant_(layer.bias, 0)
-        # Skip conv already initialized appropriately
-
-    def forward(self, x):
-        residual = self.skip_conv(x)  # Always use skip_conv
-
-        # First block with CBAM
-        x = F.relu(self.conv1(x))
-        x = self.cbam1(x)
-
-        # Second block with CBAM
-        x = F.relu(self.conv2(x))
-        x = self.cbam2(x)
-
-        # Final block with residual connection
-        x = F.relu(self.conv3(x) + residual)
-
-        # Predictions
-        pred_anchor_locs = self.reg_layer(x)
-        pred_cls_scores = self.cls_layer(x)
-
-        # Reshape outputs
-        batch_size = x.shape[0]
-        pred_anchor_locs = pred_anchor_locs.permute(0,2,3,1).contiguous().view(batch_size, -1, 4)
-        pred_cls_scores = pred_cls_scores.permute(0,2,3,1).contiguous().view(batch_size, -1, 2)
-
-        # Apply tanh to regression outputs and softmax to classification
-        pred_anchor_locs = torch.tanh(pred_anchor_locs) * 2
-        objectness_score = F.softmax(pred_cls_scores, dim=-1)[:,:,1]
-
-        return pred_anchor_locs, pred_cls_scores, objectness_score
-
-# Initialize model
-rpn_model = EnhancedRPN(in_channels=512, mid_channels=256).to(device)
+from backbones import build_backbone, build_rpn_for_backbone
+from rpn_utils import decode_topk, precision_autocast
+from training_metrics import TrainingMetrics
+
+# Frozen feature trunk; see backbones.BACKBONES for lighter alternatives
+BACKBONE = 'vgg16'
+# 'bf16' runs backbone and RPN under autocast (loss and decoding stay fp32)
+PRECISION = 'fp32'
+# Training recall is computed on every RECALL_EVERY-th batch, off the training thread
+RECALL_EVERY = 10
+backbone = build_backbone(BACKBONE, device=device)
+req_features = list(backbone)
+
+# Initialize model: the shared EnhancedRPN head (rpn_models, same layers and parameter names as the
+# head this notebook used to define, so rpn_epoch_N.pth checkpoints load), sized for the backbone
+# and this notebook's 9-anchor config
+rpn_model = build_rpn_for_backbone(backbone, mid_channels=256, n_anchor=len(ratios) * len(anchor_scales)).to(device)
 optimizer = torch.optim.Adam(rpn_model.parameters(), lr=0.001, weight_decay=1e-4)
 
 """## Training/Validation Functions"""
@@ -469,40 +362,57 @@ def pred_bbox_to_xywh(bbox, anchors):
     return roi
 
 
+def sampled_recall(pred_locs, objectness_score, anchors, gt_boxes_list, top_k=20, iou_threshold=0.5):
+    """Batch recall@top_k for TrainingMetrics (runs on its background thread)."""
+    batch_recall = 0.0
+    count = 0
+    # Decode only the top_k anchors, on device (anchors are [y1,x1,y2,x2])
+    anchors_xyxy = torch.from_numpy(anchors[:, [1, 0, 3, 2]].astype(np.float32)).to(pred_locs.device)
+    topk_rois, _, _ = decode_topk(pred_locs, objectness_score, anchors_xyxy, top_k)
+    topk_rois = topk_rois.cpu().numpy()
+    for proposals, gt_boxes in zip(topk_rois, gt_boxes_list):
+        if len(gt_boxes) > 0:
+            # One IoU matrix against all GT boxes (converted to [y1, x1, y2, x2])
+            ious = compute_iou_vectorized(proposals, gt_boxes[:, [1, 0, 3, 2]])
+            best_ious = ious.max(axis=0) if ious.size > 0 else np.zeros(len(gt_boxes))
+            batch_recall += np.sum(best_ious >= iou_threshold) / len(gt_boxes)
+            count += 1
+    return batch_recall / count if count > 0 else None
+
+
 def train_epochs(req_features, rpn_model, optimizer, train_dl, epochs=20, rpn_lambda=10, iou_threshold=0.5, top_k=20):
     rpn_model.train()
     epoch_train_recalls = []  # Track recall instead of error
     epoch_train_errors = []   # Still keep error for backward compatibility
+    # loss_per="sample": the log keeps its sum of batch losses / images normalisation
+    metrics = TrainingMetrics(recall_every=RECALL_EVERY, recall_fn=lambda *args: sampled_recall(
+        *args, top_k=top_k, iou_threshold=iou_threshold), loss_per="sample")
 
     for epoch in range(epochs):
         print(f"Epoch {epoch+1}/{epochs}")
-        total_samples = 0
-        sum_loss = 0.0
-        sum_loss_cls = 0.0
-        sum_loss_loc = 0.0
-        batch_recalls = []  # Track recall per batch
 
         for batch in train_dl:
             images = batch["images"].to(device)
             targets = [{"boxes": b, "labels": l} for b, l in zip(batch["boxes"], batch["labels"])]
-            B = images.shape[0]
-            total_samples += B
 
             # Forward through frozen backbone
             imgs = images.clone()
-            with torch.no_grad():
+            with torch.no_grad(), precision_autocast(PRECISION, device):
                 feat = imgs
                 for m in req_features:
                     feat = m(feat)
-            X_FM, Y_FM = feat.shape[2], feat.shape[3]
+            Y_FM, X_FM = feat.shape[2], feat.shape[3]
 
             # Compute GT targets
-            gt_locs_np, gt_scores_np, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM)
+            gt_locs_np, gt_scores_np, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM,
+                                                                backbone.stride)
             gt_locs = torch.from_numpy(gt_locs_np.astype(np.float32)).to(device)
             gt_scores = torch.from_numpy(gt_scores_np.astype(np.float32)).to(device)
 
             # Forward RPN
-            pred_locs, pred_scores, objectness_score = rpn_model(feat)
+            with precision_autocast(PRECISION, device):
+                pred_locs, pred_scores, objectness_score = rpn_model(feat)
+            pred_locs, pred_scores, objectness_score = pred_locs.float(), pred_scores.float(), objectness_score.float()
 
             # Compute losses
             cls_loss = F.cross_entropy(pred_scores.view(-1, 2),
@@ -526,51 +436,25 @@ def train_epochs(req_features, rpn_model, optimizer, train_dl, epochs=20, rpn_la
             loss.backward()
             optimizer.step()
 
-            # Accumulate losses
-            sum_loss += loss.item()
-            sum_loss_cls += cls_loss.item()
-            sum_loss_loc += (rpn_lambda * loc_loss).item()
-
-            with torch.no_grad():
-                batch_recall = 0.0
-                count = 0
-                for i in range(B):
-                    rois = pred_bbox_to_xywh(pred_locs[i], anchors)
-                    if top_k is not None:
-                        k = min(top_k, objectness_score[i].shape[0])
-                        top_k_idx = torch.topk(objectness_score[i], k=k).indices
-                        proposals = rois[top_k_idx.cpu().numpy()]
-
-                    gt_boxes = batch["boxes"][i]
-                    if not isinstance(gt_boxes, np.ndarray):
-                        gt_boxes = gt_boxes.cpu().numpy()
-
-                    if len(gt_boxes) > 0:
-                        matched = 0
-                        for gt in gt_boxes:
-                            gt_converted = np.array([gt[1], gt[0], gt[3], gt[2]])
-                            ious = compute_iou_vectorized(proposals, np.expand_dims(gt_converted, axis=0))
-                            best_iou = np.max(ious) if ious.size > 0 else 0.0
-                            if best_iou >= iou_threshold:
-                                matched += 1
-                        recall = matched / len(gt_boxes)
-                        batch_recall += recall
-                        count += 1
-
-                if count > 0:
-                    batch_recalls.append(batch_recall / count)
+            # Accumulate losses on device; recall on sampled batches in the background
+            metrics.update_losses(n_samples=images.shape[0], loss=loss, cls_loss=cls_loss, loc_loss=rpn_lambda * loc_loss)
+            metrics.update_recall(pred_locs, objectness_score, anchors, batch["boxes"])
+
+        epoch_metrics = metrics.epoch_summary()
+        epoch_recall = epoch_metrics["recall"]
 
         # Store epoch metrics
-        epoch_recall = np.mean(batch_recalls) if batch_recalls else 0.0
         epoch_train_recalls.append(epoch_recall)
         epoch_train_errors.append(1 - epoch_recall)  # For compatibility
 
-        print(f"Epoch {epoch+1}: Loss {sum_loss/total_samples:.3f} | "
+        print(f"Epoch {epoch+1}: Loss {epoch_metrics['loss']:.3f} | "
               f"Recall: {epoch_recall:.3f} | Error: {1-epoch_recall:.3f}")
 
         if (epoch+1) % 5 == 0:
             torch.save(rpn_model.state_dict(), f"./rpn_epoch_{epoch+1}.pth")
 
+    metrics.close()
+
     # Improved plotting - show both recall and error trends
     plt.figure(figsize=(12, 5))
 
@@ -612,22 +496,22 @@ def validate(rpn_model, data_loader, n_images=7, top_k=20, iou_threshold=0.5):
 
             # Forward pass through backbone features
             imgs = images.clone()
-            for m in req_features:
-                imgs = m(imgs)
-            X_FM, Y_FM = imgs.shape[2], imgs.shape[3]
-            _, _, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM)
-            pred_locs, pred_scores, objectness_score = rpn_model(imgs)
-
+            with precision_autocast(PRECISION, device):
+                for m in req_features:
+                    imgs = m(imgs)
+            Y_FM, X_FM = imgs.shape[2], imgs.shape[3]
+            _, _, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM, backbone.stride)
+            with precision_autocast(PRECISION, device):
+                pred_locs, pred_scores, objectness_score = rpn_model(imgs)
+            pred_locs, objectness_score = pred_locs.float(), objectness_score.float()
+
+            anchors_xyxy = torch.from_numpy(anchors[:, [1, 0, 3, 2]].astype(np.float32)).to(device)
+            topk_rois, _, _ = decode_topk(pred_locs, objectness_score, anchors_xyxy, top_k)
             for i in range(min(n_images, images.shape[0])):
-                # Get proposals for image i (output in [y1, x1, y2, x2])
-                rois = pred_bbox_to_xywh(pred_locs[i], anchors)
+                # Get proposals for image i (only the top_k anchors are decoded)
+                proposals = topk_rois[i].cpu().numpy()
                 if top_k is not None:
-                    k = min(top_k, objectness_score[i].shape[0])
-                    top_k_idx = torch.topk(objectness_score[i], k=k).indices
-                    proposals = rois[top_k_idx.cpu().numpy()]
-                    print(f"\nImage {i}: Showing top {k} proposals")
-                else:
-                    proposals = rois
+                    print(f"\nImage {i}: Showing top {proposals.shape[0]} proposals")
 
                 # Plot proposals and ground truth
                 show_corner_bbs(images[i], proposals)
@@ -637,16 +521,10 @@ def validate(rpn_model, data_loader, n_images=7, top_k=20, iou_threshold=0.5):
                     show_ground_truth_bbs(images[i], gt_boxes)
 
                     # Compute metrics
-                    matched = 0
-                    image_ious = []
-                    for gt in gt_boxes:
-                        # Convert GT box from [x1, y1, x2, y2] to [y1, x1, y2, x2]
-                        gt_converted = np.array([gt[1], gt[0], gt[3], gt[2]])
-                        ious = compute_iou_vectorized(proposals, np.expand_dims(gt_converted, axis=0))
-                        best_iou = np.max(ious) if ious.size > 0 else 0.0
-                        image_ious.append(best_iou)
-                        if best_iou >= iou_threshold:
-                            matched += 1
+                    # One IoU matrix; GT boxes converted from [x1, y1, x2, y2] to [y1, x1, y2, x2]
+                    ious = compute_iou_vectorized(proposals, gt_boxes[:, [1, 0, 3, 2]])
+                    image_ious = ious.max(axis=0) if ious.size > 0 else np.zeros(len(gt_boxes))
+                    matched = int(np.sum(image_ious >= iou_threshold))
 
                     recall = matched / len(gt_boxes)
                     avg_iou = np.mean(image_ious)
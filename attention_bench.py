@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Attention latency vs proposal recall for EnhancedRPNWithROI.
+
+Each configuration names the attention of the two RPN blocks, e.g.
+`cbam` (both blocks), `cbam_fused` or `eca,none` (block 1, block 2).
+For every configuration the harness reports the latency of each
+attention module, of the whole RPN and the proposal recall at a fixed
+top-k on the same images. Recall is only meaningful for
+configurations with trained weights.
+
+Usage:
+    python attention_bench.py --configs cbam cbam_fused eca none eca,none \
+        --rpn-weights cbam=final_model.pth cbam_fused=final_model.pth eca=rpn_eca.pth
+"""
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from backbones import anchors_for_backbone, build_backbone, build_rpn_for_backbone
+from rpn_models import ATTENTION
+from rpn_utils import (CustomDataset, compute_recall_at_threshold, custom_collate_fn, extract_first_n_labels,
+                       measure_latency, topk_proposals)
+
+
+def parse_config(config):
+    """'eca,none' -> ['eca', 'none']; 'cbam' -> 'cbam'."""
+    names = config.split(",")
+    return names if len(names) > 1 else names[0]
+
+
+def benchmark_attention(configs, data_loader, rpn_weights=None, backbone_name="vgg16", n_images=50,
+                        top_k=400, iou_thresh=0.5, n_iters=10, pretrained=True):
+    """
+    configs: list of config strings; rpn_weights: {config: path}.
+    Latencies are ms per batch on the first batch.
+    """
+    rpn_weights = rpn_weights or {}
+    backbone = build_backbone(backbone_name, pretrained=pretrained)
+
+    # Backbone features are shared by every configuration, compute them once
+    batches = []
+    seen = 0
+    with torch.no_grad():
+        for batch in data_loader:
+            batches.append((backbone(batch["images"]), batch["boxes"]))
+            seen += batch["images"].shape[0]
+            if seen >= n_images:
+                break
+    feat = batches[0][0]
+    anchors = anchors_for_backbone(backbone, feat)
+
+    results = []
+    for config in configs:
+        rpn = build_rpn_for_backbone(backbone, attention=parse_config(config)).eval()
+        if config in rpn_weights:
+            rpn.load_state_dict(torch.load(rpn_weights[config], map_location="cpu"))
+
+        recalls = []
+        with torch.no_grad():
+            for feats, boxes in batches:
+                pred_locs, _, objectness_score = rpn(feats)
+                for props, gt in zip(topk_proposals(pred_locs, objectness_score, anchors, top_k), boxes):
+                    if len(gt) > 0:
+                        recalls.append(compute_recall_at_threshold(props, gt.numpy(), iou_thresh))
+
+            # Inputs each attention block sees inside extract_features
+            x1 = F.relu(rpn.conv1(feat))
+            x2 = F.relu(rpn.conv2(rpn.cbam1(x1)))
+
+        results.append({
+            "config": config,
+            "att1_ms": measure_latency(rpn.cbam1, x1, n_iters=n_iters),
+            "att2_ms": measure_latency(rpn.cbam2, x2, n_iters=n_iters),
+            "rpn_ms": measure_latency(rpn, feat, n_iters=n_iters),
+            "params": sum(p.numel() for m in (rpn.cbam1, rpn.cbam2) for p in m.parameters()),
+            "recall": float(np.mean(recalls)) if recalls else 0.0,
+            "trained_rpn": config in rpn_weights,
+        })
+    return results
+
+
+def print_attention_benchmark(results, top_k=400):
+    print(f"\n{'attention':<20}{'att1 ms':>9}{'att2 ms':>9}{'rpn ms':>9}{'att params':>12}{f'R@{top_k}':>8}")
+    for r in results:
+        recall = f"{r['recall']:.3f}" if r["trained_rpn"] else "n/a"
+        print(f"{r['config']:<20}{r['att1_ms']:>9.2f}{r['att2_ms']:>9.2f}{r['rpn_ms']:>9.1f}"
+              f"{r['params']:>12}{recall:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare RPN attention modules on latency and proposal recall")
+    parser.add_argument("--configs", nargs="+", default=sorted(ATTENTION),
+                        help="attention name, or comma-separated name per block")
+    parser.add_argument("--rpn-weights", nargs="*", default=[], help="config=path pairs")
+    parser.add_argument("--backbone", default="vgg16")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-images", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--top-k", type=int, default=400)
+    parser.add_argument("--n-iters", type=int, default=10)
+    args = parser.parse_args()
+
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                         collate_fn=custom_collate_fn)
+    weights = dict(pair.split("=", 1) for pair in args.rpn_weights)
+    results = benchmark_attention(args.configs, loader, rpn_weights=weights, backbone_name=args.backbone,
+                                  n_images=args.n_images, top_k=args.top_k, n_iters=args.n_iters)
+    print_attention_benchmark(results, top_k=args.top_k)
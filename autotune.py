@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Pick the fastest CPU thread / DataLoader worker setting for this machine.
+
+Intra-op threads (torch.set_num_threads), inter-op threads
+(torch.set_num_interop_threads) and DataLoader workers compete for the
+same cores, and the best split depends on the machine and on the loop.
+For each candidate in a small search space this runs a few steps of the
+real loop in a fresh process (throughput_bench.run_isolated: the
+rpn_training.train_step loop for "train", detection.detect_objects_batch
+for "infer"), keeps the highest images/s and saves it with
+runtime_config.save_settings. The rpn_training, detection and evaluation
+entry points then apply it on this machine automatically.
+
+Candidates: intra-op threads in powers of two up to the usable cores
+(plus the core count itself), 1 or 2 inter-op threads, 0/1/2/4 workers,
+skipping splits that put more than one extra busy process per core
+(threads + workers > cores + 1).
+
+Usage:
+    python autotune.py --mode train infer --batch-size 8
+    python autotune.py --show
+    python autotune.py --clear
+"""
+
+import argparse
+import json
+import time
+
+from runtime_config import (DEFAULT_PATH, clear_settings, load_settings, machine_key, save_settings,
+                            usable_cores)
+from throughput_bench import MODES, print_results, run_isolated
+
+
+def search_space(cores=None, interop=(1, 2), workers=(0, 1, 2, 4)):
+    """(threads, interop_threads, num_workers) candidates for `cores` usable cores."""
+    cores = cores or usable_cores()
+    threads = sorted({t for t in (1, 2, 4, 8, 16, 32, 64) if t < cores} | {cores})
+    return [(t, i, w) for t in threads for i in interop for w in workers
+            if i <= max(cores, 1) and (w == 0 or t + w <= cores + 1)]
+
+
+def autotune(config, mode, batch_size=8, space=None, trial_batches=3, start_method="spawn", path=None, save=True):
+    """
+    Time trial_batches batches (after config["warmup"] untimed ones) per
+    candidate, each in a fresh process. Saves the fastest as the `mode`
+    settings of this machine (unless save=False). Returns (best, rows).
+    """
+    config = dict(config, max_batches=trial_batches,
+                  n_images=batch_size * (config["warmup"] + trial_batches))
+    rows = []
+    for threads, interop_threads, workers in space or search_space():
+        print(f"[INFO] {mode}: threads={threads} interop={interop_threads} workers={workers}")
+        result = run_isolated(config, mode, threads, workers, batch_size, interop_threads, start_method)
+        if "error" in result:
+            print(f"[WARNING] failed: {result['error']}")
+            continue
+        rows.append(result)
+    if not rows:
+        raise RuntimeError(f"Every {mode} trial failed")
+
+    best = max(rows, key=lambda row: row["images_per_sec"])
+    settings = {"threads": best["threads"], "interop_threads": best["interop_threads"],
+                "num_workers": best["workers"], "batch_size": batch_size,
+                "images_per_sec": round(best["images_per_sec"], 3), "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+    if save:
+        save_settings(mode, settings, path)
+        print(f"[INFO] Saved {mode} settings to {path or DEFAULT_PATH}")
+    return settings, rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Autotune CPU threads and DataLoader workers for this machine")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-labels", type=int, default=20000)
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--trial-batches", type=int, default=3, help="timed batches per candidate")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed batches per candidate")
+    parser.add_argument("--top-k", type=int, default=40)
+    parser.add_argument("--classifier", choices=("roi_head", "crops"), default="roi_head")
+    parser.add_argument("--rpn-weights", default=None)
+    parser.add_argument("--config", default=None, help=f"settings file (default {DEFAULT_PATH})")
+    parser.add_argument("--show", action="store_true", help="print this machine's saved settings")
+    parser.add_argument("--clear", action="store_true", help="forget this machine's saved settings")
+    args = parser.parse_args()
+
+    if args.show:
+        print(machine_key())
+        print(json.dumps({mode: load_settings(mode, args.config) for mode in MODES}, indent=2))
+    elif args.clear:
+        for mode in args.mode:
+            clear_settings(mode, args.config)
+        print(f"[INFO] Cleared {', '.join(args.mode)} settings for {machine_key()}")
+    else:
+        config = {"image_dir": args.image_dir, "pt_dir": args.pt_dir, "labels_json": args.labels_json,
+                  "n_labels": args.n_labels, "warmup": args.warmup, "top_k": args.top_k,
+                  "classifier": args.classifier, "rpn_weights": args.rpn_weights, "pretrained": True}
+        for mode in args.mode:
+            best, rows = autotune(config, mode, args.batch_size, trial_batches=args.trial_batches,
+                                  path=args.config)
+            print_results(rows)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Backbone registry for the RPN.
+
+Every backbone is an nn.Sequential trunk that declares its output channels
+and stride, so the RPN head (`in_channels`) and the anchor grid (`stride`)
+follow the backbone instead of assuming VGG16's 512 channels at stride 16.
+Because the trunks are nn.Sequential, `req_features = list(backbone)` keeps
+working with the existing train_epochs/validate loops.
+
+Usage (latency / recall comparison):
+    python backbones.py --backbones vgg16 resnet18 mobilenet_v3_large \
+        --rpn-weights vgg16=final_model.pth resnet18=rpn_resnet18.pth
+"""
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+from rpn_models import EnhancedRPNWithROI
+from rpn_utils import (CustomDataset, anchor_scales, compute_recall_at_threshold, custom_collate_fn,
+                       extract_first_n_labels, generate_anchor_grid_np, measure_latency, ratios,
+                       topk_proposals)
+
+BACKBONES = {}
+
+
+class Backbone(nn.Sequential):
+    """Feature trunk with the metadata the RPN needs."""
+    def __init__(self, layers, out_channels, stride, name=""):
+        super().__init__(*layers)
+        self.out_channels = out_channels
+        self.stride = stride
+        self.name = name
+
+
+def register_backbone(name, out_channels, stride):
+    """Decorator: register a builder `fn(pretrained, **kwargs) -> list of layers`."""
+    def wrap(fn):
+        BACKBONES[name] = {"builder": fn, "out_channels": out_channels, "stride": stride}
+        return fn
+    return wrap
+
+
+def build_backbone(name, pretrained=True, device=None, freeze=True, **kwargs):
+    """Build a registered trunk, frozen and in eval mode by default."""
+    if name not in BACKBONES:
+        raise KeyError(f"Unknown backbone '{name}', choose from {sorted(BACKBONES)}")
+    spec = BACKBONES[name]
+    backbone = Backbone(spec["builder"](pretrained, **kwargs), spec["out_channels"], spec["stride"], name)
+    if freeze:
+        for param in backbone.parameters():
+            param.requires_grad = False
+        backbone.eval()
+    if device is not None:
+        backbone = backbone.to(device)
+    return backbone
+
+
+# -----------------------
+# Registered trunks
+# -----------------------
+
+@register_backbone("vgg16", out_channels=512, stride=16)
+def _vgg16(pretrained):
+    weights = models.VGG16_Weights.DEFAULT if pretrained else None
+    return list(models.vgg16(weights=weights).features)[:30]
+
+
+def _resnet18_layers(pretrained, model, last_layer):
+    if model is None:
+        model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT if pretrained else None)
+    names = ["conv1", "bn1", "relu", "maxpool", "layer1", "layer2", "layer3", "layer4"]
+    return [getattr(model, n) for n in names[:names.index(last_layer) + 1]]
+
+
+@register_backbone("resnet18", out_channels=256, stride=16)
+def _resnet18(pretrained, model=None):
+    """
+    ResNet18 up to layer3. Pass `model=classifier.model` to share the
+    trunk (and its weights) with ObjectClassifier.
+    """
+    return _resnet18_layers(pretrained, model, "layer3")
+
+
+@register_backbone("resnet18_c5", out_channels=512, stride=32)
+def _resnet18_c5(pretrained, model=None):
+    return _resnet18_layers(pretrained, model, "layer4")
+
+
+@register_backbone("mobilenet_v2", out_channels=96, stride=16)
+def _mobilenet_v2(pretrained):
+    weights = models.MobileNet_V2_Weights.DEFAULT if pretrained else None
+    return list(models.mobilenet_v2(weights=weights).features)[:14]
+
+
+@register_backbone("mobilenet_v3_large", out_channels=112, stride=16)
+def _mobilenet_v3_large(pretrained):
+    weights = models.MobileNet_V3_Large_Weights.DEFAULT if pretrained else None
+    return list(models.mobilenet_v3_large(weights=weights).features)[:13]
+
+
+# -----------------------
+# RPN / anchors for a backbone
+# -----------------------
+
+def build_rpn_for_backbone(backbone, rpn_cls=EnhancedRPNWithROI, **kwargs):
+    """RPN head whose in_channels and anchor count match the backbone and anchor config."""
+    kwargs.setdefault("n_anchor", len(ratios) * len(anchor_scales))
+    return rpn_cls(in_channels=backbone.out_channels, **kwargs)
+
+
+def anchors_for_backbone(backbone, feat, base_size=16):
+    """Anchor grid (x1,y1,x2,y2) for a (B, C, Y_FM, X_FM) feature map of `backbone`."""
+    Y_FM, X_FM = feat.shape[2], feat.shape[3]
+    anchors = generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales,
+                                      stride=backbone.stride, base_size=base_size)
+    return torch.from_numpy(anchors).to(feat.device)
+
+
+# -----------------------
+# Benchmark
+# -----------------------
+
+def benchmark_backbones(names, data_loader, rpn_weights=None, n_images=50, top_k=400,
+                        iou_thresh=0.5, n_iters=5, pretrained=True):
+    """
+    Backbone / RPN latency (ms per batch) and proposal recall@top_k per backbone.
+    Recall is only meaningful for backbones with trained RPN weights in
+    `rpn_weights` ({name: path}); untrained heads are marked as such.
+    """
+    rpn_weights = rpn_weights or {}
+    batches = []
+    seen = 0
+    for batch in data_loader:
+        batches.append((batch["images"], batch["boxes"]))
+        seen += batch["images"].shape[0]
+        if seen >= n_images:
+            break
+
+    results = []
+    for name in names:
+        backbone = build_backbone(name, pretrained=pretrained)
+        rpn = build_rpn_for_backbone(backbone).eval()
+        if name in rpn_weights:
+            rpn.load_state_dict(torch.load(rpn_weights[name], map_location="cpu"))
+
+        example = batches[0][0]
+        with torch.no_grad():
+            feat = backbone(example)
+        anchors = anchors_for_backbone(backbone, feat)
+
+        recalls = []
+        with torch.no_grad():
+            for images, boxes in batches:
+                pred_locs, _, objectness_score = rpn(backbone(images))
+                for props, gt in zip(topk_proposals(pred_locs, objectness_score, anchors, top_k), boxes):
+                    if len(gt) > 0:
+                        recalls.append(compute_recall_at_threshold(props, gt.numpy(), iou_thresh))
+
+        results.append({
+            "backbone": name,
+            "channels": backbone.out_channels,
+            "stride": backbone.stride,
+            "feature_map": tuple(feat.shape[2:]),
+            "n_anchors": anchors.shape[0],
+            "backbone_ms": measure_latency(backbone, example, n_iters=n_iters),
+            "rpn_ms": measure_latency(rpn, feat, n_iters=n_iters),
+            "recall": float(np.mean(recalls)) if recalls else 0.0,
+            "trained_rpn": name in rpn_weights,
+        })
+    return results
+
+
+def print_benchmark(results, top_k=400):
+    print(f"\n{'backbone':<20}{'C':>5}{'stride':>8}{'fmap':>10}{'anchors':>9}"
+          f"{'bb ms':>9}{'rpn ms':>9}{f'R@{top_k}':>8}")
+    for r in results:
+        fmap = f"{r['feature_map'][0]}x{r['feature_map'][1]}"
+        recall = f"{r['recall']:.3f}" if r["trained_rpn"] else "n/a"
+        print(f"{r['backbone']:<20}{r['channels']:>5}{r['stride']:>8}{fmap:>10}{r['n_anchors']:>9}"
+              f"{r['backbone_ms']:>9.1f}{r['rpn_ms']:>9.1f}{recall:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare RPN backbones on latency and proposal recall")
+    parser.add_argument("--backbones", nargs="+", default=sorted(BACKBONES))
+    parser.add_argument("--rpn-weights", nargs="*", default=[], help="name=path pairs")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-images", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--top-k", type=int, default=400)
+    parser.add_argument("--n-iters", type=int, default=5)
+    args = parser.parse_args()
+
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                         collate_fn=custom_collate_fn)
+    weights = dict(pair.split("=", 1) for pair in args.rpn_weights)
+    results = benchmark_backbones(args.backbones, loader, rpn_weights=weights, n_images=args.n_images,
+                                  top_k=args.top_k, n_iters=args.n_iters)
+    print_benchmark(results, top_k=args.top_k)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Largest RPN training batch that fits a memory budget, with gradient accumulation.
+
+Peak memory of a training step grows with the batch size: the
+(B, 512, H/16, W/16) backbone features, bbox_generation's per-image
+anchor arrays and IoU matrices, the (B, N, 4) targets and the RPN
+activations kept for backward. choose_batch_size measures it instead of
+finding the limit by OOM kills: it runs a couple of real training steps
+(rpn_training.train_step on CustomDataset images at rpn_utils.ISIZE) per
+candidate micro-batch size, each in a fresh process
+(throughput_bench.run_isolated; the RSS high-water mark is reset after
+the models are built, so the transient of loading them does not mask the
+steps), and picks the largest divisor of the requested batch size whose peak
+(main process + num_workers DataLoader workers) is within the budget.
+The requested batch size is kept as the effective batch through
+accumulation_steps = batch_size / micro-batch (train_epochs'
+accumulation_steps). Probing stops at the first candidate over budget,
+or predicted to be over budget by a linear fit of the sizes probed so
+far, so the probe itself is not OOM-killed.
+
+The default budget is 90% of the memory available to this process (the
+smaller of MemAvailable and the cgroup limit minus its usage).
+
+checkpointing_report measures what activation checkpointing (rpn_models.
+set_activation_checkpointing: the trainable VGG tail and the three
+EnhancedRPN conv+CBAM blocks recomputed in backward) saves in peak memory
+and costs in step time, per batch size.
+
+Usage:
+    python batch_sizing.py --batch-size 32
+    python batch_sizing.py --checkpointing-report 1 2 4 --trainable-layers 3
+    python rpn_training.py --batch-size 32 --auto-batch --memory-budget-mb 12000
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from throughput_bench import run_isolated
+
+
+def available_memory_mb():
+    """MemAvailable, capped by the cgroup (v2 or v1) limit minus current usage."""
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    for limit_path, usage_path in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+                                    "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit != "max" and int(limit) < 2**60:
+            cgroup_free = (int(limit) - usage) / 2**20
+            available = cgroup_free if available is None else min(available, cgroup_free)
+        break
+    if available is None:
+        raise RuntimeError("Cannot determine the available memory; pass memory_budget_mb")
+    return available
+
+
+def probe_peak_memory(config, batch_size, num_workers=0, steps=2, threads=None, start_method="spawn"):
+    """
+    Peak RSS in MB during `steps` training steps at batch_size in a fresh
+    process (model loading excluded), counting num_workers DataLoader
+    workers at the measured worker peak. None if the probe failed (e.g.
+    was OOM-killed).
+    """
+    config = dict(config, warmup=0, max_batches=steps, n_images=batch_size * steps)
+    result = run_isolated(config, "train", threads or torch.get_num_threads(), num_workers, batch_size,
+                          start_method=start_method)
+    if "error" in result:
+        print(f"[WARNING] batch {batch_size} failed: {result['error']}")
+        return None
+    return result["timed_peak_rss_mb"] + num_workers * result["peak_worker_rss_mb"]
+
+
+def choose_batch_size(config, batch_size, memory_budget_mb=None, headroom=0.9, num_workers=0, steps=2,
+                      threads=None, start_method="spawn"):
+    """
+    Largest micro-batch (a divisor of batch_size) whose measured peak is
+    within memory_budget_mb (default: headroom x available_memory_mb()).
+    config is a throughput_bench config dict. Returns {"batch_size",
+    "accumulation_steps", "effective_batch_size", "budget_mb",
+    "peak_mb": {micro-batch: MB}, "mb_per_image"}.
+    """
+    budget = memory_budget_mb or headroom * available_memory_mb()
+    candidates = [b for b in range(1, batch_size + 1) if batch_size % b == 0]
+    peaks = {}
+    for candidate in candidates:
+        if len(peaks) >= 2:
+            slope, intercept = np.polyfit(list(peaks), list(peaks.values()), 1)
+            if intercept + slope * candidate > budget:
+                print(f"[INFO] batch {candidate}: predicted {intercept + slope * candidate:.0f} MB, over budget")
+                break
+        peak = probe_peak_memory(config, candidate, num_workers, steps, threads, start_method)
+        if peak is None:
+            break
+        print(f"[INFO] batch {candidate}: peak {peak:.0f} MB (budget {budget:.0f} MB)")
+        if peak > budget:
+            break
+        peaks[candidate] = peak
+    if not peaks:
+        raise RuntimeError(f"Batch size 1 does not fit in {budget:.0f} MB")
+
+    micro = max(peaks)
+    slope = float(np.polyfit(list(peaks), list(peaks.values()), 1)[0]) if len(peaks) >= 2 else None
+    return {"batch_size": micro, "accumulation_steps": batch_size // micro, "effective_batch_size": batch_size,
+            "budget_mb": budget, "peak_mb": peaks, "mb_per_image": slope}
+
+
+def checkpointing_report(config, batch_sizes=(1, 2, 4), steps=3, threads=None, start_method="spawn"):
+    """
+    Training steps at each batch size without and with activation
+    checkpointing (fresh process each); prints peak memory of the steps,
+    the saving, time per step and the overhead. Returns the rows.
+    """
+    rows = []
+    for batch_size in batch_sizes:
+        row = {"batch_size": batch_size}
+        for enabled in (False, True):
+            run = dict(config, activation_checkpointing=enabled, warmup=1, max_batches=steps,
+                       n_images=batch_size * (steps + 1))
+            result = run_isolated(run, "train", threads or torch.get_num_threads(), 0, batch_size,
+                                  start_method=start_method)
+            if "error" in result:
+                print(f"[WARNING] batch {batch_size} (checkpointing={enabled}) failed: {result['error']}")
+                break
+            key = "on" if enabled else "off"
+            row[f"peak_mb_{key}"] = result["timed_peak_rss_mb"]
+            row[f"step_ms_{key}"] = 1000.0 * result["seconds"] * batch_size / result["images"]
+        else:
+            rows.append(row)
+
+    print(f"\n{'batch':>6}{'peak MB':>9}{'ckpt MB':>9}{'saved':>8}{'step ms':>9}{'ckpt ms':>9}{'overhead':>10}")
+    for row in rows:
+        saved = row["peak_mb_off"] - row["peak_mb_on"]
+        overhead = row["step_ms_on"] / row["step_ms_off"] - 1
+        print(f"{row['batch_size']:>6}{row['peak_mb_off']:>9.0f}{row['peak_mb_on']:>9.0f}"
+              f"{saved / row['peak_mb_off']:>8.1%}{row['step_ms_off']:>9.1f}{row['step_ms_on']:>9.1f}{overhead:>+10.1%}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Largest training micro-batch within a memory budget")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-labels", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=8, help="effective batch size to reach")
+    parser.add_argument("--memory-budget-mb", type=float, default=None)
+    parser.add_argument("--headroom", type=float, default=0.9, help="share of the available memory to use")
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=2, help="training steps per probe")
+    parser.add_argument("--trainable-layers", type=int, default=0, help="unfrozen VGG tail (3: conv5_3)")
+    parser.add_argument("--activation-checkpointing", action="store_true")
+    parser.add_argument("--checkpointing-report", type=int, nargs="+", default=None, metavar="BATCH_SIZE",
+                        help="compare memory and step time with and without activation checkpointing")
+    args = parser.parse_args()
+
+    config = {"image_dir": args.image_dir, "pt_dir": args.pt_dir, "labels_json": args.labels_json,
+              "n_labels": args.n_labels, "top_k": 20, "classifier": "roi_head", "rpn_weights": None,
+              "pretrained": True, "trainable_layers": args.trainable_layers,
+              "activation_checkpointing": args.activation_checkpointing}
+    if args.checkpointing_report:
+        checkpointing_report(config, args.checkpointing_report, max(args.steps, 3))
+    else:
+        choice = choose_batch_size(config, args.batch_size, args.memory_budget_mb, args.headroom, args.num_workers,
+                                   args.steps)
+        print(f"[INFO] batch size {choice['batch_size']} x {choice['accumulation_steps']} accumulation steps "
+              f"= {choice['effective_batch_size']} (budget {choice['budget_mb']:.0f} MB"
+              + (f", ~{choice['mb_per_image']:.0f} MB per image)" if choice["mb_per_image"] else ")"))
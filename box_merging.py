@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Vectorized box merging.
+
+merge_boxes builds the IoU graph of a set of boxes once, labels its
+connected components in tensor ops and fuses every component either into
+its min/max union or its score-weighted average (combine_box_group). With
+mode="union" and min_cluster_size=2 it returns exactly what the DBSCAN
+`combine_boxes` in rpn_roi_integrated.py returns (DBSCAN with
+min_samples=2 on a 1-IoU distance is connected components of the
+IoU >= threshold graph, isolated boxes are its noise points), without
+sklearn.
+
+recursive_nms keeps the notebook's semantics (index-order greedy merge,
+repeated until nothing overlaps) but each pass is one NMS call plus one
+matrix product instead of a Python loop over the boxes. Its results are
+order dependent and not a connected-components clustering, so it stays
+the default in detection.py; merge_boxes is selectable there with
+merge="union" / merge="weighted".
+
+Usage (parity with the previous implementations + timing):
+    python box_merging.py --n-boxes 40 400 2000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torchvision.ops as ops
+from torchvision.ops import box_iou
+
+from rpn_utils import compute_iou_vectorized
+
+MERGE_MODES = ("union", "weighted")
+
+
+def combine_box_group(boxes, scores):
+    """
+    Combine a group of boxes into one representative box using score-weighted average
+    """
+    weights = scores / scores.sum()
+    combined_box = torch.sum(boxes * weights.view(-1, 1), dim=0)
+    return combined_box
+
+
+# -----------------------
+# IoU-graph merging
+# -----------------------
+
+def connected_components(adjacency):
+    """
+    adjacency: (N,N) symmetric bool matrix.
+    Returns (N,) component ids, each the smallest box index of its component
+    (min-label propagation over the edge list with pointer jumping).
+    """
+    src, dst = adjacency.nonzero(as_tuple=True)
+    labels = torch.arange(adjacency.shape[0], device=adjacency.device)
+    while True:
+        new_labels = labels.scatter_reduce(0, src, labels[dst], "amin")
+        new_labels = new_labels[new_labels]
+        if torch.equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def merge_boxes(boxes, scores=None, iou_threshold=0.5, mode="union", min_cluster_size=2):
+    """
+    Merge boxes whose IoU >= iou_threshold, transitively, in one pass.
+
+    Args:
+        boxes: (N,4) tensor, [x1,y1,x2,y2] (any order with the two minima first)
+        scores: (N,) weights for mode="weighted"; uniform when None
+        mode: "union" (min/max over the component) or "weighted" (combine_box_group)
+        min_cluster_size: components smaller than this are left as they are
+
+    Returns:
+        merged: (C + U, 4) one box per cluster in order of its first box,
+            then the U unclustered boxes in input order
+        labels: (N,) cluster id of every input box, -1 for unclustered ones
+    """
+    if mode not in MERGE_MODES:
+        raise ValueError(f"Unknown merge mode '{mode}'. Available: {', '.join(MERGE_MODES)}")
+    n = len(boxes)
+    if n == 0:
+        return boxes, torch.empty(0, dtype=torch.long, device=boxes.device)
+
+    boxes = boxes.float()
+    adjacency = box_iou(boxes, boxes) >= iou_threshold
+    _, component = torch.unique(connected_components(adjacency), return_inverse=True)
+    sizes = torch.bincount(component)
+    is_cluster = sizes >= min_cluster_size
+    cluster_ids = torch.cumsum(is_cluster.long(), dim=0) - 1
+    clustered = is_cluster[component]
+    labels = torch.where(clustered, cluster_ids[component], -1)
+
+    n_clusters = int(is_cluster.sum())
+    members, member_labels = boxes[clustered], labels[clustered]
+    if mode == "union":
+        index = member_labels.unsqueeze(1).expand(-1, 2)
+        mins = boxes.new_zeros(n_clusters, 2).scatter_reduce(0, index, members[:, :2], "amin", include_self=False)
+        maxs = boxes.new_zeros(n_clusters, 2).scatter_reduce(0, index, members[:, 2:], "amax", include_self=False)
+        merged = torch.cat([mins, maxs], dim=1)
+    else:
+        weights = torch.ones(n, device=boxes.device) if scores is None else scores.float()
+        weights = weights[clustered]
+        totals = boxes.new_zeros(n_clusters).index_add(0, member_labels, weights)
+        merged = boxes.new_zeros(n_clusters, 4).index_add(0, member_labels,
+                                                           members * (weights / totals[member_labels]).unsqueeze(1))
+
+    return torch.cat([merged, boxes[~clustered]]), labels
+
+
+def combine_boxes(boxes, scores=None, iou_threshold=0.5, min_cluster_size=2):
+    """Drop-in for the DBSCAN combine_boxes of rpn_roi_integrated.py (min/max union)."""
+    merged, labels = merge_boxes(torch.as_tensor(boxes), scores, iou_threshold, "union", min_cluster_size)
+    if not isinstance(boxes, torch.Tensor):
+        return merged.numpy(), labels.numpy()
+    return merged, labels.cpu().numpy()
+
+
+# -----------------------
+# Greedy recursive merge
+# -----------------------
+
+def recursive_nms(boxes, scores, iou_threshold=0.5, recursion_limit=10):
+    """
+    Custom NMS that recursively combines overlapping boxes by comparing all pairs.
+
+    In every pass the boxes are visited in index order; a box not yet
+    absorbed takes the score-weighted average (combine_box_group) of
+    itself and all boxes with IoU > iou_threshold, which are dropped.
+    That visiting order is a greedy NMS with priority = index, so a pass
+    is one ops.nms call plus one matrix product.
+
+    Args:
+        boxes: Tensor of shape [N, 4] (x1, y1, x2, y2 format)
+        scores: Tensor of shape [N] containing confidence scores
+        iou_threshold: IoU threshold for combining boxes
+        recursion_limit: Maximum number of recursive passes
+
+    Returns:
+        combined_boxes: Tensor of combined boxes
+        keep_indices: Indices of kept boxes from original input
+    """
+    if len(boxes) == 0:
+        return boxes, torch.empty(0, dtype=torch.long, device=boxes.device)
+
+    boxes = boxes.float()
+    for _ in range(recursion_limit):
+        overlaps = box_iou(boxes, boxes) > iou_threshold
+        overlaps.fill_diagonal_(False)
+        if not overlaps.any():
+            break
+
+        priority = -torch.arange(len(boxes), dtype=torch.float32, device=boxes.device)
+        keep = ops.nms(boxes, priority, iou_threshold).sort().values
+
+        groups = overlaps[keep]
+        groups[torch.arange(len(keep), device=boxes.device), keep] = True
+        weights = groups * scores.unsqueeze(0)
+        weights = weights / weights.sum(dim=1, keepdim=True)
+        boxes = weights.to(boxes.dtype) @ boxes
+        scores = scores[keep]
+
+    return boxes, torch.arange(len(boxes), device=boxes.device)
+
+
+# -----------------------
+# Reference implementations / parity
+# -----------------------
+
+def loop_recursive_nms(boxes, scores, iou_threshold=0.5, recursion_limit=10):
+    """Reference: the previous per-box loop of detection.recursive_nms."""
+    if len(boxes) == 0:
+        return boxes, torch.empty(0, dtype=torch.long, device=boxes.device)
+    boxes = boxes.float()
+    keep = torch.ones(len(boxes), dtype=torch.bool, device=boxes.device)
+    changed = True
+    recursion_count = 0
+    while changed and recursion_count < recursion_limit:
+        changed = False
+        iou_matrix = box_iou(boxes, boxes)
+        iou_matrix.fill_diagonal_(0)
+        overlaps = iou_matrix > iou_threshold
+        for i in range(len(boxes)):
+            if not keep[i]:
+                continue
+            overlapping_indices = torch.where(overlaps[i])[0]
+            if len(overlapping_indices) > 0:
+                boxes[i] = combine_box_group(torch.cat([boxes[i].unsqueeze(0), boxes[overlapping_indices]]),
+                                             torch.cat([scores[i].unsqueeze(0), scores[overlapping_indices]]))
+                keep[overlapping_indices] = False
+                changed = True
+        boxes = boxes[keep]
+        scores = scores[keep]
+        keep = torch.ones(len(boxes), dtype=torch.bool, device=boxes.device)
+        recursion_count += 1
+    return boxes, torch.where(keep)[0]
+
+
+def dbscan_combine_boxes(boxes, iou_threshold=0.5, min_cluster_size=2):
+    """Reference: the DBSCAN combine_boxes of rpn_roi_integrated.py (needs sklearn)."""
+    from sklearn.cluster import DBSCAN
+
+    boxes_np = boxes.numpy()
+    distance_matrix = 1 - compute_iou_vectorized(boxes_np, boxes_np)
+    labels = DBSCAN(eps=1-iou_threshold, min_samples=min_cluster_size, metric="precomputed").fit(distance_matrix).labels_
+    combined = []
+    for cluster_id in np.unique(labels):
+        if cluster_id == -1:
+            continue
+        cluster_boxes = boxes_np[labels == cluster_id]
+        combined.append(np.concatenate([cluster_boxes[:, :2].min(axis=0), cluster_boxes[:, 2:].max(axis=0)]))
+    combined.extend(boxes_np[labels == -1])
+    return torch.from_numpy(np.array(combined, dtype=np.float32).reshape(-1, 4)), labels
+
+
+def random_proposals(n_boxes, image_size=(720, 1280), n_objects=None, seed=0):
+    """Jittered copies of a few random boxes, like the top-k proposals of one frame."""
+    generator = torch.Generator().manual_seed(seed)
+    n_objects = n_objects or max(1, n_boxes // 10)
+    h, w = image_size
+    centres = torch.rand(n_objects, 2, generator=generator) * torch.tensor([w, h])
+    sizes = 20 + torch.rand(n_objects, 2, generator=generator) * torch.tensor([w, h]) / 4
+    owner = torch.randint(n_objects, (n_boxes,), generator=generator)
+    ctr = centres[owner] + torch.randn(n_boxes, 2, generator=generator) * sizes[owner] * 0.1
+    size = sizes[owner] * (1 + 0.2 * torch.randn(n_boxes, 2, generator=generator)).clamp(min=0.3)
+    boxes = torch.cat([ctr - size / 2, ctr + size / 2], dim=1)
+    scores = torch.rand(n_boxes, generator=generator)
+    return boxes, scores
+
+
+def _time(fn, n_iters):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return (time.perf_counter() - start) / n_iters * 1000.0
+
+
+def compare_implementations(n_boxes_list=(40, 400, 2000), iou_threshold=0.5, n_iters=5, seed=0):
+    """Parity of both rewrites with their references and ms per call."""
+    results = []
+    for n_boxes in n_boxes_list:
+        boxes, scores = random_proposals(n_boxes, seed=seed)
+
+        ref_boxes, _ = loop_recursive_nms(boxes.clone(), scores, iou_threshold, recursion_limit=n_boxes)
+        new_boxes, _ = recursive_nms(boxes, scores, iou_threshold, recursion_limit=n_boxes)
+        nms_ok = ref_boxes.shape == new_boxes.shape and torch.allclose(ref_boxes, new_boxes, atol=1e-3)
+
+        ref_union, ref_labels = dbscan_combine_boxes(boxes, iou_threshold)
+        new_union, new_labels = merge_boxes(boxes, iou_threshold=iou_threshold)
+        union_ok = torch.equal(ref_union, new_union) and np.array_equal(ref_labels, new_labels.numpy())
+
+        results.append({
+            "n_boxes": n_boxes,
+            "recursive_nms_ok": nms_ok,
+            "combine_boxes_ok": union_ok,
+            "loop_nms_ms": _time(lambda: loop_recursive_nms(boxes.clone(), scores, iou_threshold, n_boxes), n_iters),
+            "recursive_nms_ms": _time(lambda: recursive_nms(boxes, scores, iou_threshold, n_boxes), n_iters),
+            "dbscan_ms": _time(lambda: dbscan_combine_boxes(boxes, iou_threshold), n_iters),
+            "merge_union_ms": _time(lambda: merge_boxes(boxes, iou_threshold=iou_threshold), n_iters),
+            "merge_weighted_ms": _time(lambda: merge_boxes(boxes, scores, iou_threshold, "weighted"), n_iters),
+        })
+    return results
+
+
+def print_comparison(results):
+    print(f"\n{'boxes':>6}{'loop nms':>10}{'rec nms':>9}{'dbscan':>9}{'union':>9}{'weighted':>10}  parity")
+    for r in results:
+        parity = "OK" if r["recursive_nms_ok"] and r["combine_boxes_ok"] else \
+            f"FAILED (recursive_nms {r['recursive_nms_ok']}, combine_boxes {r['combine_boxes_ok']})"
+        print(f"{r['n_boxes']:>6}{r['loop_nms_ms']:>10.1f}{r['recursive_nms_ms']:>9.1f}{r['dbscan_ms']:>9.1f}"
+              f"{r['merge_union_ms']:>9.1f}{r['merge_weighted_ms']:>10.1f}  {parity}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and time the vectorized box merging")
+    parser.add_argument("--n-boxes", type=int, nargs="+", default=[40, 400, 2000])
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--n-iters", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print_comparison(compare_implementations(args.n_boxes, args.iou_threshold, args.n_iters, args.seed))
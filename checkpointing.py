@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Resumable full-state training checkpoints.
+
+train_epochs used to save only rpn_model.state_dict() every few epochs,
+so a preempted job lost the optimizer state, the RNG streams and its
+position in the epoch. CheckpointManager saves all of it:
+
+    model / optimizer state dicts, epoch, step in the epoch, global step,
+    python / numpy / torch (+ cuda) RNG states, sampler state, history and
+    any extra picklable state (e.g. TrainingMetrics.state_dict()).
+
+The state is copied to CPU on the calling thread (so training can keep
+mutating the parameters) and written by a background thread to a
+temporary file that is fsync'ed and then os.replace'd into place, so a
+kill at any point leaves either the previous or the new checkpoint,
+never a truncated one. Only one save is in flight at a time.
+
+Checkpoints are ranked by write order, not by global step: every file
+name starts with a sequence number one above the highest in the
+directory. A run restarted from step 0 (or with resume=False) in a
+directory holding a longer run's checkpoints therefore writes the newest
+ones, and latest() returns them. Files from before the sequence number
+(ckpt_e{epoch}_s{step}.pt) rank below all numbered ones.
+
+Retention: the newest `keep_last` checkpoints are kept, plus every
+checkpoint taken at the end of an epoch that is a multiple of
+`keep_every_epochs` (if set); those permanent ones do not count towards
+`keep_last`.
+
+ResumableSampler replaces `shuffle=True`: the permutation depends only on
+(seed, epoch), and it can start mid-epoch, so a resumed run sees exactly
+the batches the interrupted run had not trained on yet.
+
+    manager = CheckpointManager("checkpoints", keep_last=3, keep_every_epochs=10)
+    train_epochs(..., checkpoints=manager, save_steps=200)   # resumes from manager.latest()
+"""
+
+import argparse
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r"^ckpt_(?:(\d+)_)?e(\d+)_s(\d+)(_end)?\.pt$")
+
+
+# -----------------------
+# RNG / sampler state
+# -----------------------
+
+def capture_rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Shuffling sampler whose order is a function of (seed, epoch) only.
+    set_epoch() picks the permutation; set_position(n) skips the first n
+    samples of it (for resuming in the middle of an epoch). The position
+    applies to the next iteration only.
+    """
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_position(self, start):
+        self.start = start
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+
+    def order(self):
+        """Sample indices of the current epoch."""
+        n = len(self.data_source)
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            return torch.randperm(n, generator=generator).tolist()
+        return list(range(n))
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return iter(self.order()[start:])
+
+    def __len__(self):
+        return len(self.order()) - self.start
+
+
+# -----------------------
+# Manager
+# -----------------------
+
+def _to_cpu(obj):
+    """Deep copy of a (nested) state with every tensor cloned to CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager:
+    """
+    Writes ckpt_{seq}_e{epoch}_s{global_step}.pt files under `directory`
+    (seq: write order).
+    save() returns as soon as the state has been copied to CPU; wait()
+    blocks until the pending write is on disk. Errors from the writer
+    thread are re-raised by the next save() / wait(). A read_only
+    manager restores but never writes (non-zero ranks in distributed
+    training). DistributedDataParallel models are saved unwrapped.
+    """
+    def __init__(self, directory="checkpoints", keep_last=3, keep_every_epochs=None, async_save=True,
+                 read_only=False):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_every_epochs = keep_every_epochs
+        self.async_save = async_save
+        self.read_only = read_only
+        self._thread = None
+        self._error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def checkpoints(self):
+        """(global_step, path) of the complete checkpoints, oldest written first."""
+        return [(step, path) for _, step, path, _ in self._scan()]
+
+    def _scan(self):
+        """(seq, global_step, path, permanent) per checkpoint, sorted by write order (seq -1: unnumbered)."""
+        found = []
+        for name in os.listdir(self.directory):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match:
+                seq = int(match.group(1)) if match.group(1) is not None else -1
+                epoch, step = int(match.group(2)), int(match.group(3))
+                permanent = bool(match.group(4)) and bool(self.keep_every_epochs) and epoch % self.keep_every_epochs == 0
+                found.append((seq, step, os.path.join(self.directory, name), permanent))
+        return sorted(found)
+
+    def latest(self):
+        found = self.checkpoints()
+        return found[-1][1] if found else None
+
+    def _next_seq(self):
+        found = self._scan()
+        return max(found[-1][0] + 1, 0) if found else 0
+
+    def save(self, model, optimizer, epoch, step_in_epoch, global_step, sampler=None, history=None,
+             end_of_epoch=False, **extra):
+        """
+        Snapshot the training state. `epoch` is the epoch in progress and
+        `step_in_epoch` the number of its batches already trained on
+        (at the end of an epoch: epoch + 1 and 0).
+        """
+        if self.read_only:
+            return None
+        self.wait()
+        state = _to_cpu({
+            "model": getattr(model, "module", model).state_dict(),
+            "optimizer": optimizer.state_dict() if optimizer is not None else None,
+            "epoch": epoch,
+            "step_in_epoch": step_in_epoch,
+            "global_step": global_step,
+            "rng": capture_rng_state(),
+            "sampler": sampler.state_dict() if hasattr(sampler, "state_dict") else None,
+            "history": history,
+            "extra": extra,
+        })
+        suffix = "_end" if end_of_epoch else ""
+        path = os.path.join(self.directory, f"ckpt_{self._next_seq():06d}_e{epoch:04d}_s{global_step:08d}{suffix}.pt")
+
+        if self.async_save:
+            self._thread = threading.Thread(target=self._write, args=(state, path), daemon=True)
+            self._thread.start()
+        else:
+            self._write(state, path)
+            self._raise_error()
+        return path
+
+    def _write(self, state, path):
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._apply_retention()
+        except Exception as e:  # re-raised on the training thread
+            self._error = e
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _apply_retention(self):
+        if self.keep_last is None:
+            return
+        recent = [path for _, _, path, permanent in self._scan() if not permanent]
+        for path in recent[:max(len(recent) - self.keep_last, 0)]:
+            os.remove(path)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint write failed") from error
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def load(self, path=None, map_location="cpu"):
+        """Load `path` (default: the latest checkpoint); None if there is none."""
+        path = path or self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def restore(self, model, optimizer=None, sampler=None, path=None, map_location="cpu"):
+        """
+        Load model / optimizer / RNG / sampler state in place. Returns the
+        checkpoint dict (epoch, step_in_epoch, global_step, history, extra)
+        or None if there is nothing to resume from.
+        """
+        state = self.load(path, map_location)
+        if state is None:
+            return None
+        getattr(model, "module", model).load_state_dict(state["model"])
+        if optimizer is not None and state["optimizer"] is not None:
+            optimizer.load_state_dict(state["optimizer"])
+        if sampler is not None and state["sampler"] is not None:
+            sampler.load_state_dict(state["sampler"])
+        restore_rng_state(state["rng"])
+        return state
+
+
+def export_weights(checkpoint_path, output_path):
+    """Write the model state_dict of a full checkpoint, for the tools that load plain weights."""
+    state = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    torch.save(state["model"], output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List training checkpoints or export model weights")
+    parser.add_argument("--dir", default="checkpoints")
+    parser.add_argument("--export", default=None, help="write the latest checkpoint's model weights here")
+    args = parser.parse_args()
+
+    manager = CheckpointManager(args.dir, keep_last=None)
+    for global_step, path in manager.checkpoints():
+        state = manager.load(path)
+        print(f"{os.path.basename(path)}: epoch {state['epoch']} | step in epoch {state['step_in_epoch']} "
+              f"| global step {global_step}")
+    if args.export:
+        if manager.latest() is None:
+            print(f"[WARNING] No checkpoints in {args.dir}")
+        else:
+            export_weights(manager.latest(), args.export)
+            print(f"[INFO] Wrote {args.export}")
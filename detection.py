@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""Detection pipeline: backbone features -> RPN proposals -> merge -> classify.
+
+Port of `detect_objects` from RPN+ROI+Classification_integration.ipynb,
+minus the plotting. Proposals are classified either like the notebook
+(crop the image, resize, ObjectClassifier/ResNet18 per crop) or, when a
+`roi_head` is given, straight from the ROI-pooled RPN body features with
+ROIClassifierHead, so no second backbone pass is needed.
+
+detect_objects_batch runs the whole pipeline on a stack of images.
+
+Usage (throughput vs batch size):
+    python detection.py --rpn-weights final_model.pth --batch-sizes 1 2 4 8
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+
+from box_merging import merge_boxes, recursive_nms
+from profiling import NULL_TIMER
+from rpn_models import EnhancedRPNWithROI, ObjectClassifier, ROIClassifierHead, build_vgg_backbone
+from rpn_utils import (IMAGE_SIZE, PATCH_MEAN, PATCH_STD, PRECISIONS, CustomDataset, decode_topk,
+                       extract_first_n_labels, name_to_id, precision_autocast)
+from runtime_config import apply_tuned_settings
+
+id_to_name = list(name_to_id.keys()) + ["background"]
+
+
+# -----------------------
+# Classification
+# -----------------------
+
+def clip_proposals(proposals, image_height, image_width):
+    """Round to integer pixels, clip to the image and drop empty boxes (as the notebook does)."""
+    boxes = proposals.floor() if proposals.is_floating_point() else proposals
+    boxes = torch.stack([boxes[:, 0].clamp(min=0), boxes[:, 1].clamp(min=0),
+                         boxes[:, 2].clamp(max=image_width), boxes[:, 3].clamp(max=image_height)], dim=1)
+    valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+    return boxes[valid]
+
+
+def crop_proposals(image_tensor, boxes):
+    """
+    Cut (C,H,W) [0,1] image patches for ObjectClassifier: crop, resize to
+    IMAGE_SIZE, normalize with mean/std 0.5.
+    """
+    crops = []
+    for x1, y1, x2, y2 in boxes.long().tolist():
+        patch = TF.resize(image_tensor[:, y1:y2, x1:x2], list(IMAGE_SIZE), antialias=True)
+        crops.append(TF.normalize(patch, PATCH_MEAN, PATCH_STD))
+    return torch.stack(crops)
+
+
+def classify_crops(classifier, images, boxes_list):
+    """Second-backbone path: ResNet18 on the proposal crops of all images as one batch."""
+    crops = torch.cat([crop_proposals(image, boxes) for image, boxes in zip(images, boxes_list) if len(boxes)])
+    return F.softmax(classifier(crops.to(next(classifier.parameters()).device)), dim=1)
+
+
+def classify_pooled(rpn, roi_head, body_feats, boxes_list):
+    """ROI-head path: classify ROI-pooled RPN body features, no re-cropping."""
+    return F.softmax(roi_head(rpn.pool_rois(body_feats, boxes_list)), dim=1)
+
+
+# -----------------------
+# Detection
+# -----------------------
+
+def select_proposals(pred_locs, objectness_score, anchors, top_k=40):
+    """
+    Top-k proposals of every image in one go; only the selected anchors are decoded.
+    Returns (B, k, 4) [x1,y1,x2,y2] boxes and (B, k) objectness scores.
+    """
+    proposals, scores, _ = decode_topk(pred_locs, objectness_score, anchors, top_k)
+    return proposals, scores
+
+
+def detect_from_features(feature_maps, anchors, images, rpn, classifier=None, roi_head=None,
+                         top_k=40, iou_threshold=0.5, drop_background=True, precision="fp32", merge="recursive",
+                         timer=NULL_TIMER, rpn_outputs=None):
+    """
+    Batched detection from backbone features.
+
+    Top-k selection and decoding run on the whole (B, N) score tensor; the
+    merged proposals of all images then go through the classifier (or ROI
+    head) as one batch and are split back per image.
+
+    Args:
+        feature_maps: (B, C, Y_FM, X_FM) backbone output
+        anchors: (N, 4) [x1,y1,x2,y2] anchor grid for that feature map
+        images: (B, C, H, W) images in [0,1]
+        rpn: EnhancedRPNWithROI
+        classifier: ObjectClassifier, used when roi_head is None
+        roi_head: ROIClassifierHead on the pooled RPN features
+
+    precision="bf16" runs the RPN body and classifier under autocast;
+    decoding, NMS and the returned boxes/scores are fp32.
+
+    merge="recursive" merges proposals with recursive_nms like the notebook;
+    "union" / "weighted" use one box_merging.merge_boxes pass instead.
+
+    timer (profiling.StageTimer) times the "rpn", "proposals" and
+    "classifier" stages.
+
+    rpn_outputs: (body_feats, pred_locs, objectness_score) from
+    rpn.extract_features / rpn.predict on feature_maps, if the caller has
+    already run the RPN; it is then not run again.
+
+    Returns a list with one dict per image: "boxes" (K,4) [x1,y1,x2,y2],
+    "labels" (class names) and "scores" (class confidence).
+    """
+    if classifier is None and roi_head is None:
+        raise ValueError("detect_objects needs a classifier or a roi_head")
+    image_height, image_width = images.shape[2], images.shape[3]
+    anchors = anchors.to(feature_maps.device)
+
+    with torch.no_grad():
+        if rpn_outputs is not None:
+            body_feats, pred_locs, objectness_score = rpn_outputs
+        else:
+            with timer.stage("rpn"), precision_autocast(precision, feature_maps.device):
+                body_feats = rpn.extract_features(feature_maps)
+                pred_locs, _, objectness_score = rpn.predict(body_feats)
+
+        with timer.stage("proposals"):
+            proposals, scores = select_proposals(pred_locs.float(), objectness_score.float(), anchors, top_k)
+
+            # Apply recursive NMS (or one IoU-graph merge) to reduce overlapping proposals
+            boxes_list = []
+            for i in range(images.shape[0]):
+                if merge == "recursive":
+                    merged, _ = recursive_nms(proposals[i], scores[i].float(), iou_threshold=iou_threshold,
+                                              recursion_limit=top_k)
+                else:
+                    merged, _ = merge_boxes(proposals[i], scores[i].float(), iou_threshold, mode=merge,
+                                            min_cluster_size=1)
+                boxes_list.append(clip_proposals(merged, image_height, image_width))
+            counts = [len(b) for b in boxes_list]
+
+        with timer.stage("classifier"), precision_autocast(precision, feature_maps.device):
+            if sum(counts) == 0:
+                probs = None
+            elif roi_head is not None:
+                probs = classify_pooled(rpn, roi_head, body_feats, boxes_list)
+            else:
+                probs = classify_crops(classifier, images, boxes_list)
+        if probs is not None:
+            probs = probs.float()
+
+    results = []
+    start = 0
+    for boxes, n in zip(boxes_list, counts):
+        if n == 0:
+            results.append({"boxes": boxes.cpu(), "labels": [], "scores": torch.zeros(0)})
+            continue
+        class_scores, predicted = probs[start:start + n].max(dim=1)
+        start += n
+        if roi_head is not None and roi_head.background and drop_background:
+            keep = predicted < roi_head.num_classes
+            boxes, class_scores, predicted = boxes[keep], class_scores[keep], predicted[keep]
+        results.append({"boxes": boxes.cpu(),
+                        "labels": [id_to_name[p] for p in predicted.cpu().tolist()],
+                        "scores": class_scores.cpu()})
+    return results
+
+
+def detect_objects(feature_maps, anchors, image_tensor, rpn, classifier=None, roi_head=None,
+                   top_k=40, iou_threshold=0.5, drop_background=True, precision="fp32", merge="recursive"):
+    """
+    Detect objects in one image; see detect_from_features.
+    image_tensor is (C, H, W) or (1, C, H, W) in [0,1].
+    """
+    if image_tensor.dim() == 3:
+        image_tensor = image_tensor.unsqueeze(0)
+    return detect_from_features(feature_maps[:1], anchors, image_tensor[:1], rpn, classifier, roi_head,
+                                top_k, iou_threshold, drop_background, precision, merge)[0]
+
+
+def detect_objects_batch(images, backbone, rpn, anchors=None, classifier=None, roi_head=None,
+                         top_k=40, iou_threshold=0.5, drop_background=True, precision="fp32", merge="recursive",
+                         timer=NULL_TIMER, rpn_outputs=None):
+    """
+    Full pipeline on a (B, C, H, W) stack of images: one backbone pass, one
+    RPN pass, batched proposal selection, one classifier batch.
+    Anchors come from the RPN's cached grid for the feature map size when not given.
+    """
+    device = next(rpn.parameters()).device
+    with timer.stage("to_device"):
+        images = images.to(device)
+    with timer.stage("backbone"), torch.no_grad(), precision_autocast(precision, device):
+        feature_maps = backbone(images)
+    if anchors is None:
+        anchors = rpn.anchor_grid(feature_maps, getattr(backbone, "stride", None))
+    return detect_from_features(feature_maps, anchors, images, rpn, classifier, roi_head,
+                                top_k, iou_threshold, drop_background, precision, merge, timer)
+
+
+# -----------------------
+# Benchmark
+# -----------------------
+
+def benchmark_batch_sizes(images, backbone, rpn, classifier=None, roi_head=None,
+                          batch_sizes=(1, 2, 4, 8), top_k=40, n_iters=3, precision="fp32"):
+    """
+    Throughput of detect_objects_batch for each batch size, on a pool of
+    (N, C, H, W) images (re-used cyclically if N < batch size).
+    """
+    results = []
+    for batch_size in batch_sizes:
+        reps = -(-batch_size // images.shape[0])
+        batch = images.repeat(reps, 1, 1, 1)[:batch_size]
+        with torch.no_grad():
+            feat = backbone(batch.to(next(rpn.parameters()).device))
+        anchors = rpn.anchor_grid(feat, getattr(backbone, "stride", None))
+
+        detect_objects_batch(batch, backbone, rpn, anchors, classifier, roi_head, top_k,
+                             precision=precision)  # warm-up
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            detect_objects_batch(batch, backbone, rpn, anchors, classifier, roi_head, top_k, precision=precision)
+        ms = (time.perf_counter() - start) / n_iters * 1000.0
+        results.append({"batch_size": batch_size,
+                        "ms_per_batch": ms,
+                        "ms_per_image": ms / batch_size,
+                        "images_per_sec": batch_size / (ms / 1000.0)})
+    return results
+
+
+def print_throughput(results):
+    print(f"\n{'batch':>6}{'ms/batch':>11}{'ms/img':>9}{'img/s':>8}")
+    for r in results:
+        print(f"{r['batch_size']:>6}{r['ms_per_batch']:>11.1f}{r['ms_per_image']:>9.1f}{r['images_per_sec']:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detection throughput vs batch size")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--rpn-weights", default="final_model.pth")
+    parser.add_argument("--classifier-weights", default=None)
+    parser.add_argument("--roi-head-weights", default=None,
+                        help="classify from ROI-pooled features instead of image crops")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--top-k", type=int, default=40)
+    parser.add_argument("--n-iters", type=int, default=3)
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    args = parser.parse_args()
+
+    apply_tuned_settings("infer")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    n_pool = min(len(dataset), max(args.batch_sizes))
+    images = torch.stack([dataset[i]["image"] for i in range(n_pool)])
+
+    backbone = build_vgg_backbone(device=device)
+    rpn = EnhancedRPNWithROI().to(device).eval()
+    rpn.load_state_dict(torch.load(args.rpn_weights, map_location=device))
+    classifier, roi_head = None, None
+    if args.roi_head_weights:
+        roi_head = ROIClassifierHead(num_classes=len(name_to_id)).to(device).eval()
+        roi_head.load_state_dict(torch.load(args.roi_head_weights, map_location=device))
+    else:
+        classifier = ObjectClassifier(num_classes=len(name_to_id)).to(device).eval()
+        if args.classifier_weights:
+            classifier.load_state_dict(torch.load(args.classifier_weights, map_location=device))
+
+    results = benchmark_batch_sizes(images, backbone, rpn, classifier, roi_head,
+                                    batch_sizes=args.batch_sizes, top_k=args.top_k, n_iters=args.n_iters,
+                                    precision=args.precision)
+    print_throughput(results)
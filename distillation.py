@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Distil EnhancedRPN (teacher) into a compact student RPN.
+
+Teacher and student share the backbone and the anchor grid. The student
+is trained on the teacher's per-anchor objectness distribution (KL at
+temperature T) and box offsets (smooth L1, weighted by the teacher's
+objectness so background anchors do not dominate), optionally mixed with
+the ground-truth RPN loss. Teacher outputs can be cached to disk per
+image (fp16) so the teacher runs once over the training set; the cache
+is keyed by a hash of the teacher (and backbone) weights, so retrained or
+different weights never reuse stale outputs.
+
+Usage:
+    python distillation.py --teacher-weights final_model.pth --student-mid 256 \
+        --epochs 10 --cache-dir teacher_cache
+"""
+
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from rpn_models import CompactRPN, EnhancedRPNWithROI, build_vgg_backbone
+from rpn_training import bbox_generation, evaluate_rpn, rpn_loss
+from rpn_utils import ISIZE, CustomDataset, custom_collate_fn, extract_first_n_labels, measure_latency, standardize_filename
+
+
+# -----------------------
+# Teacher cache
+# -----------------------
+
+def model_fingerprint(*models):
+    """
+    Short hash of the models' state_dicts (names, dtypes, shapes, values)
+    and ISIZE; None entries are skipped.
+    """
+    digest = hashlib.sha1(repr(tuple(ISIZE)).encode())
+    for model in models:
+        if model is None:
+            continue
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu().contiguous()
+            digest.update(f"{name}|{tensor.dtype}|{tuple(tensor.shape)}".encode())
+            digest.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+class TeacherCache:
+    """
+    Teacher (pred_locs, pred_scores) per image in
+    cache_dir/<fingerprint>/<img>.pt (fp16), where fingerprint is
+    model_fingerprint(teacher, backbone): the outputs depend on both, so
+    each set of weights gets its own subdirectory.
+    Without cache_dir the teacher simply runs on every batch.
+    """
+    def __init__(self, teacher, cache_dir=None, backbone=None):
+        self.teacher = teacher.eval()
+        self.cache_dir = cache_dir
+        if cache_dir:
+            self.cache_dir = os.path.join(cache_dir, model_fingerprint(teacher, backbone))
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, img_id):
+        return os.path.join(self.cache_dir, standardize_filename(img_id) + ".pt")
+
+    @torch.no_grad()
+    def _run(self, feat):
+        pred_locs, pred_scores, _ = self.teacher(feat)[:3]
+        return pred_locs.float(), pred_scores.float()
+
+    def __call__(self, feat, img_ids):
+        """Teacher outputs for a batch; computes and stores what is not cached yet."""
+        if not self.cache_dir:
+            return self._run(feat)
+        paths = [self._path(i) for i in img_ids]
+        if all(os.path.exists(p) for p in paths):
+            cached = [torch.load(p) for p in paths]
+            return (torch.stack([c["locs"] for c in cached]).float().to(feat.device),
+                    torch.stack([c["scores"] for c in cached]).float().to(feat.device))
+        pred_locs, pred_scores = self._run(feat)
+        for b, p in enumerate(paths):
+            torch.save({"locs": pred_locs[b].half().cpu(), "scores": pred_scores[b].half().cpu()}, p)
+        return pred_locs, pred_scores
+
+    def fill(self, backbone, data_loader, device):
+        """Run the teacher once over data_loader and store all outputs."""
+        for batch in data_loader:
+            with torch.no_grad():
+                feat = backbone(batch["images"].to(device))
+            self(feat, batch["img_ids"])
+        print(f"[INFO] Cached teacher outputs in {self.cache_dir}")
+
+
+# -----------------------
+# Loss / training
+# -----------------------
+
+def distillation_loss(student_locs, student_scores, teacher_locs, teacher_scores, temperature=2.0, box_weight=1.0):
+    """
+    KL(teacher || student) on the 2-way objectness of every anchor at
+    temperature T (scaled by T^2), plus smooth L1 to the teacher offsets
+    weighted by the teacher's objectness probability.
+    Returns (loss, kl_loss, box_loss).
+    """
+    t_log = F.log_softmax(teacher_scores / temperature, dim=-1)
+    s_log = F.log_softmax(student_scores.float() / temperature, dim=-1)
+    kl_loss = F.kl_div(s_log.view(-1, 2), t_log.view(-1, 2), reduction="batchmean", log_target=True)
+    kl_loss = kl_loss * temperature**2
+
+    weight = F.softmax(teacher_scores, dim=-1)[..., 1]
+    diff = torch.abs(student_locs.float() - teacher_locs)
+    box_loss = torch.where(diff < 1, 0.5 * diff**2, diff - 0.5).sum(dim=-1)
+    box_loss = (box_loss * weight).sum() / weight.sum().clamp(min=1e-6)
+
+    box_loss = box_weight * box_loss
+    return kl_loss + box_loss, kl_loss, box_loss
+
+
+def train_distill(backbone, teacher_cache, student, optimizer, train_dl, epochs=10, temperature=2.0,
+                  box_weight=1.0, gt_weight=0.5, rpn_lambda=10, device=None, save_every=5):
+    """
+    loss = distillation_loss + gt_weight * rpn_loss(GT targets).
+    gt_weight=0 trains on the teacher alone.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    student.train()
+    history = []
+
+    for epoch in range(epochs):
+        sum_loss, sum_kl, sum_box, sum_gt, n_batches = 0.0, 0.0, 0.0, 0.0, 0
+        for batch in train_dl:
+            images = batch["images"].to(device)
+            with torch.no_grad():
+                feat = backbone(images)
+            teacher_locs, teacher_scores = teacher_cache(feat, batch["img_ids"])
+
+            student_locs, student_scores, _ = student(feat)[:3]
+            loss, kl_loss, box_loss = distillation_loss(student_locs, student_scores, teacher_locs, teacher_scores,
+                                                        temperature, box_weight)
+            gt_loss = torch.tensor(0.0, device=device)
+            if gt_weight > 0:
+                targets = [{"boxes": b, "labels": l} for b, l in zip(batch["boxes"], batch["labels"])]
+                gt_locs_np, gt_scores_np, _ = bbox_generation([img for img in images], targets,
+                                                              feat.shape[3], feat.shape[2])
+                gt_loss, _, _ = rpn_loss(student_locs, student_scores, torch.from_numpy(gt_locs_np).to(device),
+                                         torch.from_numpy(gt_scores_np.astype(np.float32)).to(device), rpn_lambda)
+                loss = loss + gt_weight * gt_loss
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            sum_loss += loss.item()
+            sum_kl += kl_loss.item()
+            sum_box += box_loss.item()
+            sum_gt += gt_loss.item()
+            n_batches += 1
+
+        n = max(n_batches, 1)
+        history.append({"loss": sum_loss / n, "kl": sum_kl / n, "box": sum_box / n, "gt": sum_gt / n})
+        print(f"Epoch {epoch+1}/{epochs}: Loss {sum_loss/n:.3f} | KL {sum_kl/n:.3f} | "
+              f"Box {sum_box/n:.3f} | GT {sum_gt/n:.3f}")
+        if save_every and (epoch+1) % save_every == 0:
+            torch.save(student.state_dict(), f"./student_epoch_{epoch+1}.pth")
+    return student, history
+
+
+def compare_teacher_student(backbone, teacher, student, val_dl, top_k=20, n_iters=10, device=None):
+    """Recall@top_k, mean best IoU, RPN latency (full-size frame) and params for both heads."""
+    if device is None:
+        device = next(student.parameters()).device
+    with torch.no_grad():
+        feat = backbone(torch.zeros(1, 3, ISIZE[0], ISIZE[1], device=device))
+    rows = []
+    for name, model in (("teacher", teacher), ("student", student)):
+        model.eval()
+        metrics = evaluate_rpn(backbone, model, val_dl, top_k=top_k, device=device)
+        rows.append({"model": name,
+                     "params": sum(p.numel() for p in model.parameters()),
+                     "rpn_ms": measure_latency(model, feat, n_iters=n_iters),
+                     **metrics})
+    print(f"\n{'model':<10}{'params':>10}{'rpn ms':>9}{f'R@{top_k}':>8}{'mIoU':>7}")
+    for r in rows:
+        print(f"{r['model']:<10}{r['params']:>10}{r['rpn_ms']:>9.1f}{r['recall']:>8.3f}{r['mean_best_iou']:>7.3f}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distil EnhancedRPN into a compact student RPN")
+    parser.add_argument("--teacher-weights", default="final_model.pth")
+    parser.add_argument("--student-mid", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--box-weight", type=float, default=1.0)
+    parser.add_argument("--gt-weight", type=float, default=0.5)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--cache-dir", default=None, help="cache teacher outputs here")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    train_size = int(0.85 * len(dataset))
+    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, len(dataset) - train_size],
+                                                               generator=torch.Generator().manual_seed(0))
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
+                                               collate_fn=custom_collate_fn, num_workers=2)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False,
+                                             collate_fn=custom_collate_fn, num_workers=2)
+
+    backbone = build_vgg_backbone(device=device)
+    teacher = EnhancedRPNWithROI().to(device).eval()
+    teacher.load_state_dict(torch.load(args.teacher_weights, map_location=device))
+    student = CompactRPN(mid_channels=args.student_mid).to(device)
+
+    cache = TeacherCache(teacher, args.cache_dir, backbone)
+    if args.cache_dir:
+        cache.fill(backbone, train_loader, device)
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr, weight_decay=1e-4)
+    train_distill(backbone, cache, student, optimizer, train_loader, epochs=args.epochs,
+                  temperature=args.temperature, box_weight=args.box_weight, gt_weight=args.gt_weight, device=device)
+    compare_teacher_student(backbone, teacher, student, val_loader, top_k=args.top_k)
+    torch.save(student.state_dict(), "./student_final.pth")
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Multi-process CPU data-parallel RPN training (DistributedDataParallel, gloo).
+
+One process per rank, each with torch.set_num_threads(threads / ranks),
+runs rpn_training.train_epochs on its own shard of the training split.
+Per rank:
+    - ShardedSampler: the (seed, epoch) permutation of ResumableSampler,
+      padded to a multiple of the world size and strided by rank, so all
+      ranks take the same number of steps and a checkpoint's step count
+      resumes every shard at the right place;
+    - the frozen backbone, anchor targets (bbox_generation) and recall
+      sampling run locally on the rank's batch; only the RPN gradients
+      are all-reduced by DDP.
+Rank 0 owns the checkpoints (other ranks restore from them read-only),
+the epoch metrics are all-reduced over the ranks (DistributedTrainingMetrics)
+and only rank 0 prints.
+
+The per-rank batch size is fixed, so the global batch grows with the
+number of processes (--scale-lr scales the learning rate with it).
+
+Usage:
+    python distributed.py --processes 4 --epochs 20 --checkpoint-dir checkpoints
+    python distributed.py --scaling 1 2 4 8 --epochs 1 --n-train 256
+"""
+
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from backbones import BACKBONES, build_backbone, build_rpn_for_backbone
+from checkpointing import CheckpointManager, ResumableSampler
+from rpn_models import build_vgg_backbone
+from rpn_training import build_datasets, train_epochs
+from rpn_utils import custom_collate_fn
+from training_metrics import TrainingMetrics
+
+
+class ShardedSampler(ResumableSampler):
+    """
+    ResumableSampler restricted to one rank: indices rank, rank + world_size,
+    ... of the epoch permutation, padded (by wrapping around) so every
+    rank gets ceil(n / world_size) samples.
+    """
+    def __init__(self, data_source, rank=0, world_size=1, shuffle=True, seed=0):
+        super().__init__(data_source, shuffle=shuffle, seed=seed)
+        self.rank = rank
+        self.world_size = world_size
+
+    def order(self):
+        order = super().order()
+        total = -(-len(order) // self.world_size) * self.world_size
+        order = (order * (-(-total // len(order))))[:total]
+        return order[self.rank:total:self.world_size]
+
+
+class DistributedTrainingMetrics(TrainingMetrics):
+    """
+    TrainingMetrics whose state (and therefore epoch_summary) covers the
+    batches of every rank: loss sums and batch counts are all-reduced,
+    the sampled recalls gathered. Collective, so every rank must call
+    state_dict / epoch_summary together.
+    """
+    def state_dict(self):
+        state = super().state_dict()
+        names = sorted(state["loss_sums"])
+        totals = torch.tensor([state["loss_sums"][name] for name in names]
+                              + [state["n_batches"], state["n_samples"]], dtype=torch.float64)
+        dist.all_reduce(totals)
+        recalls = [None] * dist.get_world_size()
+        dist.all_gather_object(recalls, state["recalls"])
+        return {"loss_sums": dict(zip(names, totals[:-2].tolist())), "n_batches": int(totals[-2]),
+                "n_samples": int(totals[-1]), "batch_index": state["batch_index"],
+                "recalls": [r for rank in recalls for r in rank]}
+
+    def load_state_dict(self, state, device=None):
+        """The checkpointed state is already the all-rank total: rank 0 keeps it, the others start empty."""
+        if dist.get_rank() != 0:
+            state = {"loss_sums": {name: 0.0 for name in state["loss_sums"]}, "n_batches": 0, "n_samples": 0,
+                     "batch_index": state["batch_index"], "recalls": []}
+        super().load_state_dict(state, device)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def train_worker(rank, world_size, config, results=None):
+    """Entry point of one rank; config is the dict built by launch()."""
+    os.environ["MASTER_ADDR"] = config["master_addr"]
+    os.environ["MASTER_PORT"] = str(config["master_port"])
+    torch.set_num_threads(config["threads_per_rank"])
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    if rank != 0:
+        sys.stdout = open(os.devnull, "w")
+    device = torch.device("cpu")
+
+    try:
+        seed = config["seed"]
+        torch.manual_seed(seed)             # same RPN init everywhere (DDP also broadcasts rank 0's)
+        np.random.seed(seed + rank)         # per-rank anchor target subsampling
+        random.seed(seed + rank)
+
+        train_dataset, _ = build_datasets(config["image_dir"], config["pt_dir"], config["labels_json"],
+                                          config["n_train"])
+        sampler = ShardedSampler(train_dataset, rank, world_size, seed=seed)
+        train_dl = torch.utils.data.DataLoader(train_dataset, batch_size=config["batch_size"], sampler=sampler,
+                                               collate_fn=custom_collate_fn, num_workers=config["num_workers"])
+
+        # Rank 0 fetches the pretrained weights first so the ranks do not race on the download
+        if rank != 0:
+            dist.barrier()
+        if config.get("backbone", "vgg16") == "vgg16":
+            backbone = build_vgg_backbone(pretrained=config["pretrained"], device=device)
+        else:
+            backbone = build_backbone(config["backbone"], pretrained=config["pretrained"], device=device)
+        if rank == 0:
+            dist.barrier()
+
+        rpn_model = DistributedDataParallel(build_rpn_for_backbone(backbone))
+        lr = config["lr"] * (world_size if config["scale_lr"] else 1)
+        optimizer = torch.optim.Adam(rpn_model.parameters(), lr=lr, weight_decay=1e-4)
+        checkpoints = None
+        if config["checkpoint_dir"]:
+            checkpoints = CheckpointManager(config["checkpoint_dir"], keep_last=config["keep_last"],
+                                            keep_every_epochs=config["keep_every_epochs"], read_only=rank != 0)
+        metrics = DistributedTrainingMetrics(recall_every=config["recall_every"], top_k=config["top_k"])
+
+        dist.barrier()
+        start = time.perf_counter()
+        _, history = train_epochs(backbone, rpn_model, optimizer, train_dl, epochs=config["epochs"],
+                                  top_k=config["top_k"], device=device, save_every=0,
+                                  recall_every=config["recall_every"], checkpoints=checkpoints,
+                                  save_steps=config["save_steps"], metrics=metrics)
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+
+        if rank == 0:
+            if config["output"]:
+                torch.save(rpn_model.module.state_dict(), config["output"])
+            if results is not None:
+                n_images = len(sampler.order()) * world_size * config["epochs"]
+                results.put({"processes": world_size, "threads_per_rank": config["threads_per_rank"],
+                             "seconds": elapsed, "images": n_images, "history": history})
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(config, processes, start_method="spawn"):
+    """Run train_worker on `processes` ranks; returns rank 0's result dict."""
+    config = dict(config, master_addr=config.get("master_addr", "127.0.0.1"), master_port=free_port())
+    config.setdefault("threads_per_rank", max(1, (config.get("threads") or os.cpu_count()) // processes))
+    results = mp.get_context(start_method).SimpleQueue()
+    mp.start_processes(train_worker, args=(processes, config, results), nprocs=processes, join=True,
+                       start_method=start_method)
+    return results.get() if not results.empty() else None
+
+
+def scaling_report(config, process_counts=(1, 2, 4, 8), start_method="spawn"):
+    """Same training at each process count (threads split evenly); prints throughput and efficiency."""
+    rows = []
+    for processes in process_counts:
+        if processes > (config.get("threads") or os.cpu_count()):
+            print(f"[WARNING] {processes} processes on {os.cpu_count()} cores: ranks will share cores")
+        print(f"[INFO] Training with {processes} process(es)")
+        result = launch(dict(config, checkpoint_dir=None, output=None), processes, start_method)
+        result["images_per_s"] = result["images"] / result["seconds"]
+        rows.append(result)
+
+    base = rows[0]["images_per_s"] / rows[0]["processes"]
+    print(f"\n{'procs':>6}{'threads':>9}{'img/s':>9}{'speedup':>9}{'eff.':>7}{'final loss':>12}")
+    for row in rows:
+        speedup = row["images_per_s"] / base
+        print(f"{row['processes']:>6}{row['threads_per_rank']:>9}{row['images_per_s']:>9.2f}"
+              f"{speedup:>9.2f}{speedup / row['processes']:>7.0%}{row['history']['loss'][-1]:>12.4f}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-parallel RPN training on CPU (DDP, gloo)")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--backbone", choices=sorted(BACKBONES), default="vgg16")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--scaling", type=int, nargs="*", default=None, help="process counts for a scaling report")
+    parser.add_argument("--threads", type=int, default=None, help="total intra-op threads (default: all cores)")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=8, help="per process")
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--scale-lr", action="store_true", help="multiply lr by the number of processes")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--recall-every", type=int, default=10)
+    parser.add_argument("--n-train", type=int, default=None)
+    parser.add_argument("--num-workers", type=int, default=1, help="DataLoader workers per process")
+    parser.add_argument("--checkpoint-dir", default=None)
+    parser.add_argument("--save-steps", type=int, default=None)
+    parser.add_argument("--keep-last", type=int, default=3)
+    parser.add_argument("--keep-every-epochs", type=int, default=None)
+    parser.add_argument("--output", default="./final_model.pth")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = {"image_dir": args.image_dir, "pt_dir": args.pt_dir, "labels_json": args.labels_json,
+              "backbone": args.backbone, "n_train": args.n_train, "threads": args.threads, "epochs": args.epochs,
+              "batch_size": args.batch_size, "lr": args.lr, "scale_lr": args.scale_lr, "top_k": args.top_k,
+              "recall_every": args.recall_every, "num_workers": args.num_workers,
+              "checkpoint_dir": args.checkpoint_dir, "save_steps": args.save_steps, "keep_last": args.keep_last,
+              "keep_every_epochs": args.keep_every_epochs, "output": args.output, "seed": args.seed,
+              "pretrained": True}
+
+    if args.scaling:
+        scaling_report(config, args.scaling)
+    else:
+        launch(config, args.processes)
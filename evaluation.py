@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""Streaming detection evaluation over a whole validation split.
+
+One pass over the data loader, no plotting. Per image it accumulates
+  - proposal recall at every (top-k, IoU threshold) pair,
+  - mean best IoU and proposal density (compute_mean_best_iou /
+    compute_proposal_density of RPN+CBAM+ROI.ipynb) at every top-k,
+  - per-class TP/FP counts for AP at every IoU threshold.
+Recall, best IoU and density are per-image means, as in evaluate_rpn.
+
+Memory does not grow with the dataset: AP is computed from fixed score
+histograms (n_score_bins per class and threshold) instead of keeping
+every detection, so detections whose scores fall into the same bin are
+treated as tied. The per-image metric work can run in a process pool
+(workers > 0) while the main process runs the models.
+
+With a classifier or ROI head, AP is reported per class on the output
+of detection.detect_from_features; otherwise the NMS'd top-k proposals
+are scored as one class-agnostic "object" class.
+
+Usage:
+    python evaluation.py --rpn-weights final_model.pth --top-ks 20 100 400 --iou-thresholds 0.5 0.7 --workers 4
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torchvision.ops as ops
+
+from detection import detect_from_features
+from rpn_models import EnhancedRPNWithROI, ObjectClassifier, ROIClassifierHead, build_vgg_backbone
+from rpn_utils import (CustomDataset, anchor_scales, batch_iou_matrix, compute_iou_vectorized, custom_collate_fn,
+                       decode_topk, extract_first_n_labels, generate_anchor_grid_np, greedy_match, name_to_id,
+                       precision_autocast, ratios)
+from runtime_config import apply_tuned_settings, tuned_num_workers
+
+TOP_KS = (20, 100, 400)
+IOU_THRESHOLDS = (0.5, 0.7)
+
+
+# -----------------------
+# Accumulator
+# -----------------------
+
+class DetectionEvaluator:
+    """
+    Fixed-size metric accumulator; add_image() per image, merge() partial
+    evaluators (e.g. from pool workers), summary() at the end.
+    """
+    def __init__(self, class_names, top_ks=TOP_KS, iou_thresholds=IOU_THRESHOLDS, n_score_bins=1000):
+        self.class_names = list(class_names)
+        self.top_ks = tuple(sorted(top_ks))
+        self.iou_thresholds = tuple(iou_thresholds)
+        self.n_score_bins = n_score_bins
+
+        self.n_images = 0
+        self.recall_sum = np.zeros((len(self.top_ks), len(self.iou_thresholds)))
+        self.density_sum = np.zeros((len(self.top_ks), len(self.iou_thresholds)))
+        self.best_iou_sum = np.zeros(len(self.top_ks))
+        self.tp_hist = np.zeros((len(self.class_names), len(self.iou_thresholds), n_score_bins), dtype=np.int64)
+        self.fp_hist = np.zeros_like(self.tp_hist)
+        self.n_gt = np.zeros(len(self.class_names), dtype=np.int64)
+
+    def config(self):
+        return self.class_names, self.top_ks, self.iou_thresholds, self.n_score_bins
+
+    def add_image(self, proposals, gt_boxes, gt_classes, det_boxes, det_classes, det_scores):
+        """
+        proposals: (K,4) sorted by objectness; gt_classes / det_classes are
+        class indices into class_names (-1 = not evaluated for AP);
+        det_scores in [0, 1].
+        """
+        self.n_gt += np.bincount(gt_classes[gt_classes >= 0], minlength=len(self.class_names))
+        if len(gt_boxes):
+            self.n_images += 1
+            if len(proposals):
+                # Best IoU of every GT within the first k proposals, for all k at once
+                ious = compute_iou_vectorized(proposals, gt_boxes)
+                prefix_best = np.maximum.accumulate(ious, axis=0)
+                qualifying = [np.cumsum(ious >= t, axis=0) for t in self.iou_thresholds]
+                for i, k in enumerate(self.top_ks):
+                    row = min(k, len(proposals)) - 1
+                    self.best_iou_sum[i] += prefix_best[row].mean()
+                    for j, t in enumerate(self.iou_thresholds):
+                        self.recall_sum[i, j] += np.mean(prefix_best[row] >= t)
+                        self.density_sum[i, j] += qualifying[j][row].mean()
+
+        if len(det_boxes) == 0:
+            return
+        order = np.argsort(-det_scores, kind="stable")
+        det_boxes, det_classes, det_scores = det_boxes[order], det_classes[order], det_scores[order]
+        ious = batch_iou_matrix([det_boxes], [gt_boxes], [det_classes], [gt_classes])[0]
+        bins = np.clip((det_scores * self.n_score_bins).astype(np.int64), 0, self.n_score_bins - 1)
+        evaluated = det_classes >= 0
+        for j, t in enumerate(self.iou_thresholds):
+            tp = greedy_match(ious, t) >= 0
+            np.add.at(self.tp_hist[:, j], (det_classes[evaluated & tp], bins[evaluated & tp]), 1)
+            np.add.at(self.fp_hist[:, j], (det_classes[evaluated & ~tp], bins[evaluated & ~tp]), 1)
+
+    def merge(self, other):
+        for name in ("n_images", "recall_sum", "density_sum", "best_iou_sum", "tp_hist", "fp_hist", "n_gt"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def average_precision(self):
+        """(C, T) all-point interpolated AP from the score histograms; nan for classes without GT."""
+        tp = np.cumsum(self.tp_hist[..., ::-1], axis=-1)
+        fp = np.cumsum(self.fp_hist[..., ::-1], axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            precision = tp / np.maximum(tp + fp, 1)
+            recall = tp / self.n_gt[:, None, None]
+        precision = np.maximum.accumulate(precision[..., ::-1], axis=-1)[..., ::-1]
+        recall_steps = np.diff(np.concatenate([np.zeros_like(recall[..., :1]), recall], axis=-1), axis=-1)
+        ap = (precision * recall_steps).sum(axis=-1)
+        ap[self.n_gt == 0] = np.nan
+        return ap
+
+    def summary(self):
+        n = max(self.n_images, 1)
+        ap = self.average_precision()
+        result = {"n_images": self.n_images}
+        for i, k in enumerate(self.top_ks):
+            result[f"mean_best_iou@{k}"] = float(self.best_iou_sum[i] / n)
+            for j, t in enumerate(self.iou_thresholds):
+                result[f"recall@{k}_iou{t}"] = float(self.recall_sum[i, j] / n)
+                result[f"density@{k}_iou{t}"] = float(self.density_sum[i, j] / n)
+        for j, t in enumerate(self.iou_thresholds):
+            result[f"mAP_iou{t}"] = float(np.nanmean(ap[:, j])) if np.any(self.n_gt > 0) else 0.0
+            for c, name in enumerate(self.class_names):
+                if self.n_gt[c] > 0:
+                    result[f"AP_iou{t}/{name}"] = float(ap[c, j])
+        return result
+
+
+def _image_stats(config, image_args):
+    """Pool worker: metrics of a chunk of images as a partial evaluator."""
+    evaluator = DetectionEvaluator(*config)
+    for args in image_args:
+        evaluator.add_image(*args)
+    return evaluator
+
+
+# -----------------------
+# Streaming loop
+# -----------------------
+
+def _class_ids(names, class_index):
+    return np.array([class_index.get(name, -1) for name in names], dtype=np.int64)
+
+
+def evaluate_detection(backbone, rpn, data_loader, classifier=None, roi_head=None, top_ks=TOP_KS,
+                       iou_thresholds=IOU_THRESHOLDS, det_top_k=40, proposal_nms=0.5, n_score_bins=1000,
+                       workers=0, precision="fp32", n_images=None, device=None):
+    """
+    Stream data_loader once and return DetectionEvaluator.summary().
+    workers > 0 computes the per-batch metrics in a process pool; at most
+    2 * workers batches are in flight, so memory stays bounded.
+    """
+    if device is None:
+        device = next(rpn.parameters()).device
+    with_classes = classifier is not None or roi_head is not None
+    class_names = list(name_to_id) if with_classes else ["object"]
+    class_index = name_to_id if with_classes else None
+    evaluator = DetectionEvaluator(class_names, top_ks, iou_thresholds, n_score_bins)
+    config = evaluator.config()
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    pending = []
+    seen = 0
+    rpn.eval()
+    try:
+        with torch.no_grad():
+            for batch in data_loader:
+                images = batch["images"].to(device)
+                with precision_autocast(precision, device):
+                    feat = backbone(images)
+                    if with_classes:
+                        # One RPN pass, shared with detect_from_features
+                        body_feats = rpn.extract_features(feat)
+                        pred_locs, _, objectness_score = rpn.predict(body_feats)
+                    else:
+                        pred_locs, _, objectness_score = rpn(feat)[:3]
+                anchors = rpn.anchor_grid(feat) if hasattr(rpn, "anchor_grid") else torch.from_numpy(
+                    generate_anchor_grid_np(feat.shape[3], feat.shape[2], ratios, anchor_scales))
+                proposals, scores, _ = decode_topk(pred_locs.float(), objectness_score.float(), anchors, max(top_ks))
+                if with_classes:
+                    detections = detect_from_features(feat, anchors, images, rpn, classifier, roi_head,
+                                                      top_k=det_top_k, precision=precision,
+                                                      rpn_outputs=(body_feats, pred_locs, objectness_score))
+
+                image_args = []
+                for i, (gt, names) in enumerate(zip(batch["boxes"], batch["names"])):
+                    if with_classes:
+                        det = detections[i]
+                        det_boxes = det["boxes"].float().cpu().numpy()
+                        det_classes = _class_ids(det["labels"], class_index)
+                        det_scores = det["scores"].float().cpu().numpy()
+                        gt_classes = _class_ids(names, class_index)
+                    else:
+                        keep = ops.nms(proposals[i], scores[i], proposal_nms)
+                        det_boxes = proposals[i][keep].cpu().numpy()
+                        det_scores = scores[i][keep].cpu().numpy()
+                        det_classes = np.zeros(len(keep), dtype=np.int64)
+                        gt_classes = np.zeros(len(gt), dtype=np.int64)
+                    image_args.append((proposals[i].cpu().numpy(), gt.numpy(), gt_classes,
+                                       det_boxes, det_classes, det_scores))
+
+                if pool is None:
+                    for args in image_args:
+                        evaluator.add_image(*args)
+                else:
+                    pending.append(pool.submit(_image_stats, config, image_args))
+                    if len(pending) >= 2 * workers:
+                        evaluator.merge(pending.pop(0).result())
+
+                seen += images.shape[0]
+                if n_images is not None and seen >= n_images:
+                    break
+        for future in pending:
+            evaluator.merge(future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return evaluator.summary()
+
+
+def print_evaluation(summary, top_ks=TOP_KS, iou_thresholds=IOU_THRESHOLDS):
+    print(f"\n[INFO] Evaluated {summary['n_images']} images with ground truth")
+    print(f"{'top-k':>6}{'mIoU':>7}" + "".join(f"{f'R@{t}':>8}{f'dens@{t}':>10}" for t in iou_thresholds))
+    for k in top_ks:
+        print(f"{k:>6}{summary[f'mean_best_iou@{k}']:>7.3f}"
+              + "".join(f"{summary[f'recall@{k}_iou{t}']:>8.3f}{summary[f'density@{k}_iou{t}']:>10.2f}"
+                        for t in iou_thresholds))
+    for t in iou_thresholds:
+        per_class = [(key.split("/", 1)[1], value) for key, value in summary.items() if key.startswith(f"AP_iou{t}/")]
+        print(f"mAP@{t}: {summary[f'mAP_iou{t}']:.3f}  " + ", ".join(f"{name} {ap:.3f}" for name, ap in per_class))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate RPN proposals and detections on the validation split")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--rpn-weights", default="final_model.pth")
+    parser.add_argument("--classifier-weights", default=None, help="per-class AP with ObjectClassifier")
+    parser.add_argument("--roi-head-weights", default=None, help="per-class AP with ROIClassifierHead")
+    parser.add_argument("--top-ks", type=int, nargs="+", default=list(TOP_KS))
+    parser.add_argument("--iou-thresholds", type=float, nargs="+", default=list(IOU_THRESHOLDS))
+    parser.add_argument("--det-top-k", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0, help="process pool size for the metric computation")
+    parser.add_argument("--n-images", type=int, default=None)
+    args = parser.parse_args()
+
+    apply_tuned_settings("infer")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    train_size = int(0.85 * len(dataset))
+    _, val_dataset = torch.utils.data.random_split(dataset, [train_size, len(dataset) - train_size],
+                                                   generator=torch.Generator().manual_seed(0))
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False,
+                                             collate_fn=custom_collate_fn,
+                                             num_workers=tuned_num_workers("infer", default=2))
+
+    backbone = build_vgg_backbone(device=device)
+    rpn = EnhancedRPNWithROI().to(device).eval()
+    rpn.load_state_dict(torch.load(args.rpn_weights, map_location=device))
+    classifier, roi_head = None, None
+    if args.roi_head_weights:
+        roi_head = ROIClassifierHead(num_classes=len(name_to_id)).to(device).eval()
+        roi_head.load_state_dict(torch.load(args.roi_head_weights, map_location=device))
+    elif args.classifier_weights:
+        classifier = ObjectClassifier(num_classes=len(name_to_id)).to(device).eval()
+        classifier.load_state_dict(torch.load(args.classifier_weights, map_location=device))
+
+    summary = evaluate_detection(backbone, rpn, val_loader, classifier, roi_head, top_ks=args.top_ks,
+                                 iou_thresholds=args.iou_thresholds, det_top_k=args.det_top_k,
+                                 workers=args.workers, n_images=args.n_images, device=device)
+    print_evaluation(summary, sorted(args.top_ks), args.iou_thresholds)
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the geometry and post-processing hot paths.
+
+Each case times one function on synthetic inputs at BDD sizes: the full
+anchor grid of an ISIZE frame (45 x 80 cells x 15 anchors = 54k anchors
+at stride 16), 5-80 GT boxes, 20-2000 proposals, batches of 8.
+
+    bbox_generation          rpn_training.bbox_generation (anchor targets)
+    compute_iou_vectorized   anchors x GT IoU
+    batch_iou_matrix         prediction x GT IoU for matching, a padded batch
+                             (replaces the per-image compute_iou_matrix of
+                             the rpn_roi_integrated.py notebook export)
+    pred_bbox_to_xywh        offset decode of every anchor
+    process_proposals        EnhancedRPNWithROI._process_proposals (2000
+                             anchors per image above conf_thresh)
+    combine_boxes            box_merging.combine_boxes
+    recursive_nms            box_merging.recursive_nms
+    cbam_forward             CBAM.forward on RPN body features
+    dataset_getitem          CustomDataset.__getitem__ on a synthetic_data frame,
+                             JPEG decode / .pt cache
+
+Results (median / min / IQR in ms over `repeat` runs) are written as JSON
+together with the environment; `compare` flags every case whose median
+is slower than the baseline by more than the tolerance and exits with
+status 1 if there is one.
+
+Usage:
+    python microbench.py run --output benchmarks/baseline.json
+    python microbench.py run --output current.json --filter iou nms
+    python microbench.py compare benchmarks/baseline.json current.json --tolerance 0.1
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from box_merging import combine_boxes, random_proposals, recursive_nms
+from rpn_models import CBAM, EnhancedRPNWithROI
+from rpn_training import bbox_generation
+from rpn_utils import (ISIZE, CustomDataset, anchor_scales, batch_iou_matrix, compute_iou_vectorized,
+                       extract_first_n_labels, generate_anchor_grid_np, pred_bbox_to_xywh, ratios)
+from synthetic_data import generate_dataset
+
+STRIDE = 16
+BATCH_SIZE = 8
+
+
+# -----------------------
+# Synthetic inputs
+# -----------------------
+
+def feature_size(stride=STRIDE):
+    return ISIZE[0] // stride, ISIZE[1] // stride
+
+
+def full_anchor_grid(stride=STRIDE):
+    Y_FM, X_FM = feature_size(stride)
+    return generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales)
+
+
+def random_gt_boxes(n_boxes, rng, image_size=ISIZE):
+    """Boxes of 10-400 x 10-300 pixels inside the frame, [x1, y1, x2, y2]."""
+    h, w = image_size
+    size = rng.uniform([10, 10], [400, 300], size=(n_boxes, 2))
+    x1y1 = rng.uniform(0, 1, size=(n_boxes, 2)) * (np.array([w, h]) - size)
+    return np.concatenate([x1y1, x1y1 + size], axis=1).astype(np.float32)
+
+
+# -----------------------
+# Cases
+# -----------------------
+
+def case_bbox_generation(n_gt):
+    rng = np.random.default_rng(0)
+    Y_FM, X_FM = feature_size()
+    images = [torch.empty(3, *ISIZE)] * BATCH_SIZE
+    targets = [{"boxes": torch.from_numpy(random_gt_boxes(n_gt, rng))} for _ in range(BATCH_SIZE)]
+    return lambda: bbox_generation(images, targets, X_FM, Y_FM)
+
+
+def case_compute_iou_vectorized(n_gt):
+    anchors = full_anchor_grid()
+    gt = random_gt_boxes(n_gt, np.random.default_rng(0))
+    return lambda: compute_iou_vectorized(anchors, gt)
+
+
+def case_batch_iou_matrix(n_pred, n_gt):
+    rng = np.random.default_rng(0)
+    preds = [random_proposals(n_pred, seed=i)[0].numpy() for i in range(BATCH_SIZE)]
+    gts = [random_gt_boxes(n_gt, rng) for _ in range(BATCH_SIZE)]
+    return lambda: batch_iou_matrix(preds, gts)
+
+
+def case_pred_bbox_to_xywh():
+    anchors = full_anchor_grid()
+    offsets = torch.randn(len(anchors), 4, generator=torch.Generator().manual_seed(0)) * 0.1
+    return lambda: pred_bbox_to_xywh(offsets, anchors)
+
+
+def case_process_proposals():
+    generator = torch.Generator().manual_seed(0)
+    Y_FM, X_FM = feature_size()
+    rpn = EnhancedRPNWithROI().eval()
+    anchors = torch.from_numpy(full_anchor_grid())
+    features = torch.rand(BATCH_SIZE, 256, Y_FM, X_FM, generator=generator)
+    offsets = torch.randn(BATCH_SIZE, len(anchors), 4, generator=generator) * 0.1
+    proposals = torch.stack([torch.from_numpy(pred_bbox_to_xywh(o, anchors)) for o in offsets])
+    # 2000 anchors per image above rpn.conf_thresh, the rest below
+    scores = torch.rand(BATCH_SIZE, len(anchors), generator=generator) * rpn.conf_thresh
+    above = torch.rand(BATCH_SIZE, len(anchors), generator=generator).argsort(dim=1)[:, :2000]
+    scores.scatter_(1, above, rpn.conf_thresh + torch.rand(BATCH_SIZE, 2000, generator=generator) * 0.5)
+
+    def run():
+        with torch.no_grad():
+            return rpn._process_proposals(features, proposals, scores)
+    return run
+
+
+def case_combine_boxes(n_boxes):
+    boxes, _ = random_proposals(n_boxes)
+    return lambda: combine_boxes(boxes.numpy())
+
+
+def case_recursive_nms(n_boxes):
+    boxes, scores = random_proposals(n_boxes)
+    return lambda: recursive_nms(boxes, scores)
+
+
+def case_cbam_forward():
+    Y_FM, X_FM = feature_size()
+    cbam = CBAM(256).eval()
+    x = torch.rand(BATCH_SIZE, 256, Y_FM, X_FM, generator=torch.Generator().manual_seed(0))
+
+    def run():
+        with torch.no_grad():
+            return cbam(x)
+    return run
+
+
+def case_dataset_getitem(cached):
+    """One full-size frame per call; without the cache the .pt file is removed first (JPEG decode + resize)."""
+    directory = tempfile.mkdtemp(prefix="microbench_")
+    pt_dir = os.path.join(directory, "pt")
+    image_dir, labels_path = generate_dataset(directory, n_images=1, boxes_per_image=10)
+    labels = extract_first_n_labels(labels_path, 1)
+    dataset = CustomDataset(image_dir, labels, pt_dir)
+    pt_path = os.path.join(pt_dir, labels[0]["name"].replace(".jpg", ".pt"))
+    dataset[0]  # write the cache
+
+    def run():
+        if not cached:
+            os.remove(pt_path)
+        return dataset[0]
+    run.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+    return run
+
+
+CASES = {
+    "bbox_generation[B=8,gt=5]": lambda: case_bbox_generation(5),
+    "bbox_generation[B=8,gt=20]": lambda: case_bbox_generation(20),
+    "bbox_generation[B=8,gt=80]": lambda: case_bbox_generation(80),
+    "compute_iou_vectorized[54k x 5]": lambda: case_compute_iou_vectorized(5),
+    "compute_iou_vectorized[54k x 80]": lambda: case_compute_iou_vectorized(80),
+    "batch_iou_matrix[B=8,20 x 5]": lambda: case_batch_iou_matrix(20, 5),
+    "batch_iou_matrix[B=8,2000 x 80]": lambda: case_batch_iou_matrix(2000, 80),
+    "pred_bbox_to_xywh[54k]": case_pred_bbox_to_xywh,
+    "process_proposals[B=8,2000 of 54k]": case_process_proposals,
+    "combine_boxes[20]": lambda: case_combine_boxes(20),
+    "combine_boxes[200]": lambda: case_combine_boxes(200),
+    "combine_boxes[2000]": lambda: case_combine_boxes(2000),
+    "recursive_nms[20]": lambda: case_recursive_nms(20),
+    "recursive_nms[200]": lambda: case_recursive_nms(200),
+    "recursive_nms[2000]": lambda: case_recursive_nms(2000),
+    "cbam_forward[B=8,256ch]": case_cbam_forward,
+    "dataset_getitem[jpeg]": lambda: case_dataset_getitem(cached=False),
+    "dataset_getitem[pt cache]": lambda: case_dataset_getitem(cached=True),
+}
+
+
+# -----------------------
+# Running / comparing
+# -----------------------
+
+def measure(fn, repeat=15, min_time=0.05):
+    """
+    Per-call ms over `repeat` runs; each run loops fn enough times to last
+    at least min_time seconds (calibrated after a warm-up call).
+    """
+    start = time.perf_counter()
+    fn()
+    single = max(time.perf_counter() - start, 1e-6)
+    number = max(1, int(min_time / single))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number * 1000.0)
+    q1, median, q3 = np.percentile(times, [25, 50, 75])
+    return {"median_ms": float(median), "min_ms": float(min(times)), "iqr_ms": float(q3 - q1),
+            "number": number, "repeat": repeat}
+
+
+def environment():
+    return {"python": platform.python_version(), "torch": torch.__version__, "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(), "isize": list(ISIZE)}
+
+
+def run_benchmarks(filters=None, repeat=15, min_time=0.05):
+    results = {}
+    for name, build in CASES.items():
+        if filters and not any(f in name for f in filters):
+            continue
+        fn = build()
+        try:
+            results[name] = measure(fn, repeat, min_time)
+        finally:
+            getattr(fn, "cleanup", lambda: None)()
+        print(f"{name:<36}{results[name]['median_ms']:>11.3f} ms  (IQR {results[name]['iqr_ms']:.3f})")
+    return {"environment": environment(), "results": results}
+
+
+def compare(baseline, current, tolerance=0.10):
+    """
+    Rows (name, baseline ms, current ms, ratio, status) for the cases in
+    `current`; status is ok / REGRESSION / faster / new (not in the baseline).
+    """
+    rows = []
+    for name in sorted(current["results"]):
+        old, new = baseline["results"].get(name), current["results"][name]
+        if old is None:
+            rows.append((name, None, new["median_ms"], None, "new"))
+            continue
+        ratio = new["median_ms"] / old["median_ms"]
+        status = "REGRESSION" if ratio > 1 + tolerance else "faster" if ratio < 1 - tolerance else "ok"
+        rows.append((name, old["median_ms"], new["median_ms"], ratio, status))
+    return rows
+
+
+def print_comparison(rows, baseline, current):
+    if baseline["environment"] != current["environment"]:
+        print("[WARNING] Environments differ:")
+        for key in baseline["environment"]:
+            if baseline["environment"][key] != current["environment"].get(key):
+                print(f"  {key}: {baseline['environment'][key]} -> {current['environment'].get(key)}")
+    print(f"\n{'case':<36}{'base ms':>10}{'now ms':>10}{'ratio':>8}  status")
+    for name, old, new, ratio, status in rows:
+        old_s = f"{old:>10.3f}" if old is not None else f"{'-':>10}"
+        new_s = f"{new:>10.3f}"
+        ratio_s = f"{ratio:>8.2f}" if ratio is not None else f"{'-':>8}"
+        print(f"{name:<36}{old_s}{new_s}{ratio_s}  {status}")
+    not_run = set(baseline["results"]) - set(current["results"])
+    if not_run:
+        print(f"[INFO] {len(not_run)} baseline case(s) not in the current run")
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(data, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks with JSON baselines")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and write a JSON result")
+    run_parser.add_argument("--output", default="benchmarks/baseline.json")
+    run_parser.add_argument("--filter", nargs="*", default=None, help="only cases containing one of these")
+    run_parser.add_argument("--repeat", type=int, default=15)
+    run_parser.add_argument("--min-time", type=float, default=0.05, help="seconds per timed run")
+    run_parser.add_argument("--threads", type=int, default=None)
+    run_parser.add_argument("--compare", default=None, help="baseline JSON to compare the new results with")
+    run_parser.add_argument("--tolerance", type=float, default=0.10)
+    compare_parser = commands.add_parser("compare", help="compare two JSON results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.10, help="allowed median slow-down (0.1 = 10%%)")
+    commands.add_parser("list", help="list the benchmark cases")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        print("\n".join(CASES))
+        sys.exit(0)
+
+    if args.command == "run":
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        current = run_benchmarks(args.filter, args.repeat, args.min_time)
+        save_json(current, args.output)
+        print(f"[INFO] Wrote {args.output}")
+        if not args.compare:
+            sys.exit(0)
+        baseline = load_json(args.compare)
+    else:
+        baseline, current = load_json(args.baseline), load_json(args.current)
+
+    rows = compare(baseline, current, args.tolerance)
+    print_comparison(rows, baseline, current)
+    regressions = [row[0] for row in rows if row[4] == "REGRESSION"]
+    if regressions:
+        print(f"[WARNING] {len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Export the detection graph to ONNX and run it with onnxruntime on CPU.
+
+One graph: backbone -> EnhancedRPN -> top-k -> anchor decode -> clip ->
+NMS (-> optional ROI crop + classifier). Decoding happens in the graph
+instead of NumPy (pred_bbox_to_xywh), and only for the top-k anchors.
+The notebook's recursive_nms is a data-dependent Python loop, so the
+graph uses standard NMS (ONNX NonMaxSuppression); crops are taken with
+RoiAlign instead of PIL crop + resize.
+
+The input size is fixed at export time (the anchor grid is a constant of
+the graph) and the batch size is 1.
+
+Usage:
+    python onnx_export.py --rpn-weights final_model.pth --out detection.onnx --check --benchmark
+"""
+
+import argparse
+import time
+
+import numpy as np
+import onnxruntime as ort
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.ops as ops
+
+from box_merging import recursive_nms
+from rpn_models import EnhancedRPNWithROI, ObjectClassifier, build_vgg_backbone
+from rpn_utils import (IMAGE_SIZE, ISIZE, CustomDataset, anchor_scales, compute_iou_vectorized, decode_boxes,
+                       extract_first_n_labels, generate_anchor_grid_np, name_to_id, pred_bbox_to_xywh, ratios)
+
+
+# -----------------------
+# Graph
+# -----------------------
+
+class DetectionGraph(nn.Module):
+    """
+    images (1, 3, H, W) in [0,1] -> boxes (K,4) [x1,y1,x2,y2], scores (K,)
+    and, with a classifier, class probabilities (K, num_classes).
+    """
+    def __init__(self, backbone, rpn, anchors, classifier=None, top_k=400, iou_threshold=0.5,
+                 max_detections=100, image_size=ISIZE):
+        super().__init__()
+        self.backbone = backbone
+        self.rpn = rpn
+        self.classifier = classifier
+        self.register_buffer("anchors", anchors.float())
+        self.top_k = min(top_k, anchors.shape[0])
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+        self.image_height, self.image_width = float(image_size[0]), float(image_size[1])
+
+    def forward(self, images):
+        feat = self.backbone(images)
+        pred_locs, _, objectness_score = self.rpn(feat)[:3]
+
+        # Decode only the top-k anchors
+        scores, topk_inds = torch.topk(objectness_score[0], self.top_k)
+        boxes = decode_boxes(pred_locs[0][topk_inds], self.anchors[topk_inds])
+        boxes = torch.stack([boxes[:, 0].clamp(min=0.0, max=self.image_width),
+                             boxes[:, 1].clamp(min=0.0, max=self.image_height),
+                             boxes[:, 2].clamp(min=0.0, max=self.image_width),
+                             boxes[:, 3].clamp(min=0.0, max=self.image_height)], dim=1)
+
+        keep = ops.nms(boxes, scores, self.iou_threshold)[:self.max_detections]
+        boxes, scores = boxes[keep], scores[keep]
+        if self.classifier is None:
+            return boxes, scores
+
+        rois = torch.cat([torch.zeros_like(boxes[:, :1]), boxes], dim=1)
+        crops = ops.roi_align(images, rois, output_size=IMAGE_SIZE, spatial_scale=1.0, sampling_ratio=2)
+        crops = (crops - 0.5) / 0.5
+        probs = F.softmax(self.classifier(crops), dim=1)
+        return boxes, scores, probs
+
+
+def build_detection_graph(rpn_weights=None, classifier_weights=None, with_classifier=False, top_k=400,
+                          iou_threshold=0.5, max_detections=100, pretrained=True):
+    backbone = build_vgg_backbone(pretrained=pretrained)
+    rpn = EnhancedRPNWithROI().eval()
+    if rpn_weights:
+        rpn.load_state_dict(torch.load(rpn_weights, map_location="cpu"))
+    classifier = None
+    if with_classifier:
+        classifier = ObjectClassifier(num_classes=len(name_to_id), pretrained=pretrained).eval()
+        if classifier_weights:
+            classifier.load_state_dict(torch.load(classifier_weights, map_location="cpu"))
+
+    with torch.no_grad():
+        feat = backbone(torch.zeros(1, 3, ISIZE[0], ISIZE[1]))
+    anchors = torch.from_numpy(generate_anchor_grid_np(feat.shape[3], feat.shape[2], ratios, anchor_scales))
+    return DetectionGraph(backbone, rpn, anchors, classifier, top_k, iou_threshold, max_detections).eval()
+
+
+# -----------------------
+# Export / run
+# -----------------------
+
+def export_onnx(graph, path, opset=17):
+    outputs = ["boxes", "scores"] + (["probs"] if graph.classifier is not None else [])
+    example = torch.rand(1, 3, ISIZE[0], ISIZE[1])
+    with torch.no_grad():
+        torch.onnx.export(graph, (example,), path, opset_version=opset, input_names=["images"],
+                          output_names=outputs, dynamic_axes={name: {0: "detections"} for name in outputs})
+    print(f"[INFO] Exported {path}")
+    return path
+
+
+def ort_session(path, num_threads=None):
+    options = ort.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def run_onnx(session, images):
+    return session.run(None, {"images": images.numpy().astype(np.float32)})
+
+
+def check_parity(graph, session, images, atol=1e-3):
+    """
+    Compare eager DetectionGraph with onnxruntime frame by frame.
+    Detections are matched by IoU (each eager box to its highest-IoU ONNX
+    box), and boxes / scores / probs are compared on the matched pairs, so
+    near-tied scores that NMS orders differently do not count as mismatches.
+    """
+    report = []
+    for image in images:
+        image = image.unsqueeze(0)
+        with torch.no_grad():
+            eager = [t.numpy() for t in graph(image)]
+        onnx_out = run_onnx(session, image)
+        matched, max_diff = 1.0, 0.0
+        if len(eager[0]) and len(onnx_out[0]):
+            iou = compute_iou_vectorized(eager[0], onnx_out[0])
+            pairs = iou.argmax(axis=1)
+            matched = float(np.mean(iou[np.arange(len(pairs)), pairs] > 0.99))
+            max_diff = max(float(np.abs(e - o[pairs]).max()) for e, o in zip(eager, onnx_out))
+        elif len(eager[0]) != len(onnx_out[0]):
+            matched = 0.0
+        report.append({"n_eager": len(eager[0]), "n_onnx": len(onnx_out[0]), "matched": matched, "max_abs_diff": max_diff})
+
+    ok = all(r["n_eager"] == r["n_onnx"] and r["matched"] == 1.0 and r["max_abs_diff"] <= atol for r in report)
+    print(f"[INFO] Parity {'OK' if ok else 'FAILED'} on {len(report)} frames: "
+          f"matched {np.mean([r['matched'] for r in report]):.3f}, "
+          f"max abs diff {max(r['max_abs_diff'] for r in report):.2e}")
+    return ok, report
+
+
+# -----------------------
+# Latency
+# -----------------------
+
+def eager_numpy_pipeline(graph, image, top_k=400, iou_threshold=0.5):
+    """The current path: eager backbone/RPN, NumPy decode, topk, recursive_nms."""
+    with torch.no_grad():
+        feat = graph.backbone(image)
+        pred_locs, _, objectness_score = graph.rpn(feat)[:3]
+        rois = pred_bbox_to_xywh(pred_locs[0], graph.anchors)
+        topk_inds = torch.topk(objectness_score[0], k=min(top_k, rois.shape[0])).indices
+        proposals = torch.from_numpy(rois[topk_inds.numpy()])
+        boxes, _ = recursive_nms(proposals, objectness_score[0][topk_inds], iou_threshold, recursion_limit=top_k)
+    return boxes
+
+
+def benchmark_onnx(graph, session, images, n_iters=5):
+    """Mean ms per image for the eager+NumPy path, the eager graph and onnxruntime."""
+    def timed(fn):
+        fn(images[:1])
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            for image in images:
+                fn(image.unsqueeze(0))
+        return (time.perf_counter() - start) / (n_iters * len(images)) * 1000.0
+
+    with torch.no_grad():
+        results = {
+            "eager_numpy_ms": timed(lambda x: eager_numpy_pipeline(graph, x, graph.top_k, graph.iou_threshold)),
+            "eager_graph_ms": timed(graph),
+            "onnxruntime_ms": timed(lambda x: run_onnx(session, x)),
+        }
+    print(f"\n{'path':<18}{'ms/img':>9}")
+    for name, ms in results.items():
+        print(f"{name[:-3]:<18}{ms:>9.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the detection pipeline to ONNX")
+    parser.add_argument("--rpn-weights", default="final_model.pth")
+    parser.add_argument("--classifier-weights", default=None)
+    parser.add_argument("--with-classifier", action="store_true")
+    parser.add_argument("--out", default="detection.onnx")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--top-k", type=int, default=400)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--max-detections", type=int, default=100)
+    parser.add_argument("--check", action="store_true", help="parity check against the eager graph")
+    parser.add_argument("--benchmark", action="store_true", help="latency: eager+NumPy vs eager graph vs onnxruntime")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-images", type=int, default=10)
+    parser.add_argument("--n-iters", type=int, default=5)
+    args = parser.parse_args()
+
+    graph = build_detection_graph(args.rpn_weights, args.classifier_weights, args.with_classifier,
+                                  args.top_k, args.iou_threshold, args.max_detections)
+    export_onnx(graph, args.out, args.opset)
+
+    if args.check or args.benchmark:
+        dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+        images = torch.stack([dataset[i]["image"] for i in range(min(args.n_images, len(dataset)))])
+        session = ort_session(args.out)
+        if args.check:
+            check_parity(graph, session, images)
+        if args.benchmark:
+            benchmark_onnx(graph, session, images, args.n_iters)
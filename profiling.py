@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Per-stage timers and an optional torch.profiler trace for training loops.
+
+    timer = StageTimer(enabled=True)
+    for batch in timer.iterate(train_dl):          # "data": DataLoader wait
+        with timer.stage("backbone"):
+            ...
+        timer.end_step()
+    timer.print_summary()                           # mean / p95 / share per stage, then reset
+
+A disabled StageTimer hands out one shared no-op context manager, so the
+instrumentation costs a method call per stage. With sync=True (CUDA) the
+device is synchronised at stage boundaries so asynchronous kernels are
+charged to the stage that launched them; leave it off on CPU. With
+annotate=True every stage is also a torch.profiler.record_function range,
+so the stages show up by name in a trace.
+
+trace_profiler() wraps torch.profiler for a window of steps
+(wait / warmup / active) and writes a Chrome trace per window to
+trace_dir, for chrome://tracing, Perfetto or TensorBoard.
+"""
+
+import contextlib
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class StageTimer:
+    """
+    Wall-clock time per named stage, accumulated per step. summary()
+    covers the steps since the last reset (normally one epoch).
+    """
+    def __init__(self, enabled=True, sync=False, annotate=False):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.annotate = annotate
+        self.reset()
+
+    def reset(self):
+        self._steps = defaultdict(list)   # stage -> seconds per step
+        self._current = defaultdict(float)
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name) if self.annotate else _NULL_CONTEXT:
+                yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self._current[name] += time.perf_counter() - start
+
+    def iterate(self, iterable, name="data"):
+        """Yield from iterable, timing each next() as stage `name`."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._current[name] += time.perf_counter() - start
+            yield item
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        for name, seconds in self._current.items():
+            self._steps[name].append(seconds)
+        self._current = defaultdict(float)
+
+    def summary(self):
+        """{stage: {"mean_ms", "p95_ms", "total_s", "share"}} over the recorded steps."""
+        totals = {name: sum(times) for name, times in self._steps.items()}
+        grand_total = sum(totals.values()) or 1.0
+        return {name: {"mean_ms": float(np.mean(times)) * 1000.0,
+                       "p95_ms": float(np.percentile(times, 95)) * 1000.0,
+                       "total_s": totals[name],
+                       "share": totals[name] / grand_total}
+                for name, times in self._steps.items()}
+
+    def print_summary(self, reset=True):
+        summary = self.summary()
+        if summary:
+            print(f"{'stage':<14}{'mean ms':>9}{'p95 ms':>9}{'share':>8}")
+            for name, s in sorted(summary.items(), key=lambda item: -item[1]["total_s"]):
+                print(f"{name:<14}{s['mean_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['share']:>8.1%}")
+        if reset:
+            self.reset()
+        return summary
+
+
+# Shared disabled timer, the default of instrumented functions
+NULL_TIMER = StageTimer(enabled=False)
+
+
+def trace_profiler(trace_dir=None, wait=5, warmup=2, active=5, record_shapes=True, profile_memory=False):
+    """
+    torch.profiler.profile over steps [wait + warmup, wait + warmup + active)
+    (call .step() once per training step), writing a Chrome trace to
+    trace_dir. Without trace_dir a no-op object with a step() method.
+    """
+    if trace_dir is None:
+        return _NullProfiler()
+    os.makedirs(trace_dir, exist_ok=True)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def write_trace(prof):
+        path = os.path.join(trace_dir, f"trace_step{prof.step_num}.json")
+        prof.export_chrome_trace(path)
+        print(f"[INFO] Wrote profiler trace {path}")
+        print(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                                  on_trace_ready=write_trace, record_shapes=record_shapes,
+                                  profile_memory=profile_memory)
+
+
+class _NullProfiler:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def step(self):
+        pass
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Latency of EnhancedRPNWithROI proposal processing at several batch sizes.
+
+Compares the old per-image loop (mask, ops.nms, torch.cat, roi_pool per
+image) with the batched path (one offset NMS, per-image top_n in tensor
+ops, one roi_pool call), and the RPN forward with and without ROI pooling.
+Both paths are checked to keep the same ROIs with the same pooled
+features, compared in ROI order (ops.nms leaves the order of equal-score
+boxes unspecified).
+
+Usage:
+    python proposal_bench.py --batch-sizes 1 8 32 --rpn-weights final_model.pth
+"""
+
+import argparse
+import time
+
+import torch
+import torchvision.ops as ops
+
+from rpn_models import EnhancedRPNWithROI
+from rpn_utils import ISIZE, anchor_scales, generate_anchor_grid_np, ratios
+
+
+def loop_process_proposals(rpn, conv_features, proposals, scores):
+    """
+    Reference: the previous per-image EnhancedRPNWithROI._process_proposals.
+    Returns (rois, pooled features).
+    """
+    pooled_list, roi_list = [], []
+    for b_idx in range(conv_features.size(0)):
+        conf_mask = scores[b_idx] > rpn.conf_thresh
+        filtered_boxes = proposals[b_idx][conf_mask]
+        filtered_scores = scores[b_idx][conf_mask]
+        if filtered_boxes.size(0) == 0:
+            continue
+        keep_idx = ops.nms(filtered_boxes, filtered_scores, rpn.nms_thresh)[:rpn.top_n]
+        final_boxes = filtered_boxes[keep_idx]
+        roi_input = torch.cat([
+            torch.full((final_boxes.size(0), 1), b_idx, device=conv_features.device, dtype=torch.float32),
+            final_boxes
+        ], dim=1)
+        pooled_list.append(rpn.roi_pool(conv_features, roi_input))
+        roi_list.append(roi_input)
+    if not pooled_list:
+        return (conv_features.new_zeros((0, 5)),
+                conv_features.new_zeros((0, conv_features.shape[1]) + tuple(rpn.roi_pool.output_size)))
+    return torch.cat(roi_list, dim=0), torch.cat(pooled_list, dim=0)
+
+
+def _roi_order(rois):
+    """Row order sorting rois by (batch_idx, x1, y1, x2, y2)."""
+    order = torch.arange(rois.shape[0], device=rois.device)
+    for col in reversed(range(rois.shape[1])):
+        order = order[torch.sort(rois[order, col], stable=True).indices]
+    return order
+
+
+def same_proposals(rois_a, pooled_a, rois_b, pooled_b):
+    """True if both paths kept the same ROIs with the same pooled features, in any row order."""
+    if rois_a.shape != rois_b.shape or pooled_a.shape != pooled_b.shape:
+        return False
+    order_a, order_b = _roi_order(rois_a), _roi_order(rois_b)
+    return torch.equal(rois_a[order_a], rois_b[order_b]) and torch.allclose(pooled_a[order_a], pooled_b[order_b])
+
+
+def _time(fn, n_iters):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return (time.perf_counter() - start) / n_iters * 1000.0
+
+
+def benchmark_proposals(rpn, batch_sizes=(1, 8, 32), n_iters=5, in_channels=512, stride=16):
+    """ms per batch for each stage; inputs are random backbone-sized feature maps."""
+    Y_FM, X_FM = ISIZE[0] // stride, ISIZE[1] // stride
+    anchors = torch.from_numpy(generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales))
+    device = next(rpn.parameters()).device
+    results = []
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            feat = torch.rand(batch_size, in_channels, Y_FM, X_FM, device=device)
+            body = rpn.extract_features(feat)
+            pred_locs, _, objectness_score = rpn.predict(body)
+            proposals = rpn._generate_proposals(pred_locs, anchors)
+
+            loop_rois, loop_out = loop_process_proposals(rpn, body, proposals, objectness_score)
+            batched_rois = rpn.select_proposals(proposals, objectness_score)
+            batched_out = rpn.roi_pool(body, batched_rois)
+            results.append({
+                "batch_size": batch_size,
+                "n_rois": batched_out.shape[0],
+                "match": same_proposals(loop_rois, loop_out, batched_rois, batched_out),
+                "loop_ms": _time(lambda: loop_process_proposals(rpn, body, proposals, objectness_score), n_iters),
+                "batched_ms": _time(lambda: rpn._process_proposals(body, proposals, objectness_score), n_iters),
+                "forward_ms": _time(lambda: rpn(feat, anchors), n_iters),
+                "forward_roi_ms": _time(lambda: rpn(feat, anchors, do_roi=True), n_iters),
+            })
+    return results
+
+
+def print_proposal_benchmark(results):
+    print(f"\n{'batch':>6}{'rois':>7}{'loop ms':>10}{'batched ms':>12}{'speedup':>9}"
+          f"{'fwd ms':>9}{'fwd+roi ms':>12}{'match':>7}")
+    for r in results:
+        print(f"{r['batch_size']:>6}{r['n_rois']:>7}{r['loop_ms']:>10.1f}{r['batched_ms']:>12.1f}"
+              f"{r['loop_ms'] / r['batched_ms']:>8.1f}x{r['forward_ms']:>9.1f}{r['forward_roi_ms']:>12.1f}"
+              f"{str(r['match']):>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched proposal processing")
+    parser.add_argument("--rpn-weights", default=None)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--n-iters", type=int, default=5)
+    parser.add_argument("--conf-thresh", type=float, default=0.5)
+    parser.add_argument("--top-n", type=int, default=400)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    rpn = EnhancedRPNWithROI(conf_thresh=args.conf_thresh, top_n=args.top_n).to(device).eval()
+    if args.rpn_weights:
+        rpn.load_state_dict(torch.load(args.rpn_weights, map_location=device))
+    print_proposal_benchmark(benchmark_proposals(rpn, args.batch_sizes, args.n_iters))
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Structured channel pruning for the RPN heads.
+
+Channels are pruned per group, a group being every tensor dimension that
+has to shrink together:
+    EnhancedRPN(WithROI): conv1 out (+cbam1, conv2 in), conv2 out (+cbam2,
+        conv3 in), conv3/skip_conv out (+reg/cls in)
+    RPNWithROI / CompactRPN: conv1 out (+reg/cls in)
+Channels are scored by filter L1 norm ("l1") or by first-order Taylor
+saliency |sum(activation * gradient)| of the RPN loss ("taylor", no BN
+needed), removed physically (the pruned model is a narrower model of the
+same class) and the result is fine-tuned with rpn_training.train_epochs.
+
+Note that pruning the last EnhancedRPNWithROI group narrows the body
+features, so an ROIClassifierHead has to be rebuilt with the new width.
+
+Usage (latency / recall Pareto table):
+    python pruning.py --rpn-weights final_model.pth --ratios 0 0.25 0.5 0.75 --finetune-epochs 2
+"""
+
+import argparse
+import copy
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from rpn_models import CBAM, CompactRPN, EnhancedRPN, EnhancedRPNWithROI, RPNWithROI, build_vgg_backbone
+from rpn_training import bbox_generation, evaluate_rpn, rpn_loss, train_epochs
+from rpn_utils import ISIZE, CustomDataset, custom_collate_fn, extract_first_n_labels, measure_latency
+
+ENHANCED_GROUPS = {
+    "conv1": {"out": ["conv1"], "attention": "cbam1", "in": ["conv2"]},
+    "conv2": {"out": ["conv2"], "attention": "cbam2", "in": ["conv3"]},
+    "conv3": {"out": ["conv3", "skip_conv"], "attention": None, "in": ["reg_layer", "cls_layer"]},
+}
+RPN_ROI_GROUPS = {
+    "conv1": {"out": ["conv1"], "attention": None, "in": ["reg_layer", "cls_layer"]},
+}
+
+
+def channel_groups(rpn):
+    if isinstance(rpn, (EnhancedRPN, EnhancedRPNWithROI)):
+        return ENHANCED_GROUPS
+    if isinstance(rpn, (RPNWithROI, CompactRPN)):
+        return RPN_ROI_GROUPS
+    raise TypeError(f"No channel groups defined for {type(rpn).__name__}")
+
+
+def group_widths(rpn):
+    """{group: number of channels}, e.g. to save next to a pruned state_dict."""
+    return {name: getattr(rpn, g["out"][0]).out_channels for name, g in channel_groups(rpn).items()}
+
+
+# -----------------------
+# Channel scores
+# -----------------------
+
+def l1_scores(rpn):
+    """Filter L1 norm per output channel, each conv normalised by its mean."""
+    scores = {}
+    for name, g in channel_groups(rpn).items():
+        total = 0
+        for conv_name in g["out"]:
+            w = getattr(rpn, conv_name).weight.detach()
+            norms = w.abs().sum(dim=(1, 2, 3))
+            total = total + norms / (norms.mean() + 1e-12)
+        scores[name] = total
+    return scores
+
+
+def taylor_scores(backbone, rpn, data_loader, n_batches=4, rpn_lambda=10, device=None):
+    """
+    First-order Taylor saliency |sum_{h,w} a * dL/da| of each output channel,
+    averaged over images, using the RPN training loss.
+    """
+    if device is None:
+        device = next(rpn.parameters()).device
+    groups = channel_groups(rpn)
+    acts = {}
+    hooks = []
+    for name, g in groups.items():
+        for conv_name in g["out"]:
+            def hook(module, inputs, output, key=(name, conv_name)):
+                output.retain_grad()
+                acts[key] = output
+            hooks.append(getattr(rpn, conv_name).register_forward_hook(hook))
+
+    scores = {name: 0 for name in groups}
+    was_training = rpn.training
+    rpn.train()
+    for batch_idx, batch in enumerate(data_loader):
+        if batch_idx >= n_batches:
+            break
+        images = batch["images"].to(device)
+        targets = [{"boxes": b, "labels": l} for b, l in zip(batch["boxes"], batch["labels"])]
+        with torch.no_grad():
+            feat = backbone(images)
+        gt_locs_np, gt_scores_np, _ = bbox_generation([img for img in images], targets, feat.shape[3], feat.shape[2])
+        pred_locs, pred_scores, _ = rpn(feat)[:3]
+        loss, _, _ = rpn_loss(pred_locs, pred_scores, torch.from_numpy(gt_locs_np).to(device),
+                              torch.from_numpy(gt_scores_np.astype(np.float32)).to(device), rpn_lambda)
+        rpn.zero_grad()
+        loss.backward()
+        for (name, _), a in acts.items():
+            scores[name] = scores[name] + (a * a.grad).sum(dim=(2, 3)).abs().mean(dim=0).detach()
+    for h in hooks:
+        h.remove()
+    rpn.zero_grad()
+    rpn.train(was_training)
+    return scores
+
+
+# -----------------------
+# Surgery
+# -----------------------
+
+def _copy_conv(conv, weight, bias):
+    new = nn.Conv2d(weight.shape[1], weight.shape[0], conv.kernel_size, stride=conv.stride,
+                    padding=conv.padding, bias=bias is not None).to(weight.device)
+    new.weight.data.copy_(weight)
+    new.weight.requires_grad = conv.weight.requires_grad
+    if bias is not None:
+        new.bias.data.copy_(bias)
+        new.bias.requires_grad = conv.bias.requires_grad
+    return new
+
+
+def _prune_out(conv, keep):
+    bias = conv.bias.data[keep] if conv.bias is not None else None
+    return _copy_conv(conv, conv.weight.data[keep], bias)
+
+
+def _prune_in(conv, keep):
+    bias = conv.bias.data if conv.bias is not None else None
+    return _copy_conv(conv, conv.weight.data[:, keep], bias)
+
+
+def _prune_attention(att, keep):
+    """Only CBAM (and FusedCBAM) carry per-channel weights; ECA / none are width-agnostic."""
+    if not isinstance(att, CBAM):
+        return
+    fc_in, fc_out = att.fc[0], att.fc[2]
+    new_in = nn.Linear(len(keep), fc_in.out_features, bias=False).to(fc_in.weight.device)
+    new_in.weight.data.copy_(fc_in.weight.data[:, keep])
+    new_out = nn.Linear(fc_out.in_features, len(keep), bias=False).to(fc_out.weight.device)
+    new_out.weight.data.copy_(fc_out.weight.data[keep])
+    att.fc[0], att.fc[2] = new_in, new_out
+
+
+def prune_rpn(rpn, keep_indices):
+    """
+    Physically remove channels. keep_indices: {group: LongTensor of kept
+    channels}. Returns a pruned deep copy.
+    """
+    rpn = copy.deepcopy(rpn)
+    for name, keep in keep_indices.items():
+        g = channel_groups(rpn)[name]
+        keep = torch.as_tensor(keep, dtype=torch.long)
+        for conv_name in g["out"]:
+            setattr(rpn, conv_name, _prune_out(getattr(rpn, conv_name), keep))
+        if g["attention"]:
+            _prune_attention(getattr(rpn, g["attention"]), keep)
+        for conv_name in g["in"]:
+            setattr(rpn, conv_name, _prune_in(getattr(rpn, conv_name), keep))
+    return rpn
+
+
+def prune_by_ratio(rpn, scores, ratio):
+    """Drop the `ratio` lowest-scoring channels of every group."""
+    keep_indices = {}
+    for name, s in scores.items():
+        n_keep = max(1, int(round(len(s) * (1.0 - ratio))))
+        keep_indices[name] = torch.sort(torch.topk(s, n_keep).indices).values.cpu()
+    return prune_rpn(rpn, keep_indices)
+
+
+def save_pruned_rpn(rpn, path):
+    torch.save({"widths": group_widths(rpn), "state_dict": rpn.state_dict()}, path)
+
+
+def load_pruned_rpn(path, rpn, map_location="cpu"):
+    """Shrink a freshly built rpn to the saved widths, then load the weights."""
+    ckpt = torch.load(path, map_location=map_location)
+    rpn = prune_rpn(rpn, {name: torch.arange(n) for name, n in ckpt["widths"].items()})
+    rpn.load_state_dict(ckpt["state_dict"])
+    return rpn
+
+
+# -----------------------
+# Pareto sweep
+# -----------------------
+
+def pareto_sweep(backbone, rpn, train_dl, val_dl, ratios=(0.0, 0.25, 0.5, 0.75), method="l1",
+                 finetune_epochs=2, lr=1e-4, top_k=20, n_iters=5, device=None):
+    """
+    Prune rpn at each ratio, fine-tune, and measure RPN latency (ms per
+    image on a full-size feature map), parameter count and recall@top_k.
+    """
+    if device is None:
+        device = next(rpn.parameters()).device
+    if method == "taylor":
+        scores = taylor_scores(backbone, rpn, train_dl, device=device)
+    else:
+        scores = l1_scores(rpn)
+
+    with torch.no_grad():
+        feat = backbone(torch.zeros(1, 3, ISIZE[0], ISIZE[1], device=device))
+
+    results = []
+    for ratio in ratios:
+        pruned = prune_by_ratio(rpn, scores, ratio) if ratio > 0 else copy.deepcopy(rpn)
+        if ratio > 0 and finetune_epochs > 0:
+            optimizer = torch.optim.Adam([p for p in pruned.parameters() if p.requires_grad], lr=lr,
+                                         weight_decay=1e-4)
+            pruned, _ = train_epochs(backbone, pruned, optimizer, train_dl, epochs=finetune_epochs,
+                                     top_k=top_k, device=device, save_every=0)
+        pruned.eval()
+        metrics = evaluate_rpn(backbone, pruned, val_dl, top_k=top_k, device=device)
+        results.append({
+            "ratio": ratio,
+            "widths": group_widths(pruned),
+            "params": sum(p.numel() for p in pruned.parameters()),
+            "rpn_ms": measure_latency(pruned, feat, n_iters=n_iters),
+            "recall": metrics["recall"],
+            "mean_best_iou": metrics["mean_best_iou"],
+            "model": pruned,
+        })
+
+    # A row is Pareto-optimal if no other row is at least as fast and as accurate, and better in one
+    for r in results:
+        r["pareto"] = not any(o["rpn_ms"] <= r["rpn_ms"] and o["recall"] >= r["recall"]
+                              and (o["rpn_ms"] < r["rpn_ms"] or o["recall"] > r["recall"])
+                              for o in results if o is not r)
+    return results
+
+
+def print_pareto(results, top_k=20):
+    print(f"\n{'ratio':>6}{'widths':>18}{'params':>10}{'rpn ms':>9}{f'R@{top_k}':>8}{'mIoU':>7}{'pareto':>8}")
+    for r in results:
+        widths = "/".join(str(w) for w in r["widths"].values())
+        print(f"{r['ratio']:>6.2f}{widths:>18}{r['params']:>10}{r['rpn_ms']:>9.1f}{r['recall']:>8.3f}"
+              f"{r['mean_best_iou']:>7.3f}{'*' if r['pareto'] else '':>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune RPN channels and report a latency/recall Pareto table")
+    parser.add_argument("--model", choices=["enhanced", "rpn_roi"], default="enhanced")
+    parser.add_argument("--rpn-weights", default="final_model.pth")
+    parser.add_argument("--method", choices=["l1", "taylor"], default="l1")
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.0, 0.25, 0.5, 0.75])
+    parser.add_argument("--finetune-epochs", type=int, default=2)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-train", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--save-dir", default=None, help="write pruned_<ratio>.pth for each ratio")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    train_size = int(0.85 * len(dataset))
+    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, len(dataset) - train_size],
+                                                               generator=torch.Generator().manual_seed(0))
+    train_dataset = torch.utils.data.Subset(train_dataset, list(range(min(args.n_train, len(train_dataset)))))
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
+                                               collate_fn=custom_collate_fn, num_workers=2)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False,
+                                             collate_fn=custom_collate_fn, num_workers=2)
+
+    backbone = build_vgg_backbone(device=device)
+    rpn = (EnhancedRPNWithROI() if args.model == "enhanced" else RPNWithROI(n_anchor=15)).to(device)
+    rpn.load_state_dict(torch.load(args.rpn_weights, map_location=device))
+
+    results = pareto_sweep(backbone, rpn, train_loader, val_loader, ratios=args.ratios, method=args.method,
+                           finetune_epochs=args.finetune_epochs, lr=args.lr, top_k=args.top_k, device=device)
+    print_pareto(results, top_k=args.top_k)
+    if args.save_dir:
+        os.makedirs(args.save_dir, exist_ok=True)
+        for r in results:
+            save_pruned_rpn(r["model"], os.path.join(args.save_dir, f"pruned_{r['ratio']:.2f}.pth"))
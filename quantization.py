@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""Post-training static int8 quantization of the detection pipeline for CPU.
+
+Each stage (VGG16 backbone, RPN head, ResNet18 classifier) is prepared with
+FX graph mode, calibrated on a few hundred BDD frames and converted on its
+own. The comparison report lists latency, model size and proposal recall /
+classifier accuracy for fp32 vs int8 per stage, so each stage can be kept in
+the precision that pays off.
+
+Usage:
+    python quantization.py --image-dir trainA_original_700 \
+        --labels-json bdd100k_labels_images_train.json \
+        --rpn-weights final_model.pth --classifier-weights classification_3_2000_60.pth
+"""
+
+import argparse
+import copy
+import io
+import json
+import os
+
+import torch
+import torch.nn as nn
+import torchvision.transforms.functional as TF
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from rpn_models import EnhancedRPNWithROI, ObjectClassifier, build_vgg_backbone
+from rpn_utils import (IMAGE_SIZE, PATCH_MEAN, PATCH_STD, CustomDataset, anchor_scales,
+                       compute_recall_at_threshold, custom_collate_fn, extract_first_n_labels,
+                       generate_anchor_grid_np, measure_latency, name_to_id, ratios, topk_proposals)
+
+STAGES = ("backbone", "rpn", "classifier")
+
+
+# -----------------------
+# Stage wrappers
+# -----------------------
+
+class RPNHead(nn.Module):
+    """
+    Exposes only the convolutional RPN outputs (locs, scores, objectness) so
+    the head traces without the anchors/do_roi control flow.
+    """
+    def __init__(self, rpn):
+        super().__init__()
+        self.rpn = rpn
+
+    def forward(self, x):
+        pred_locs, pred_scores, objectness_score = self.rpn(x)[:3]
+        return pred_locs, pred_scores, objectness_score
+
+
+class QuantizedPipeline(nn.Module):
+    """
+    backbone -> RPN head -> top-k proposals -> crop classifier.
+    Each stage can independently be the fp32 module or its int8 conversion.
+    """
+    def __init__(self, backbone, rpn, classifier=None):
+        super().__init__()
+        self.backbone = backbone
+        self.rpn = rpn
+        self.classifier = classifier
+
+    @torch.no_grad()
+    def proposals(self, images, anchors, top_k=400):
+        feat = self.backbone(images)
+        pred_locs, _, objectness_score = self.rpn(feat)
+        return [torch.from_numpy(p) for p in topk_proposals(pred_locs, objectness_score, anchors, top_k)]
+
+    @torch.no_grad()
+    def classify(self, crops):
+        return self.classifier(crops).argmax(dim=1)
+
+
+# -----------------------
+# Prepare / calibrate / convert
+# -----------------------
+
+def quantize_stage(model, example_inputs, calib_inputs, backend="x86"):
+    """
+    Static int8 quantization of one stage.
+    calib_inputs: iterable of input tensors fed through the observers.
+    Returns the converted (int8) copy; `model` is left untouched.
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+    with torch.no_grad():
+        for x in calib_inputs:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def gt_crops(images, boxes, names):
+    """
+    Crop GT boxes out of (B, C, H, W) images in [0,1] and prepare them the
+    way the classifier was trained (resize to IMAGE_SIZE, mean/std 0.5).
+    Returns (crops, labels); objects with unknown category are skipped.
+    """
+    crops, labels = [], []
+    H, W = images.shape[2], images.shape[3]
+    for img, img_boxes, img_names in zip(images, boxes, names):
+        for box, name in zip(img_boxes.tolist(), img_names):
+            if name not in name_to_id:
+                continue
+            x1, y1 = max(0, int(box[0])), max(0, int(box[1]))
+            x2, y2 = min(W, int(box[2])), min(H, int(box[3]))
+            if x1 >= x2 or y1 >= y2:
+                continue
+            patch = TF.resized_crop(img, y1, x1, y2 - y1, x2 - x1, list(IMAGE_SIZE), antialias=True)
+            crops.append(TF.normalize(patch, PATCH_MEAN, PATCH_STD))
+            labels.append(name_to_id[name])
+    if not crops:
+        return torch.zeros((0, 3, *IMAGE_SIZE)), torch.zeros((0,), dtype=torch.long)
+    return torch.stack(crops), torch.tensor(labels, dtype=torch.long)
+
+
+def quantize_pipeline(backbone, rpn, classifier, calib_loader, n_calib=300, backend="x86"):
+    """
+    Calibrate and convert every stage on up to `n_calib` frames.
+    The RPN is calibrated on fp32 backbone features and the classifier on
+    GT crops of the same frames, so each stage is quantized in isolation.
+    """
+    backbone, classifier = backbone.cpu().eval(), classifier.cpu().eval()
+    rpn_head = RPNHead(rpn.cpu().eval())
+
+    images_calib, feats_calib, crops_calib = [], [], []
+    seen = 0
+    with torch.no_grad():
+        for batch in calib_loader:
+            images = batch["images"]
+            images_calib.append(images)
+            feats_calib.append(backbone(images))
+            crops, _ = gt_crops(images, batch["boxes"], batch["names"])
+            if len(crops) > 0:
+                crops_calib.append(crops)
+            seen += images.shape[0]
+            if seen >= n_calib:
+                break
+    if not crops_calib:
+        raise ValueError("No labelled objects found in the calibration frames")
+
+    print(f"[INFO] calibrating on {seen} frames, {sum(len(c) for c in crops_calib)} crops")
+    return QuantizedPipeline(
+        backbone=quantize_stage(backbone, (images_calib[0],), images_calib, backend),
+        rpn=quantize_stage(rpn_head, (feats_calib[0],), feats_calib, backend),
+        classifier=quantize_stage(classifier, (crops_calib[0],), crops_calib, backend),
+    )
+
+
+def save_quantized_pipeline(pipeline, example_images, out_dir):
+    """TorchScript each int8 stage to <out_dir>/<stage>_int8.pt."""
+    os.makedirs(out_dir, exist_ok=True)
+    with torch.no_grad():
+        feat = pipeline.backbone(example_images)
+        crops = torch.zeros((1, 3, *IMAGE_SIZE))
+        for name, module, example in [("backbone", pipeline.backbone, example_images),
+                                      ("rpn", pipeline.rpn, feat),
+                                      ("classifier", pipeline.classifier, crops)]:
+            traced = torch.jit.trace(module, example, check_trace=False)
+            torch.jit.save(traced, os.path.join(out_dir, f"{name}_int8.pt"))
+
+
+def load_quantized_pipeline(out_dir, stages=STAGES, fp32_pipeline=None):
+    """
+    Rebuild a pipeline from saved int8 stages. Stages not listed in
+    `stages` are taken from `fp32_pipeline` (per-stage precision choice).
+    """
+    modules = {}
+    for name in STAGES:
+        if name in stages:
+            modules[name] = torch.jit.load(os.path.join(out_dir, f"{name}_int8.pt"))
+        else:
+            modules[name] = getattr(fp32_pipeline, name)
+    return QuantizedPipeline(**modules)
+
+
+# -----------------------
+# fp32 vs int8 report
+# -----------------------
+
+def model_size_mb(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 1e6
+
+
+def _proposal_recall(pipeline, eval_batches, anchors, top_k, iou_thresh):
+    recalls = []
+    for images, boxes in eval_batches:
+        for props, gt in zip(pipeline.proposals(images, anchors, top_k), boxes):
+            if len(gt) > 0:
+                recalls.append(compute_recall_at_threshold(props.numpy(), gt.numpy(), iou_thresh))
+    return sum(recalls) / len(recalls) if recalls else 0.0
+
+
+def _classifier_accuracy(pipeline, crop_batches):
+    correct, total = 0, 0
+    for crops, labels in crop_batches:
+        correct += (pipeline.classify(crops) == labels).sum().item()
+        total += len(labels)
+    return correct / total if total else 0.0
+
+
+def compare_stages(fp32, int8, eval_loader, n_eval=100, top_k=400, iou_thresh=0.5, n_iters=10):
+    """
+    Per-stage fp32 vs int8 comparison. Recall for a stage is measured with
+    only that stage swapped to int8; the "pipeline" row swaps all of them.
+    """
+    eval_batches, crop_batches = [], []
+    seen = 0
+    for batch in eval_loader:
+        eval_batches.append((batch["images"], batch["boxes"]))
+        crops, labels = gt_crops(batch["images"], batch["boxes"], batch["names"])
+        if len(crops) > 0:
+            crop_batches.append((crops, labels))
+        seen += batch["images"].shape[0]
+        if seen >= n_eval:
+            break
+
+    example_images = eval_batches[0][0]
+    with torch.no_grad():
+        example_feat = fp32.backbone(example_images)
+    Y_FM, X_FM = example_feat.shape[2], example_feat.shape[3]
+    anchors = torch.from_numpy(generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales))
+    example_crops = crop_batches[0][0] if crop_batches else torch.zeros((1, 3, *IMAGE_SIZE))
+    examples = {"backbone": example_images, "rpn": example_feat, "classifier": example_crops}
+
+    def recall_of(**swap):
+        pipeline = QuantizedPipeline(
+            backbone=int8.backbone if swap.get("backbone") else fp32.backbone,
+            rpn=int8.rpn if swap.get("rpn") else fp32.rpn)
+        return _proposal_recall(pipeline, eval_batches, anchors, top_k, iou_thresh)
+
+    recall_fp32 = recall_of()
+    report = {"top_k": top_k, "iou_thresh": iou_thresh, "n_eval": seen, "stages": {}}
+    for name in STAGES:
+        fp32_module, int8_module = getattr(fp32, name), getattr(int8, name)
+        if name == "classifier":
+            metric = "accuracy"
+            metric_fp32 = _classifier_accuracy(fp32, crop_batches)
+            metric_int8 = _classifier_accuracy(int8, crop_batches)
+        else:
+            metric = f"recall@{top_k}"
+            metric_fp32, metric_int8 = recall_fp32, recall_of(**{name: True})
+        report["stages"][name] = {
+            "metric": metric,
+            "metric_fp32": metric_fp32,
+            "metric_int8": metric_int8,
+            "latency_ms_fp32": measure_latency(fp32_module, examples[name], n_iters=n_iters),
+            "latency_ms_int8": measure_latency(int8_module, examples[name], n_iters=n_iters),
+            "size_mb_fp32": model_size_mb(fp32_module),
+            "size_mb_int8": model_size_mb(int8_module),
+        }
+    report["stages"]["pipeline"] = {
+        "metric": f"recall@{top_k}",
+        "metric_fp32": recall_fp32,
+        "metric_int8": recall_of(backbone=True, rpn=True),
+    }
+    return report
+
+
+def print_report(report):
+    print(f"\nint8 vs fp32 ({report['n_eval']} frames, IoU >= {report['iou_thresh']})")
+    print(f"{'stage':<11}{'metric':<12}{'fp32':>8}{'int8':>8}"
+          f"{'ms fp32':>10}{'ms int8':>10}{'MB fp32':>10}{'MB int8':>10}")
+    for name, row in report["stages"].items():
+        line = f"{name:<11}{row['metric']:<12}{row['metric_fp32']:>8.3f}{row['metric_int8']:>8.3f}"
+        if "latency_ms_fp32" in row:
+            line += (f"{row['latency_ms_fp32']:>10.1f}{row['latency_ms_int8']:>10.1f}"
+                     f"{row['size_mb_fp32']:>10.1f}{row['size_mb_int8']:>10.1f}")
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-labels", type=int, default=20000)
+    parser.add_argument("--rpn-weights", default="final_model.pth")
+    parser.add_argument("--classifier-weights", default="classification_3_2000_60.pth")
+    parser.add_argument("--n-calib", type=int, default=300)
+    parser.add_argument("--n-eval", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--top-k", type=int, default=400)
+    parser.add_argument("--backend", default="x86", choices=["x86", "fbgemm", "qnnpack"])
+    parser.add_argument("--out-dir", default="quantized")
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, args.n_labels), args.pt_dir)
+    calib_size = min(args.n_calib, len(dataset) // 2)
+    calib_set = torch.utils.data.Subset(dataset, range(calib_size))
+    eval_set = torch.utils.data.Subset(dataset, range(calib_size, min(len(dataset), calib_size + args.n_eval)))
+    calib_loader = torch.utils.data.DataLoader(calib_set, batch_size=args.batch_size, shuffle=False, collate_fn=custom_collate_fn)
+    eval_loader = torch.utils.data.DataLoader(eval_set, batch_size=args.batch_size, shuffle=False, collate_fn=custom_collate_fn)
+
+    backbone = build_vgg_backbone(device=device)
+    rpn = EnhancedRPNWithROI()
+    rpn.load_state_dict(torch.load(args.rpn_weights, map_location=device))
+    classifier = ObjectClassifier(num_classes=len(name_to_id))
+    classifier.load_state_dict(torch.load(args.classifier_weights, map_location=device))
+
+    fp32 = QuantizedPipeline(backbone, RPNHead(rpn.eval()), classifier.eval())
+    int8 = quantize_pipeline(backbone, rpn, classifier, calib_loader, n_calib=args.n_calib, backend=args.backend)
+
+    report = compare_stages(fp32, int8, eval_loader, n_eval=args.n_eval, top_k=args.top_k)
+    print_report(report)
+
+    save_quantized_pipeline(int8, next(iter(eval_loader))["images"], args.out_dir)
+    with open(os.path.join(args.out_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] saved int8 stages and report to {args.out_dir}/")
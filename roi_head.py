@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Training path for ROIClassifierHead.
+
+The backbone and RPN stay frozen. Per image, the top-k RPN proposals plus
+the GT boxes are labelled by IoU against GT (class of the best GT at
+IoU >= fg_iou, background below bg_iou, ignored in between), a fixed
+number is sampled, ROI-pooled from the RPN body features and classified.
+
+Usage:
+    python roi_head.py --rpn-weights final_model.pth --epochs 10
+"""
+
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torchvision.ops import box_iou
+
+from rpn_models import EnhancedRPNWithROI, ROIClassifierHead, build_vgg_backbone
+from rpn_utils import (CustomDataset, anchor_scales, custom_collate_fn, extract_first_n_labels,
+                       generate_anchor_grid_np, name_to_id, ratios, topk_proposals)
+
+
+def gt_class_ids(names):
+    """Map category names to class ids; unknown categories get -1."""
+    return torch.tensor([name_to_id.get(n, -1) for n in names], dtype=torch.long)
+
+
+def assign_roi_labels(proposals, gt_boxes, gt_labels, background_label, fg_iou=0.5, bg_iou=0.3):
+    """
+    Label proposals (K,4) against GT (M,4): GT class at IoU >= fg_iou,
+    background_label below bg_iou (or when there is no GT), -1 (ignore) otherwise.
+    With background_label=None, background proposals are ignored too.
+    """
+    labels = torch.full((len(proposals),), -1, dtype=torch.long)
+    if len(gt_boxes) == 0:
+        if background_label is not None:
+            labels[:] = background_label
+        return labels
+    max_ious, argmax = box_iou(proposals, gt_boxes).max(dim=1)
+    fg = max_ious >= fg_iou
+    labels[fg] = gt_labels[argmax[fg]]
+    if background_label is not None:
+        labels[max_ious < bg_iou] = background_label
+    return labels
+
+
+def sample_rois(labels, background_label, n_sample=64, fg_fraction=0.25):
+    """
+    Indices of up to n_sample labelled ROIs, fg_fraction of them foreground
+    (more if there is not enough background to fill the batch).
+    """
+    if background_label is None:
+        fg_inds = torch.where(labels >= 0)[0]
+        bg_inds = fg_inds[:0]
+    else:
+        fg_inds = torch.where((labels >= 0) & (labels != background_label))[0]
+        bg_inds = torch.where(labels == background_label)[0]
+    n_fg = min(len(fg_inds), max(int(fg_fraction * n_sample), n_sample - len(bg_inds)))
+    n_bg = min(len(bg_inds), n_sample - n_fg)
+    fg_inds = fg_inds[torch.randperm(len(fg_inds))[:n_fg]]
+    bg_inds = bg_inds[torch.randperm(len(bg_inds))[:n_bg]]
+    return torch.cat([fg_inds, bg_inds])
+
+
+def _roi_batch(images, batch, backbone, rpn, anchors, roi_head, top_k, n_sample, use_proposals=True):
+    """Frozen forward + ROI labelling. Returns (body_feats, boxes_list, labels, anchors)."""
+    background_label = roi_head.num_classes if roi_head.background else None
+    with torch.no_grad():
+        body_feats = rpn.extract_features(backbone(images))
+        if anchors is None:
+            Y_FM, X_FM = body_feats.shape[2], body_feats.shape[3]
+            anchors = torch.from_numpy(generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales))
+        proposals = [None] * images.shape[0]
+        if use_proposals:
+            pred_locs, _, objectness_score = rpn.predict(body_feats)
+            proposals = topk_proposals(pred_locs, objectness_score, anchors, top_k)
+
+    boxes_list, labels_list = [], []
+    for i in range(images.shape[0]):
+        gt_labels = gt_class_ids(batch["names"][i])
+        known = gt_labels >= 0
+        gt_boxes, gt_labels = batch["boxes"][i][known], gt_labels[known]
+        rois = gt_boxes
+        if proposals[i] is not None:
+            rois = torch.cat([torch.from_numpy(proposals[i]).float(), gt_boxes], dim=0)
+        labels = assign_roi_labels(rois, gt_boxes, gt_labels, background_label)
+        keep = sample_rois(labels, background_label, n_sample) if use_proposals else torch.arange(len(rois))
+        boxes_list.append(rois[keep])
+        labels_list.append(labels[keep])
+    return body_feats, boxes_list, torch.cat(labels_list), anchors
+
+
+def train_roi_head(backbone, rpn, roi_head, optimizer, train_dl, epochs=10, top_k=200,
+                   n_sample=64, device=None):
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    backbone.eval()
+    rpn.eval()
+    roi_head.train()
+    anchors = None
+
+    for epoch in range(epochs):
+        sum_loss, correct, total = 0.0, 0, 0
+        for batch in train_dl:
+            images = batch["images"].to(device)
+            body_feats, boxes_list, labels, anchors = _roi_batch(
+                images, batch, backbone, rpn, anchors, roi_head, top_k, n_sample)
+            if len(labels) == 0:
+                continue
+            labels = labels.to(device)
+
+            pooled = rpn.pool_rois(body_feats, boxes_list)
+            logits = roi_head(pooled)
+            loss = F.cross_entropy(logits, labels)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            sum_loss += loss.item() * len(labels)
+            correct += (logits.argmax(dim=1) == labels).sum().item()
+            total += len(labels)
+
+        print(f"Epoch {epoch+1}/{epochs}: Loss {sum_loss/max(total, 1):.3f} | Acc {correct/max(total, 1):.3f}")
+        if (epoch+1) % 5 == 0:
+            torch.save(roi_head.state_dict(), f"./roi_head_epoch_{epoch+1}.pth")
+    return roi_head
+
+
+def roi_head_accuracy(backbone, rpn, roi_head, data_loader, device=None):
+    """Classification accuracy of the ROI head on GT boxes (comparable to ObjectClassifier on GT crops)."""
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    roi_head.eval()
+    correct, total = 0, 0
+    with torch.no_grad():
+        for batch in data_loader:
+            images = batch["images"].to(device)
+            body_feats, boxes_list, labels, _ = _roi_batch(
+                images, batch, backbone, rpn, None, roi_head, 0, 0, use_proposals=False)
+            if len(labels) == 0:
+                continue
+            logits = roi_head(rpn.pool_rois(body_feats, boxes_list))
+            correct += (logits.argmax(dim=1).cpu() == labels).sum().item()
+            total += len(labels)
+    roi_head.train()
+    return correct / total if total else 0.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the ROI classification head on frozen RPN features")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--rpn-weights", default="final_model.pth")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--top-k", type=int, default=200)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = CustomDataset(args.image_dir, extract_first_n_labels(args.labels_json, 20000), args.pt_dir)
+    train_size = int(0.85 * len(dataset))
+    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, len(dataset) - train_size])
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=custom_collate_fn, num_workers=2)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=custom_collate_fn, num_workers=2)
+
+    backbone = build_vgg_backbone(device=device)
+    rpn = EnhancedRPNWithROI().to(device)
+    rpn.load_state_dict(torch.load(args.rpn_weights, map_location=device))
+    roi_head = ROIClassifierHead(num_classes=len(name_to_id)).to(device)
+    optimizer = torch.optim.Adam(roi_head.parameters(), lr=args.lr, weight_decay=1e-4)
+
+    train_roi_head(backbone, rpn, roi_head, optimizer, train_loader, epochs=args.epochs, top_k=args.top_k, device=device)
+    print(f"Validation accuracy on GT boxes: {roi_head_accuracy(backbone, rpn, roi_head, val_loader, device):.3f}")
+    torch.save(roi_head.state_dict(), "./roi_head_final.pth")
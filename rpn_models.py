@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+"""Model definitions shared by the RPN scripts, notebooks and tooling.
+
+The classes mirror the ones in RPN_CBAM.py, rpn_roi_integrated.py and
+RPN+ROI+Classification_integration.ipynb with identical parameter names,
+so existing checkpoints (e.g. final_model.pth, classification_*.pth) load
+unchanged. Unlike the Colab exports this file has no side effects on import.
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision
+import torchvision.models as models
+import torchvision.ops as ops
+from torch.utils.checkpoint import checkpoint
+
+from rpn_utils import anchor_scales, generate_anchor_grid_np, ratios
+
+
+# -----------------------
+# Backbone
+# -----------------------
+
+class VGGBackbone(nn.Sequential):
+    """
+    nn.Sequential of VGG16 layers (same state_dict keys). When a tail of
+    the layers is trainable, the frozen head runs without autograd and,
+    with activation_checkpointing, the tail's activations are recomputed
+    in backward instead of stored (in ~sqrt(n) segments).
+    """
+    out_channels = 512
+    stride = 16
+    activation_checkpointing = False
+
+    def forward(self, x):
+        first_trainable = next((i for i, layer in enumerate(self)
+                                if any(p.requires_grad for p in layer.parameters())), None)
+        if first_trainable is None or not torch.is_grad_enabled():
+            return super().forward(x)
+        # Slices are VGGBackbones too, so run them as plain Sequentials
+        with torch.no_grad():
+            x = nn.Sequential.forward(self[:first_trainable], x)
+        tail = self[first_trainable:]
+        if not self.activation_checkpointing:
+            return nn.Sequential.forward(tail, x)
+        # ~sqrt(n) segments cut before convs (the in-place ReLUs must not start a segment):
+        # only segment inputs are kept and one segment at a time is recomputed
+        starts = [i for i, layer in enumerate(tail) if isinstance(layer, nn.Conv2d)]
+        starts = starts[::max(1, round(math.sqrt(len(starts))))] + [len(tail)]
+        for start, end in zip(starts[:-1], starts[1:]):
+            x = checkpoint(nn.Sequential.forward, tail[start:end], x, use_reentrant=False)
+        return x
+
+
+def build_vgg_backbone(pretrained=True, device=None, trainable_layers=0):
+    """
+    VGG16 conv trunk up to conv5_3 (+ReLU), i.e. vgg16.features[:30].
+    Output: 512 channels at stride 16 (out_channels / stride, as on
+    backbones.Backbone). Frozen and in eval mode, except
+    for the last trainable_layers layers (3: conv5_3 and its ReLUs, the
+    tail rpn_roi_integrated.py fine-tunes as vgg_model.features[-4:]).
+    """
+    weights = torchvision.models.VGG16_Weights.DEFAULT if pretrained else None
+    vgg_model = torchvision.models.vgg16(weights=weights)
+    backbone = VGGBackbone(*list(vgg_model.features)[:30])
+    for i, layer in enumerate(backbone):
+        for param in layer.parameters():
+            param.requires_grad = i >= len(backbone) - trainable_layers
+    backbone.eval()
+    if device is not None:
+        backbone = backbone.to(device)
+    return backbone
+
+
+# -----------------------
+# Activation checkpointing
+# -----------------------
+
+def _maybe_checkpoint(owner, fn, *args):
+    """fn(*args), recomputed in backward when owner.activation_checkpointing is set and autograd is on."""
+    if owner.activation_checkpointing and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
+
+def set_activation_checkpointing(*models, enabled=True):
+    """
+    Toggle activation checkpointing on every submodule that supports it
+    (VGGBackbone tail, EnhancedRPN / EnhancedRPNWithROI blocks), through
+    wrappers such as DistributedDataParallel. Forward results are
+    unchanged; backward recomputes the checkpointed segments.
+    """
+    for model in models:
+        for module in model.modules():
+            if hasattr(module, "activation_checkpointing"):
+                module.activation_checkpointing = enabled
+
+
+# -----------------------
+# Attention
+# -----------------------
+
+ATTENTION = {}
+
+
+def register_attention(name):
+    """Decorator: register an attention module class `cls(channels, **kwargs)`."""
+    def wrap(cls):
+        ATTENTION[name] = cls
+        return cls
+    return wrap
+
+
+def build_attention(name, channels, **kwargs):
+    if name not in ATTENTION:
+        raise KeyError(f"Unknown attention '{name}', choose from {sorted(ATTENTION)}")
+    return ATTENTION[name](channels, **kwargs)
+
+
+def attention_per_block(attention, n_blocks=2):
+    """'cbam' -> ['cbam', 'cbam']; a list/tuple gives one name per block."""
+    if isinstance(attention, str):
+        return [attention] * n_blocks
+    if len(attention) != n_blocks:
+        raise ValueError(f"Expected {n_blocks} attention names, got {list(attention)}")
+    return list(attention)
+
+
+@register_attention("cbam")
+class CBAM(nn.Module):
+    def __init__(self, channels, reduction=4, kernel_size=3):
+        super().__init__()
+        # Channel attention
+        self.avg_pool = nn.AdaptiveAvgPool2d(1)
+        self.max_pool = nn.AdaptiveMaxPool2d(1)
+        self.fc = nn.Sequential(
+            nn.Linear(channels, channels//reduction, bias=False),
+            nn.ReLU(),
+            nn.Linear(channels//reduction, channels, bias=False)
+        )
+        self.sigmoid = nn.Sigmoid()
+
+        # Spatial attention
+        self.conv = nn.Conv2d(2, 1, kernel_size, padding=kernel_size//2, bias=False)
+
+    def forward(self, x):
+        # Channel attention (shape indexing instead of unpacking keeps it FX-traceable)
+        b, c = x.shape[0], x.shape[1]
+        y_avg = self.avg_pool(x).view(b, c)
+        y_max = self.max_pool(x).view(b, c)
+        y = self.fc(y_avg) + self.fc(y_max)
+        scale = self.sigmoid(y).view(b, c, 1, 1)
+        x = x * scale
+
+        # Spatial attention
+        avg_out = torch.mean(x, dim=1, keepdim=True)
+        max_out, _ = torch.max(x, dim=1, keepdim=True)
+        y = torch.cat([avg_out, max_out], dim=1)
+        scale = self.sigmoid(self.conv(y))
+        return x * scale
+
+
+@register_attention("cbam_fused")
+class FusedCBAM(CBAM):
+    """
+    CBAM with the channel MLP run once on the stacked avg/max descriptors
+    instead of twice. Same parameters as CBAM, so CBAM weights load as-is.
+    """
+    def forward(self, x):
+        b, c = x.shape[0], x.shape[1]
+        pooled = torch.cat([self.avg_pool(x).view(b, c), self.max_pool(x).view(b, c)], dim=0)
+        y = self.fc(pooled)
+        scale = self.sigmoid(y[:b] + y[b:]).view(b, c, 1, 1)
+        x = x * scale
+
+        y = torch.cat([torch.mean(x, dim=1, keepdim=True), torch.amax(x, dim=1, keepdim=True)], dim=1)
+        return x * self.sigmoid(self.conv(y))
+
+
+@register_attention("eca")
+class ECA(nn.Module):
+    """
+    ECA-Net channel attention: global avg pool, 1D conv across channels,
+    sigmoid. No spatial branch, no MLP (k_size parameters in total).
+    """
+    def __init__(self, channels, gamma=2, b=1, k_size=None):
+        super().__init__()
+        if k_size is None:
+            t = int(abs((math.log2(channels) + b) / gamma))
+            k_size = t if t % 2 else t + 1
+        self.avg_pool = nn.AdaptiveAvgPool2d(1)
+        self.conv = nn.Conv1d(1, 1, kernel_size=k_size, padding=k_size//2, bias=False)
+        self.sigmoid = nn.Sigmoid()
+
+    def forward(self, x):
+        b, c = x.shape[0], x.shape[1]
+        y = self.conv(self.avg_pool(x).view(b, 1, c))
+        return x * self.sigmoid(y).view(b, c, 1, 1)
+
+
+@register_attention("none")
+class NoAttention(nn.Identity):
+    def __init__(self, channels, **kwargs):
+        super().__init__()
+
+
+# -----------------------
+# RPN heads
+# -----------------------
+
+class EnhancedRPN(nn.Module):
+    activation_checkpointing = False  # see set_activation_checkpointing
+
+    def __init__(self, in_channels=512, mid_channels=256, n_anchor=9, attention="cbam"):
+        """attention: a registered name (see ATTENTION) or one name per block."""
+        super(EnhancedRPN, self).__init__()
+        self.conv1 = nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1)
+        self.conv2 = nn.Conv2d(mid_channels, mid_channels, kernel_size=3, padding=1)
+        self.conv3 = nn.Conv2d(mid_channels, mid_channels, kernel_size=3, padding=1)
+
+        # Attribute names kept from the CBAM-only version so checkpoints load
+        att1, att2 = attention_per_block(attention)
+        self.cbam1 = build_attention(att1, mid_channels)
+        self.cbam2 = build_attention(att2, mid_channels)
+
+        self.reg_layer = nn.Conv2d(mid_channels, n_anchor*4, kernel_size=1)
+        self.cls_layer = nn.Conv2d(mid_channels, n_anchor*2, kernel_size=1)
+
+        # Skip connection - identity mapping if dims match
+        self.skip_conv = nn.Conv2d(in_channels, mid_channels, kernel_size=1)
+        if in_channels == mid_channels:
+            nn.init.eye_(self.skip_conv.weight.view(mid_channels, in_channels))
+            nn.init.zeros_(self.skip_conv.bias)
+            self.skip_conv.weight.requires_grad = False
+            self.skip_conv.bias.requires_grad = False
+
+        self._initialize_weights()
+
+    def _initialize_weights(self):
+        for layer in [self.conv1, self.conv2, self.conv3, self.reg_layer, self.cls_layer]:
+            nn.init.normal_(layer.weight, std=0.01)
+            if layer.bias is not None:
+                nn.init.constant_(layer.bias, 0)
+
+    def _block1(self, x):
+        return self.cbam1(F.relu(self.conv1(x)))
+
+    def _block2(self, x):
+        return self.cbam2(F.relu(self.conv2(x)))
+
+    def _block3(self, x, residual):
+        return F.relu(self.conv3(x) + residual)
+
+    def forward(self, x):
+        residual = self.skip_conv(x)
+
+        # Each conv+CBAM block is a checkpoint segment when activation_checkpointing is set
+        x = _maybe_checkpoint(self, self._block1, x)
+        x = _maybe_checkpoint(self, self._block2, x)
+        x = _maybe_checkpoint(self, self._block3, x, residual)
+
+        pred_anchor_locs = self.reg_layer(x)
+        pred_cls_scores = self.cls_layer(x)
+
+        batch_size = x.shape[0]
+        pred_anchor_locs = pred_anchor_locs.permute(0,2,3,1).contiguous().view(batch_size, -1, 4)
+        pred_cls_scores = pred_cls_scores.permute(0,2,3,1).contiguous().view(batch_size, -1, 2)
+
+        pred_anchor_locs = torch.tanh(pred_anchor_locs) * 2
+        objectness_score = F.softmax(pred_cls_scores, dim=-1)[:,:,1]
+
+        return pred_anchor_locs, pred_cls_scores, objectness_score
+
+
+class RPN(nn.Module):
+    def __init__(self, in_channels=512, mid_channels=512, n_anchor=9):
+        super(RPN, self).__init__()
+        self.conv1 = nn.Conv2d(in_channels, mid_channels, kernel_size=3, stride=1, padding=1)
+        self.reg_layer = nn.Conv2d(mid_channels, n_anchor*4, kernel_size=1, stride=1)
+        self.cls_layer = nn.Conv2d(mid_channels, n_anchor*2, kernel_size=1, stride=1)
+        for layer in [self.conv1, self.reg_layer, self.cls_layer]:
+            nn.init.normal_(layer.weight, std=0.01)
+            nn.init.constant_(layer.bias, 0)
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+        x = self.conv1(x)
+        pred_anchor_locs = self.reg_layer(x)
+        pred_cls_scores = self.cls_layer(x)
+        pred_anchor_locs = pred_anchor_locs.permute(0,2,3,1).contiguous().view(batch_size, -1, 4)
+        pred_cls_scores = pred_cls_scores.permute(0,2,3,1).contiguous().view(batch_size, -1, 2)
+        objectness_score = pred_cls_scores[:,:,1]
+        return pred_anchor_locs, pred_cls_scores, objectness_score
+
+
+class CompactRPN(nn.Module):
+    """
+    Single 3x3 conv head with the same outputs as EnhancedRPN (tanh*2
+    offsets, softmax objectness), used as a distillation student. At
+    mid_channels=256 it costs about half of the plain RPN's 512->512 conv.
+    """
+    def __init__(self, in_channels=512, mid_channels=256, n_anchor=15):
+        super().__init__()
+        self.conv1 = nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1)
+        self.reg_layer = nn.Conv2d(mid_channels, n_anchor*4, kernel_size=1)
+        self.cls_layer = nn.Conv2d(mid_channels, n_anchor*2, kernel_size=1)
+
+        for layer in [self.conv1, self.reg_layer, self.cls_layer]:
+            nn.init.normal_(layer.weight, std=0.01)
+            nn.init.constant_(layer.bias, 0)
+
+    def forward(self, x):
+        B = x.size(0)
+        x = F.relu(self.conv1(x))
+        pred_anchor_locs = self.reg_layer(x).permute(0,2,3,1).contiguous().view(B, -1, 4)
+        pred_cls_scores = self.cls_layer(x).permute(0,2,3,1).contiguous().view(B, -1, 2)
+
+        pred_anchor_locs = torch.tanh(pred_anchor_locs) * 2
+        objectness_score = F.softmax(pred_cls_scores, dim=-1)[..., 1]
+        return pred_anchor_locs, pred_cls_scores, objectness_score
+
+
+# -----------------------
+# Batched proposal selection
+# -----------------------
+
+def batched_proposals(boxes, scores, conf_thresh=0.5, iou_thresh=0.5, top_n=400):
+    """
+    Score filter + NMS + per-image top_n for a whole batch, without a Python
+    loop over images.
+
+    boxes: (B, N, 4) [x1,y1,x2,y2], scores: (B, N)
+    Returns (K, 5) ROIs [batch_idx, x1, y1, x2, y2], grouped by image and
+    sorted by score within each image, equal scores in anchor order (a
+    per-image ops.nms keeps the same boxes but leaves the order of ties
+    unspecified).
+    """
+    b_idx, a_idx = torch.nonzero(scores > conf_thresh, as_tuple=True)
+    cand_boxes = boxes[b_idx, a_idx]
+    cand_scores = scores[b_idx, a_idx]
+    if cand_boxes.numel() == 0:
+        return boxes.new_zeros((0, 5))
+
+    # Per-image NMS in one call: batched_nms offsets each image's boxes into a
+    # disjoint coordinate range (on CPU with many boxes it switches to one NMS
+    # per image, which is cheaper than a single quadratic NMS over the batch)
+    keep = ops.batched_nms(cand_boxes, cand_scores, b_idx, iou_thresh)
+
+    # Deterministic order (image, -score, anchor index): batched_nms sorts by
+    # score with an unstable sort, so ties would come back in any order.
+    # Candidates are image-major, so the index breaks ties in anchor order.
+    keep = torch.sort(keep).values
+    keep = keep[torch.sort(cand_scores[keep], descending=True, stable=True).indices]
+    keep = keep[torch.sort(b_idx[keep], stable=True).indices]
+
+    # Keep the first top_n per image
+    kept_b = b_idx[keep]
+    counts = torch.bincount(kept_b, minlength=scores.shape[0])
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(len(keep), device=keep.device) - starts[kept_b]
+    keep = keep[rank < top_n]
+
+    return torch.cat([b_idx[keep, None].to(cand_boxes.dtype), cand_boxes[keep]], dim=1)
+
+
+class RPNWithROI(nn.Module):
+    def __init__(self, in_channels=512, mid_channels=512, n_anchor=9, roi_size=(7,7)):
+        super(RPNWithROI, self).__init__()
+        self.conv1 = nn.Conv2d(in_channels, mid_channels, kernel_size=3, stride=1, padding=1)
+        self.reg_layer = nn.Conv2d(mid_channels, n_anchor*4, kernel_size=1, stride=1)
+        self.cls_layer = nn.Conv2d(mid_channels, n_anchor*2, kernel_size=1, stride=1)
+
+        self.roi_pool = ops.RoIPool(roi_size, spatial_scale=1.0)
+
+        for layer in [self.conv1, self.reg_layer, self.cls_layer]:
+            nn.init.normal_(layer.weight, std=0.01)
+            nn.init.constant_(layer.bias, 0)
+
+    def forward(self, x, anchors=None, gt_boxes=None, do_roi=None):
+        """
+        ROI pooling runs when anchors are given and do_roi is True; with the
+        default do_roi=None it follows the old rule (anchors and gt_boxes given).
+        """
+        batch_size = x.shape[0]
+        x = self.conv1(x)
+        pred_anchor_locs = self.reg_layer(x)  # [B, n_anchor*4, H, W]
+        pred_cls_scores = self.cls_layer(x)   # [B, n_anchor*2, H, W]
+
+        pred_anchor_locs = pred_anchor_locs.permute(0,2,3,1).contiguous().view(batch_size, -1, 4)
+        pred_cls_scores = pred_cls_scores.permute(0,2,3,1).contiguous().view(batch_size, -1, 2)
+        objectness_score = pred_cls_scores[:,:,1]
+
+        if do_roi is None:
+            do_roi = gt_boxes is not None
+        if anchors is not None and do_roi:
+            proposal_boxes = self._generate_proposals(pred_anchor_locs, anchors)
+            pooled_features = self._process_proposals(x, proposal_boxes, objectness_score)
+            return pred_anchor_locs, pred_cls_scores, objectness_score, pooled_features
+
+        return pred_anchor_locs, pred_cls_scores, objectness_score
+
+    def _generate_proposals(self, pred_locs, anchors):
+        """Convert anchor offsets to boxes in (x1,y1,x2,y2) format"""
+        # pred_locs: [B, N, 4] (dy, dx, dh, dw)
+        # anchors: [N, 4] (y1, x1, y2, x2)
+        anchor_h = anchors[:, 2] - anchors[:, 0]
+        anchor_w = anchors[:, 3] - anchors[:, 1]
+        anchor_ctr_y = anchors[:, 0] + 0.5 * anchor_h
+        anchor_ctr_x = anchors[:, 1] + 0.5 * anchor_w
+
+        ctr_y = pred_locs[..., 0] * anchor_h[None, :] + anchor_ctr_y[None, :]
+        ctr_x = pred_locs[..., 1] * anchor_w[None, :] + anchor_ctr_x[None, :]
+        h = torch.exp(pred_locs[..., 2]) * anchor_h[None, :]
+        w = torch.exp(pred_locs[..., 3]) * anchor_w[None, :]
+
+        return torch.stack([ctr_x - 0.5 * w, ctr_y - 0.5 * h,
+                            ctr_x + 0.5 * w, ctr_y + 0.5 * h], dim=-1)
+
+    def _process_proposals(self, features, boxes, scores, conf_thresh=0.7, iou_thresh=0.5, top_n=50):
+        """Process proposals through NMS and ROI pooling (whole batch at once)"""
+        rois = batched_proposals(boxes, scores, conf_thresh, iou_thresh, top_n)
+        return self.roi_pool(features, rois)
+
+
+class EnhancedRPNWithROI(nn.Module):
+    activation_checkpointing = False  # see set_activation_checkpointing
+
+    def __init__(self,
+                 in_channels=512,
+                 mid_channels=256,
+                 n_anchor=15,  # must match len(ratios)*len(scales)
+                 pool_size=(7,7),
+                 nms_thresh=0.5,
+                 conf_thresh=0.5,
+                 top_n=400,
+                 feature_stride=16,
+                 attention="cbam"):
+        """
+        EnhancedRPN body plus ROI pooling and a _process_proposals method.
+        Proposals are in image pixels, so ROI pooling scales them by
+        1/feature_stride onto the feature map. attention is a registered
+        name (see ATTENTION) or one name per block.
+        """
+        super().__init__()
+
+        self.conv1 = nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1)
+        self.conv2 = nn.Conv2d(mid_channels, mid_channels, kernel_size=3, padding=1)
+        self.conv3 = nn.Conv2d(mid_channels, mid_channels, kernel_size=3, padding=1)
+
+        # Attribute names kept from the CBAM-only version so checkpoints load
+        att1, att2 = attention_per_block(attention)
+        self.cbam1 = build_attention(att1, mid_channels)
+        self.cbam2 = build_attention(att2, mid_channels)
+
+        self.reg_layer = nn.Conv2d(mid_channels, n_anchor*4, kernel_size=1)
+        self.cls_layer = nn.Conv2d(mid_channels, n_anchor*2, kernel_size=1)
+
+        self.skip_conv = nn.Conv2d(in_channels, mid_channels, kernel_size=1)
+        if in_channels == mid_channels:
+            nn.init.eye_(self.skip_conv.weight.view(mid_channels, in_channels))
+            nn.init.zeros_(self.skip_conv.bias)
+            self.skip_conv.weight.requires_grad = False
+            self.skip_conv.bias.requires_grad = False
+
+        self._init_weights()
+
+        self.roi_pool = ops.RoIPool(output_size=pool_size, spatial_scale=1.0/feature_stride)
+
+        self.nms_thresh = nms_thresh
+        self.conf_thresh = conf_thresh
+        self.top_n = top_n
+        self._anchor_cache = {}
+
+    def _init_weights(self):
+        for layer in [self.conv1, self.conv2, self.conv3, self.reg_layer, self.cls_layer]:
+            nn.init.normal_(layer.weight, std=0.01)
+            if layer.bias is not None:
+                nn.init.constant_(layer.bias, 0)
+
+    def forward(self, x, anchors=None, do_roi=False):
+        """
+        Args:
+            x: feature map from the backbone, shape (B, C=512, H, W)
+            anchors: (total_anchors, 4) if you want to decode proposals
+            do_roi: bool. If True, we also do the ROI pooling step, returning pooled features.
+
+        Returns:
+            pred_locs: (B, #anchors, 4)
+            pred_scores: (B, #anchors, 2)
+            objectness_score: (B, #anchors)
+            (optionally) pooled_feats: if do_roi==True and anchors is not None
+        """
+        x = self.extract_features(x)
+        pred_anchor_locs, pred_cls_scores, objectness_score = self.predict(x)
+
+        if anchors is None or (not do_roi):
+            return pred_anchor_locs, pred_cls_scores, objectness_score
+
+        proposals = self._generate_proposals(pred_anchor_locs, anchors)  # shape (B, #anchors, 4)
+        pooled_feats = self._process_proposals(x, proposals, objectness_score)
+
+        return pred_anchor_locs, pred_cls_scores, objectness_score, pooled_feats
+
+    _block1 = EnhancedRPN._block1
+    _block2 = EnhancedRPN._block2
+    _block3 = EnhancedRPN._block3
+
+    def extract_features(self, x):
+        """
+        RPN body: conv+CBAM blocks with residual, (B, mid_channels, H, W).
+        With activation_checkpointing each block is recomputed in backward.
+        """
+        residual = self.skip_conv(x)
+
+        x = _maybe_checkpoint(self, self._block1, x)
+        x = _maybe_checkpoint(self, self._block2, x)
+        return _maybe_checkpoint(self, self._block3, x, residual)
+
+    def predict(self, x):
+        """RPN heads on body features: (pred_locs, pred_scores, objectness_score)."""
+        B = x.size(0)
+        pred_anchor_locs = self.reg_layer(x)      # shape (B, n_anchor*4, H, W)
+        pred_cls_scores  = self.cls_layer(x)      # shape (B, n_anchor*2, H, W)
+
+        pred_anchor_locs = pred_anchor_locs.permute(0,2,3,1).contiguous().view(B, -1, 4)
+        pred_cls_scores  = pred_cls_scores.permute(0,2,3,1).contiguous().view(B, -1, 2)
+
+        pred_anchor_locs = torch.tanh(pred_anchor_locs) * 2
+        objectness_score = F.softmax(pred_cls_scores, dim=-1)[..., 1]  # shape (B, #anchors)
+        return pred_anchor_locs, pred_cls_scores, objectness_score
+
+    def pool_rois(self, conv_features, boxes_list):
+        """
+        ROI-pool arbitrary boxes from body features.
+        boxes_list: one (K_i, 4) [x1,y1,x2,y2] tensor per image, in image pixels.
+        Returns (sum K_i, mid_channels, pool_h, pool_w), in image order.
+        """
+        rois = torch.cat([
+            torch.cat([torch.full((len(boxes), 1), b_idx, dtype=torch.float32, device=conv_features.device),
+                       boxes.to(device=conv_features.device, dtype=torch.float32)], dim=1)
+            for b_idx, boxes in enumerate(boxes_list)
+        ], dim=0)
+        return self._roi_pool_fp32(conv_features, rois)
+
+    def _roi_pool_fp32(self, conv_features, rois):
+        """
+        roi_pool with fp32 ROIs: bf16 has 8 mantissa bits, so pixel
+        coordinates (and batch indices above 256) would be rounded by up to
+        several pixels. bf16 features are pooled in fp32 and cast back
+        (max pooling, so the values are unchanged).
+        """
+        pooled = self.roi_pool(conv_features.float(), rois.float())
+        return pooled.to(conv_features.dtype)
+
+    def anchor_grid(self, feature_maps, stride=None):
+        """
+        (N, 4) [x1,y1,x2,y2] anchors for the size and device of feature_maps,
+        generated once and then served from a cache (not saved in checkpoints).
+        stride is the backbone stride, see generate_anchor_grid_np.
+        """
+        key = (feature_maps.shape[2], feature_maps.shape[3], stride, feature_maps.device)
+        if key not in self._anchor_cache:
+            anchors = generate_anchor_grid_np(key[1], key[0], ratios, anchor_scales, stride=stride)
+            self._anchor_cache[key] = torch.from_numpy(anchors).to(feature_maps.device)
+        return self._anchor_cache[key]
+
+    def _generate_proposals(self, pred_locs, anchors):
+        """
+        Convert anchor offsets to box coords [x1, y1, x2, y2].
+        pred_locs: (B, N, 4) => offsets [dy, dx, dh, dw]
+        anchors:   (N, 4) in [x1, y1, x2, y2]
+        """
+        anchors = anchors.to(pred_locs.device)
+
+        anc_w = anchors[:, 2] - anchors[:, 0]  # x2 - x1
+        anc_h = anchors[:, 3] - anchors[:, 1]  # y2 - y1
+        anc_ctr_x = anchors[:, 0] + 0.5*anc_w
+        anc_ctr_y = anchors[:, 1] + 0.5*anc_h
+
+        ctr_y = pred_locs[..., 0] * anc_h[None, :] + anc_ctr_y[None, :]
+        ctr_x = pred_locs[..., 1] * anc_w[None, :] + anc_ctr_x[None, :]
+        h = torch.exp(pred_locs[..., 2]) * anc_h[None, :]
+        w = torch.exp(pred_locs[..., 3]) * anc_w[None, :]
+
+        return torch.stack([ctr_x - 0.5*w, ctr_y - 0.5*h,
+                            ctr_x + 0.5*w, ctr_y + 0.5*h], dim=-1)
+
+    def select_proposals(self, proposals, scores):
+        """
+        conf_thresh filter, NMS and top_n per image for the whole batch.
+        Returns (K, 5) ROIs [batch_idx, x1, y1, x2, y2]; pool them with
+        self.roi_pool(conv_features, rois) only if the features are needed.
+        """
+        return batched_proposals(proposals, scores, self.conf_thresh, self.nms_thresh, self.top_n)
+
+    def _process_proposals(self, conv_features, proposals, scores):
+        """
+        Filter proposals by self.conf_thresh, NMS, keep top_n per image and
+        ROI pool, all in batched tensor ops with a single roi_pool call.
+        Return pooled features.
+        """
+        rois = self.select_proposals(proposals, scores)
+        return self._roi_pool_fp32(conv_features, rois)
+
+
+# -----------------------
+# Classifier
+# -----------------------
+
+class ObjectClassifier(nn.Module):
+    def __init__(self, num_classes=10, dropout_p=0.5, freeze_backbone=True, pretrained=True):
+        super(ObjectClassifier, self).__init__()
+        weights = models.ResNet18_Weights.DEFAULT if pretrained else None
+        self.model = models.resnet18(weights=weights)
+
+        if freeze_backbone:
+            for param in self.model.parameters():
+                param.requires_grad = False
+            for param in self.model.layer4.parameters():
+                param.requires_grad = True
+            for param in self.model.fc.parameters():
+                param.requires_grad = True
+
+        in_features = self.model.fc.in_features
+        self.model.fc = nn.Sequential(
+            nn.Dropout(p=dropout_p),
+            nn.Linear(in_features, num_classes)
+        )
+
+    def forward(self, x):
+        return self.model(x)
+
+
+class ROIClassifierHead(nn.Module):
+    """
+    Lightweight classifier on ROI-pooled RPN body features (K, C, 7, 7),
+    replacing the crop -> resize -> ResNet18 pass per proposal.
+    With background=True the last logit is a "no object" class.
+    """
+    def __init__(self, in_channels=256, pool_size=(7,7), num_classes=10,
+                 reduced_channels=64, hidden=512, dropout_p=0.5, background=True):
+        super().__init__()
+        self.num_classes = num_classes
+        self.background = background
+        self.reduce = nn.Sequential(
+            nn.Conv2d(in_channels, reduced_channels, kernel_size=1),
+            nn.ReLU()
+        )
+        self.fc = nn.Sequential(
+            nn.Flatten(),
+            nn.Linear(reduced_channels * pool_size[0] * pool_size[1], hidden),
+            nn.ReLU(),
+            nn.Dropout(p=dropout_p),
+            nn.Linear(hidden, num_classes + 1 if background else num_classes)
+        )
+
+    def forward(self, pooled_feats):
+        return self.fc(self.reduce(pooled_feats))
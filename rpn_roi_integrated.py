@@ -421,31 +421,8 @@ def compute_iou(box1, box2):
 
     return inter_area / union_area if union_area > 0 else 0
 
-# define the function that finds the best match from predicted bounding boxes for each ground truth box
-def match_predictions_to_ground_truth(pred_boxes, gt_boxes, iou_threshold=0.5):
-    """Match predicted boxes to ground truth boxes based on IoU."""
-    matched_preds = {}
-    gt_matched = set()
-    pred_boxes = pred_boxes.astype(np.float32)
-    gt_boxes = gt_boxes.astype(np.float32)
-
-    for i, pred in enumerate(pred_boxes):
-        best_iou = 0
-        best_gt_idx = -1
-        for j, gt in enumerate(gt_boxes):
-            if j in gt_matched:
-                continue  # Skip matched gt boxes
-            iou = compute_iou(pred, gt)
-            if iou > best_iou:
-                best_iou = iou
-                best_gt_idx = j
-
-        if best_iou >= iou_threshold:
-            matched_preds[i] = best_gt_idx
-            gt_matched.add(best_gt_idx)
-
-    return matched_preds # return a dictionary of predicted bounding boxes that each matches to one ground truth box
-               # with format: {i}: box, where i is the order of corresponding ground truth box
+# Greedy one-to-one matching (one IoU matrix per image, optionally class-aware) and TP/FP/FN
+from rpn_utils import batch_tp_fp_fn, compute_tp_fp_fn, match_predictions_to_ground_truth
 
 # can directly use this function in the training code to get the iou loss for parameter updates
 # this function calls match_prediction_to_ground_truth(pred_boxes, gt_boxes, iou_threshold=0.5) and compute_iou(box1, box2)
@@ -489,14 +466,6 @@ def match_predictions_to_ground_truth(pred_boxes, gt_boxes, iou_threshold=0.5):
     return iou_loss
 '''
   # compute true positive, false positive, and false negative if we need for precision and recall calculation
-def compute_tp_fp_fn(matched_preds, num_pred, num_gt): # num_pred is total number of predictions.
-                                # num_gt is total number of ground boxes.
-    """Calculate TP, FP, FN from matched predictions."""
-    TP = len(matched_preds)
-    FP = num_pred - TP
-    FN = num_gt - TP
-    return TP, FP, FN
-
 vgg_model = torchvision.models.vgg16(pretrained=True).to(device)
 vgg_model.eval()
 for param in vgg_model.features.parameters():
@@ -554,13 +523,10 @@ def pred_bbox_to_xywh(bbox, anchors):
 def train_epochs(req_features, rpn_model, optimizer, train_dl, epochs=20, rpn_lambda=10, device = None):
     if device is None:  # If device is not specified, use the default device
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    rpn_model.load_state_dict(torch.load("./rpn_epoch_200.pth", map_location=device))
+    if os.path.exists("./rpn_epoch_200.pth"):  # warm start only if the checkpoint is there
+        rpn_model.load_state_dict(torch.load("./rpn_epoch_200.pth", map_location=device))
     rpn_model.train()
     for epoch in range(epochs):
-        print("Hi")
-    rpn_model.train()
-    for epoch in range(epochs):
-        print("Hi")
         total_samples = 0
         sum_loss = 0.0
         sum_loss_cls = 0.0
@@ -580,7 +546,6 @@ def train_epochs(req_features, rpn_model, optimizer, train_dl, epochs=20, rpn_la
             X_FM, Y_FM = feat.shape[2], feat.shape[3]
             # Compute GT targets (for all anchors)
             gt_locs_np, gt_scores_np, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM)
-            print("Hmm")
             gt_locs = torch.from_numpy(gt_locs_np.astype(np.float32)).to(device)
             gt_scores = torch.from_numpy(gt_scores_np.astype(np.float32)).to(device)
             # Forward RPN
@@ -689,7 +654,7 @@ validate(trained_rpn, val_loader)
 """###ROI"""
 
 import torchvision.ops as ops
-from sklearn.cluster import DBSCAN
+from box_merging import combine_boxes
 import torch
 import torch.nn as nn
 import torchvision.ops as ops
@@ -839,58 +804,6 @@ class RPNWithROI(nn.Module):
 
         return torch.cat(pooled_features, dim=0) if batch_size > 1 else pooled_features[0]
 
-def combine_boxes(boxes, scores=None, iou_threshold=0.5, min_cluster_size=2):
-    # Convert to numpy if needed (maintaining [y1,x1,y2,x2] format)
-    boxes_np = boxes.cpu().numpy() if isinstance(boxes, torch.Tensor) else np.array(boxes)
-
-    if len(boxes_np) == 0:
-        return boxes, np.array([])
-
-    # Calculate IoU matrix using your existing function
-    iou_matrix = compute_iou_vectorized(boxes_np, boxes_np)  # Compare all boxes to all boxes
-
-    # Convert IoU to distance (1-IoU) for DBSCAN
-    distance_matrix = 1 - iou_matrix
-
-    # Cluster boxes using DBSCAN
-    clustering = DBSCAN(
-        eps=1-iou_threshold,
-        min_samples=min_cluster_size,
-        metric='precomputed'
-    ).fit(distance_matrix)
-
-    cluster_labels = clustering.labels_
-
-    # Combine boxes in each cluster
-    combined_boxes = []
-    for cluster_id in np.unique(cluster_labels):
-        if cluster_id == -1:  # Skip noise points (boxes not in any cluster)
-            continue
-
-        cluster_mask = (cluster_labels == cluster_id)
-        cluster_boxes = boxes_np[cluster_mask]
-
-        # Calculate combined box coordinates (still in [y1,x1,y2,x2] format)
-        y1 = np.min(cluster_boxes[:, 0])
-        x1 = np.min(cluster_boxes[:, 1])
-        y2 = np.max(cluster_boxes[:, 2])
-        x2 = np.max(cluster_boxes[:, 3])
-        combined_boxes.append([y1, x1, y2, x2])
-
-    # Add unclustered boxes (if any)
-    unclustered_mask = (cluster_labels == -1)
-    if np.any(unclustered_mask):
-        combined_boxes.extend(boxes_np[unclustered_mask])
-
-    combined_boxes = np.array(combined_boxes) if len(combined_boxes) > 0 else np.empty((0, 4))
-
-    # Convert back to tensor if input was tensor
-    if isinstance(boxes, torch.Tensor):
-        combined_boxes = torch.from_numpy(combined_boxes).float().to(boxes.device)
-
-    return combined_boxes, cluster_labels
-
-
 def train_epochs(req_features, rpn_model, optimizer, train_dl, epochs=20, rpn_lambda=10, device=None):
     if device is None:  # If device is not specified, use the default device
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -916,7 +829,6 @@ def train_epochs(req_features, rpn_model, optimizer, train_dl, epochs=20, rpn_la
             X_FM, Y_FM = feat.shape[2], feat.shape[3]
             # Compute GT targets (for all anchors)
             gt_locs_np, gt_scores_np, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM)
-            print("Hmm")
             gt_locs = torch.from_numpy(gt_locs_np.astype(np.float32)).to(device)
             gt_scores = torch.from_numpy(gt_scores_np.astype(np.float32)).to(device)
             # Forward RPN
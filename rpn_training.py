@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""Importable RPN training loop (anchor targets, loss, train/eval).
+
+Port of bbox_generation / train_epochs from RPN+CBAM+ROI.ipynb and
+RPN_CBAM.py in the [x1, y1, x2, y2] convention of rpn_utils, without the
+plotting and hard-coded checkpoint loading, so tools can train and
+evaluate an RPN without running a Colab export.
+
+`precision="bf16"` runs backbone and RPN under autocast; the loss, the
+targets and box decoding stay in fp32.
+
+Usage (fp32 vs bf16 from the same initialisation):
+    python rpn_training.py --precision compare --epochs 5 --n-train 200
+"""
+
+import argparse
+import copy
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from backbones import BACKBONES, build_backbone, build_rpn_for_backbone
+from checkpointing import CheckpointManager, ResumableSampler
+from profiling import NULL_TIMER, StageTimer, trace_profiler
+from rpn_models import build_vgg_backbone, set_activation_checkpointing
+from rpn_utils import (PRECISIONS, CustomDataset, anchor_scales, compute_iou_vectorized, compute_recall_at_threshold,
+                       custom_collate_fn, extract_first_n_labels, generate_anchor_grid_np, precision_autocast,
+                       ratios, topk_proposals)
+from runtime_config import apply_tuned_settings, tuned_num_workers
+from training_metrics import TrainingMetrics
+
+
+# -----------------------
+# Anchor targets
+# -----------------------
+
+def bbox_generation(images, targets, X_FM, Y_FM, pos_iou_th=0.7, neg_iou_th=0.3, n_sample=256, pos_ratio=0.5,
+                    stride=None):
+    """
+    Regression targets and labels for all anchors; anchors outside the
+    image are ignored (label = -1). stride is the backbone stride
+    (backbone.stride), so the anchors are the ones inference decodes
+    against (rpn.anchor_grid / generate_anchor_grid_np).
+    Returns:
+       anchor_locs_all: (B, total_anchors, 4) offsets [dy, dx, dh, dw]
+       anchor_labels_all: (B, total_anchors) 1 / 0 / -1
+       anchors: (total_anchors, 4) in [x1,y1,x2,y2]
+    """
+    B = len(images)
+    C, H_IMG, W_IMG = images[0].shape
+    anchors = generate_anchor_grid_np(X_FM, Y_FM, ratios, anchor_scales, stride=stride)
+    total_anchors = anchors.shape[0]
+
+    # Valid anchors fully in the image
+    valid_idx = np.where(
+        (anchors[:,0] >= 0) & (anchors[:,1] >= 0) &
+        (anchors[:,2] <= W_IMG) & (anchors[:,3] <= H_IMG)
+    )[0]
+    valid_anchors = anchors[valid_idx]
+
+    anchor_locs_all, anchor_labels_all = [], []
+    for i in range(B):
+        labels = -1*np.ones((total_anchors,), dtype=np.int32)
+        locs   = np.zeros((total_anchors, 4), dtype=np.float32)
+
+        gt_boxes = targets[i]["boxes"].cpu().numpy()  # shape (M,4) in [x1,y1,x2,y2]
+        if gt_boxes.shape[0] > 0 and len(valid_idx) > 0:
+            ious = compute_iou_vectorized(valid_anchors, gt_boxes)  # shape [N_valid, M]
+            max_ious  = np.max(ious, axis=1)
+            argmax_ious = np.argmax(ious, axis=1)
+
+            # Label: pos => iou>=0.7, neg => iou<0.3
+            valid_labels = -1*np.ones_like(max_ious, dtype=np.int32)
+            valid_labels[max_ious >= pos_iou_th] = 1
+            valid_labels[max_ious <  neg_iou_th] = 0
+
+            # Force each gt box to have at least one positive anchor
+            gt_max_ious = np.max(ious, axis=0)
+            valid_labels[np.where(ious == gt_max_ious[None, :])[0]] = 1
+
+            # Subsample
+            pos_inds = np.where(valid_labels == 1)[0]
+            neg_inds = np.where(valid_labels == 0)[0]
+
+            num_pos = int(n_sample*pos_ratio)
+            if len(pos_inds) > num_pos:
+                disable_pos = np.random.choice(pos_inds, size=len(pos_inds)-num_pos, replace=False)
+                valid_labels[disable_pos] = -1
+
+            num_neg = n_sample - np.sum(valid_labels==1)
+            if len(neg_inds) > num_neg:
+                disable_neg = np.random.choice(neg_inds, size=len(neg_inds)-num_neg, replace=False)
+                valid_labels[disable_neg] = -1
+
+            # Compute loc for positives
+            valid_locs = np.zeros((valid_anchors.shape[0], 4), dtype=np.float32)
+            pos_final = np.where(valid_labels == 1)[0]
+            if len(pos_final) > 0:
+                posA = valid_anchors[pos_final]
+                anc_w = posA[:,2] - posA[:,0]
+                anc_h = posA[:,3] - posA[:,1]
+                anc_ctr_x = posA[:,0] + 0.5*anc_w
+                anc_ctr_y = posA[:,1] + 0.5*anc_h
+
+                match_gt = gt_boxes[argmax_ious[pos_final]]
+                gt_w = match_gt[:,2] - match_gt[:,0]
+                gt_h = match_gt[:,3] - match_gt[:,1]
+                gt_ctr_x = match_gt[:,0] + 0.5*gt_w
+                gt_ctr_y = match_gt[:,1] + 0.5*gt_h
+
+                dx = (gt_ctr_x - anc_ctr_x)/anc_w
+                dy = (gt_ctr_y - anc_ctr_y)/anc_h
+                dw = np.log(gt_w/anc_w)
+                dh = np.log(gt_h/anc_h)
+                valid_locs[pos_final] = np.stack([dy, dx, dh, dw], axis=1)
+
+            labels[valid_idx] = valid_labels
+            locs[valid_idx]   = valid_locs
+
+        anchor_labels_all.append(labels)
+        anchor_locs_all.append(locs)
+
+    anchor_labels_all = np.stack(anchor_labels_all, axis=0)  # (B, total_anchors)
+    anchor_locs_all   = np.stack(anchor_locs_all,   axis=0)  # (B, total_anchors, 4)
+    return anchor_locs_all, anchor_labels_all, anchors
+
+
+# -----------------------
+# Loss
+# -----------------------
+
+def rpn_loss(pred_locs, pred_scores, gt_locs, gt_scores, rpn_lambda=10):
+    """
+    Cross-entropy on labelled anchors (ignore -1) + smooth L1 on positives.
+    Predictions are cast to fp32 first, so the loss is fp32 under autocast.
+    Returns (loss, cls_loss, loc_loss) with loc_loss already scaled by rpn_lambda.
+    """
+    pred_locs = pred_locs.float()
+    pred_scores = pred_scores.float()
+    cls_loss = F.cross_entropy(pred_scores.view(-1, 2), gt_scores.view(-1).long(), ignore_index=-1)
+
+    pos_mask = gt_scores > 0
+    if pos_mask.sum() > 0:
+        diff = torch.abs(gt_locs[pos_mask] - pred_locs[pos_mask])
+        loc_loss = torch.where(diff < 1, 0.5 * diff**2, diff - 0.5).sum() / pos_mask.sum().float()
+    else:
+        loc_loss = torch.tensor(0.0, device=pred_locs.device)
+
+    loc_loss = rpn_lambda * loc_loss
+    return cls_loss + loc_loss, cls_loss, loc_loss
+
+
+# -----------------------
+# Train / evaluate
+# -----------------------
+
+def train_step(backbone, rpn_model, optimizer, batch, device, rpn_lambda=10, precision="fp32", timer=NULL_TIMER,
+               accumulation_steps=1, accumulation_index=0):
+    """
+    One optimisation step. Returns (loss, cls_loss, loc_loss, pred_locs,
+    objectness_score, anchors); losses are detached tensors. Stages are
+    timed with `timer` (a profiling.StageTimer; disabled by default).
+
+    With accumulation_steps > 1 the batch is micro-batch accumulation_index
+    of a group: gradients are zeroed on the first, the loss is divided by
+    accumulation_steps and the optimizer steps after the last.
+    """
+    with timer.stage("to_device"):
+        images = batch["images"].to(device)
+        targets = [{"boxes": b, "labels": l} for b, l in zip(batch["boxes"], batch["labels"])]
+
+    # Forward through the backbone, with autograd only if part of it is trainable
+    backbone_trainable = any(p.requires_grad for p in backbone.parameters())
+    with timer.stage("backbone"), torch.set_grad_enabled(backbone_trainable), precision_autocast(precision, device):
+        feat = backbone(images)
+    X_FM, Y_FM = feat.shape[3], feat.shape[2]
+
+    with timer.stage("targets"):
+        gt_locs_np, gt_scores_np, anchors = bbox_generation([img for img in images], targets, X_FM, Y_FM,
+                                                            stride=getattr(backbone, "stride", None))
+    with timer.stage("targets_h2d"):
+        gt_locs = torch.from_numpy(gt_locs_np).to(device)
+        gt_scores = torch.from_numpy(gt_scores_np.astype(np.float32)).to(device)
+
+    with timer.stage("rpn_forward"), precision_autocast(precision, device):
+        pred_locs, pred_scores, objectness_score = rpn_model(feat)[:3]
+    with timer.stage("loss"):
+        loss, cls_loss, loc_loss = rpn_loss(pred_locs, pred_scores, gt_locs, gt_scores, rpn_lambda)
+
+    with timer.stage("backward"):
+        if accumulation_index == 0:
+            optimizer.zero_grad()
+        (loss / accumulation_steps if accumulation_steps > 1 else loss).backward()
+        if accumulation_index == accumulation_steps - 1:
+            optimizer.step()
+    return loss.detach(), cls_loss.detach(), loc_loss.detach(), pred_locs.detach(), objectness_score.detach(), anchors
+
+
+def train_epochs(backbone, rpn_model, optimizer, train_dl, epochs=20, rpn_lambda=10, iou_threshold=0.5,
+                 top_k=20, precision="fp32", device=None, save_every=5, recall_every=10, checkpoints=None,
+                 save_steps=None, resume=True, metrics=None, profile=False, trace_dir=None, trace_steps=(5, 2, 5),
+                 autotuned=False, accumulation_steps=1):
+    """
+    Train the RPN on a frozen backbone (or one with a trainable tail, see
+    rpn_models.build_vgg_backbone; its weights are then checkpointed as
+    well and optimizer must include them). Returns (rpn_model, history) where
+    history holds per-epoch "loss", "cls_loss", "loc_loss" and "recall".
+    Losses are summed on device; recall is estimated on every
+    recall_every-th batch by a background thread (see training_metrics).
+
+    With a checkpointing.CheckpointManager, the full training state is
+    saved asynchronously every save_steps batches and at the end of every
+    epoch, and (if resume) training continues from the latest checkpoint,
+    mid-epoch included. Exact mid-epoch resume needs train_dl to use a
+    checkpointing.ResumableSampler; with any other sampler the remaining
+    batches of the interrupted epoch are drawn from a fresh order.
+    `metrics` replaces the default TrainingMetrics (e.g. the all-reduced
+    variant in distributed.py).
+
+    profile=True times every stage of a step (data wait, backbone, anchor
+    targets, RPN forward, loss, backward, metrics, checkpoint) and prints
+    mean / p95 per stage after each epoch (also in history["stages"]).
+    trace_dir writes a torch.profiler trace of the steps given by
+    trace_steps = (wait, warmup, active).
+
+    autotuned=True applies this machine's saved autotune.py "train" thread
+    settings first. That changes process-wide torch thread counts, so it is
+    off by default; the command line applies them itself, before building
+    its DataLoaders (see runtime_config).
+
+    accumulation_steps > 1 takes one optimizer step per accumulation_steps
+    batches of train_dl (gradient accumulation, e.g. with the micro-batch
+    size chosen by batch_sizing.choose_batch_size); the last group of an
+    epoch may be shorter and is averaged over its own size. Step
+    checkpoints are only written at group boundaries.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if autotuned:
+        apply_tuned_settings("train")
+    rpn_model.train()
+    history = {"loss": [], "cls_loss": [], "loc_loss": [], "recall": []}
+    timer = StageTimer(enabled=profile, sync=device.type == "cuda", annotate=trace_dir is not None)
+    profiler = trace_profiler(trace_dir, *trace_steps)
+    if metrics is None:
+        metrics = TrainingMetrics(recall_every=recall_every, top_k=top_k, iou_threshold=iou_threshold)
+    sampler = train_dl.sampler if isinstance(train_dl.sampler, ResumableSampler) else None
+
+    start_epoch, start_step, global_step = 0, 0, 0
+    if checkpoints is not None and resume:
+        state = checkpoints.restore(rpn_model, optimizer, sampler, map_location=device)
+        if state is not None:
+            start_epoch, start_step, global_step = state["epoch"], state["step_in_epoch"], state["global_step"]
+            history.update(state["history"])
+            if state["extra"].get("backbone") is not None:
+                backbone.load_state_dict(state["extra"]["backbone"])
+            if state["extra"].get("metrics") is not None:
+                metrics.load_state_dict(state["extra"]["metrics"], device)
+            print(f"[INFO] Resuming from {checkpoints.latest()} (epoch {start_epoch+1}, step {start_step})")
+    elif checkpoints is not None and checkpoints.latest() is not None:
+        print(f"[WARNING] Not resuming: the checkpoints already in {checkpoints.directory} rank before this "
+              f"run's and are pruned by keep_last")
+
+    backbone_trainable = any(p.requires_grad for p in backbone.parameters())
+
+    def save_checkpoint(epoch, step_in_epoch, end_of_epoch=False):
+        checkpoints.save(rpn_model, optimizer, epoch, step_in_epoch, global_step, sampler=sampler,
+                         history=history, end_of_epoch=end_of_epoch,
+                         metrics=None if end_of_epoch else metrics.state_dict(),
+                         backbone=backbone.state_dict() if backbone_trainable else None)
+
+    try:
+        with profiler:
+            for epoch in range(start_epoch, epochs):
+                print(f"Epoch {epoch+1}/{epochs}")
+                step = start_step if epoch == start_epoch else 0
+                if sampler is not None:
+                    sampler.set_epoch(epoch)
+                    sampler.set_position(step * train_dl.batch_size)
+                batches = iter(train_dl)
+                save_due = False
+                if sampler is None:
+                    for _ in range(step):
+                        next(batches)
+
+                for batch in timer.iterate(batches):
+                    group_start = step - step % accumulation_steps
+                    loss, cls_loss, loc_loss, pred_locs, objectness_score, anchors = train_step(
+                        backbone, rpn_model, optimizer, batch, device, rpn_lambda, precision, timer,
+                        min(accumulation_steps, len(train_dl) - group_start), step - group_start)
+                    with timer.stage("metrics"):
+                        metrics.update_losses(loss=loss, cls_loss=cls_loss, loc_loss=loc_loss)
+                        metrics.update_recall(pred_locs, objectness_score, anchors, batch["boxes"])
+                    step += 1
+                    global_step += 1
+                    save_due = save_due or bool(save_steps and global_step % save_steps == 0)
+                    # Deferred to the end of an accumulation group; the last batch is covered by the epoch checkpoint
+                    if checkpoints is not None and save_due and step % accumulation_steps == 0 and step < len(train_dl):
+                        with timer.stage("checkpoint"):
+                            save_checkpoint(epoch, step)
+                        save_due = False
+                    timer.end_step()
+                    profiler.step()
+
+                summary = metrics.epoch_summary()
+                for key in ("loss", "cls_loss", "loc_loss", "recall"):
+                    history[key].append(summary.get(key, 0.0))
+                print(f"Epoch {epoch+1}: Loss {summary.get('loss', 0.0):.3f} | "
+                      f"Recall: {summary['recall']:.3f} | Error: {1-summary['recall']:.3f}")
+                if profile:
+                    history.setdefault("stages", []).append(timer.print_summary())
+
+                if checkpoints is not None:
+                    save_checkpoint(epoch + 1, 0, end_of_epoch=True)
+                if save_every and (epoch+1) % save_every == 0:
+                    torch.save(rpn_model.state_dict(), f"./rpn_epoch_{epoch+1}.pth")
+    finally:
+        metrics.close()
+        if checkpoints is not None:
+            checkpoints.wait()
+
+    return rpn_model, history
+
+
+def evaluate_rpn(backbone, rpn_model, data_loader, top_k=20, iou_threshold=0.5, precision="fp32",
+                 n_images=None, device=None):
+    """Mean recall@top_k and mean best IoU over data_loader (no plotting)."""
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    was_training = rpn_model.training
+    rpn_model.eval()
+    recalls, best_ious = [], []
+    seen = 0
+    anchors = None
+    with torch.no_grad():
+        for batch in data_loader:
+            images = batch["images"].to(device)
+            with precision_autocast(precision, device):
+                feat = backbone(images)
+                pred_locs, _, objectness_score = rpn_model(feat)[:3]
+            if anchors is None:
+                anchors = generate_anchor_grid_np(feat.shape[3], feat.shape[2], ratios, anchor_scales,
+                                                  stride=getattr(backbone, "stride", None))
+            proposals = topk_proposals(pred_locs.float(), objectness_score.float(), anchors, top_k)
+            for props, gt in zip(proposals, batch["boxes"]):
+                if len(gt) > 0:
+                    gt = gt.numpy()
+                    recalls.append(compute_recall_at_threshold(props, gt, iou_threshold))
+                    best_ious.append(float(compute_iou_vectorized(props, gt).max(axis=0).mean()))
+            seen += images.shape[0]
+            if n_images is not None and seen >= n_images:
+                break
+    rpn_model.train(was_training)
+    return {"recall": float(np.mean(recalls)) if recalls else 0.0,
+            "mean_best_iou": float(np.mean(best_ious)) if best_ious else 0.0}
+
+
+def build_datasets(image_dir, pt_dir, labels_json, n_train=None, n_labels=20000):
+    """The fixed 85/15 train/val split of CustomDataset (seed 0), optionally a train subset."""
+    dataset = CustomDataset(image_dir, extract_first_n_labels(labels_json, n_labels), pt_dir)
+    train_size = int(0.85 * len(dataset))
+    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, len(dataset) - train_size],
+                                                               generator=torch.Generator().manual_seed(0))
+    if n_train:
+        train_dataset = torch.utils.data.Subset(train_dataset, list(range(min(n_train, len(train_dataset)))))
+    return train_dataset, val_dataset
+
+
+def compare_precisions(backbone, rpn_model, train_dl, val_dl, epochs=5, lr=0.001, top_k=20, seed=0, device=None):
+    """
+    Train copies of rpn_model in fp32 and bf16 from the same initialisation
+    and data order; print loss curves and validation recall side by side.
+    """
+    results = {}
+    for precision in PRECISIONS:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        model = copy.deepcopy(rpn_model)
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=1e-4)
+        print(f"[INFO] Training in {precision}")
+        _, history = train_epochs(backbone, model, optimizer, train_dl, epochs=epochs, top_k=top_k,
+                                  precision=precision, device=device, save_every=0)
+        history["val"] = evaluate_rpn(backbone, model, val_dl, top_k=top_k, precision=precision, device=device)
+        results[precision] = history
+
+    print(f"\n{'epoch':>6}{'loss fp32':>11}{'loss bf16':>11}{'diff':>9}")
+    for e in range(epochs):
+        a, b = results["fp32"]["loss"][e], results["bf16"]["loss"][e]
+        print(f"{e+1:>6}{a:>11.4f}{b:>11.4f}{b - a:>+9.4f}")
+    for precision in PRECISIONS:
+        v = results[precision]["val"]
+        print(f"{precision}: val recall@{top_k} {v['recall']:.3f} | mean best IoU {v['mean_best_iou']:.3f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the EnhancedRPN on a frozen VGG16 backbone")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--backbone", choices=sorted(BACKBONES), default="vgg16")
+    parser.add_argument("--precision", choices=PRECISIONS + ("compare",), default="fp32")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--recall-every", type=int, default=10, help="training recall on every n-th batch")
+    parser.add_argument("--n-train", type=int, default=None, help="train on a subset")
+    parser.add_argument("--checkpoint-dir", default=None, help="save/resume full training state here")
+    parser.add_argument("--save-steps", type=int, default=None, help="also checkpoint every n batches")
+    parser.add_argument("--keep-last", type=int, default=3)
+    parser.add_argument("--keep-every-epochs", type=int, default=None)
+    parser.add_argument("--profile", action="store_true", help="per-stage step timings after every epoch")
+    parser.add_argument("--trace-dir", default=None, help="write a torch.profiler trace of a few steps here")
+    parser.add_argument("--auto-batch", action="store_true",
+                        help="largest micro-batch within the memory budget, accumulating to --batch-size")
+    parser.add_argument("--memory-budget-mb", type=float, default=None, help="default: 90%% of available memory")
+    parser.add_argument("--train-backbone-layers", type=int, default=0,
+                        help="also fine-tune the last n VGG layers (3: conv5_3) at lr / 10")
+    parser.add_argument("--activation-checkpointing", action="store_true",
+                        help="recompute the trainable VGG tail and RPN blocks in backward to save memory")
+    args = parser.parse_args()
+
+    apply_tuned_settings("train")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_dataset, val_dataset = build_datasets(args.image_dir, args.pt_dir, args.labels_json, args.n_train)
+    num_workers = tuned_num_workers("train", default=2)
+    batch_size, accumulation_steps = args.batch_size, 1
+    if args.auto_batch:
+        from batch_sizing import choose_batch_size  # imports this module through throughput_bench
+        choice = choose_batch_size({"image_dir": args.image_dir, "pt_dir": args.pt_dir,
+                                    "labels_json": args.labels_json, "n_labels": 20000, "top_k": args.top_k,
+                                    "classifier": "roi_head", "rpn_weights": None, "pretrained": True,
+                                    "trainable_layers": args.train_backbone_layers,
+                                    "activation_checkpointing": args.activation_checkpointing},
+                                   args.batch_size, args.memory_budget_mb, num_workers=num_workers)
+        batch_size, accumulation_steps = choice["batch_size"], choice["accumulation_steps"]
+        print(f"[INFO] Batch size {batch_size} x {accumulation_steps} accumulation steps")
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size,
+                                               sampler=ResumableSampler(train_dataset, seed=0),
+                                               collate_fn=custom_collate_fn, num_workers=num_workers)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=False,
+                                             collate_fn=custom_collate_fn, num_workers=num_workers)
+
+    if args.backbone == "vgg16":
+        backbone = build_vgg_backbone(device=device, trainable_layers=args.train_backbone_layers)
+    elif args.train_backbone_layers:
+        parser.error("--train-backbone-layers is only supported with --backbone vgg16")
+    else:
+        backbone = build_backbone(args.backbone, device=device)
+    rpn_model = build_rpn_for_backbone(backbone).to(device)
+    set_activation_checkpointing(backbone, rpn_model, enabled=args.activation_checkpointing)
+
+    if args.precision == "compare":
+        compare_precisions(backbone, rpn_model, train_loader, val_loader, epochs=args.epochs, lr=args.lr,
+                           top_k=args.top_k, device=device)
+    else:
+        optimizer = torch.optim.Adam(rpn_model.parameters(), lr=args.lr, weight_decay=1e-4)
+        backbone_params = [p for p in backbone.parameters() if p.requires_grad]
+        if backbone_params:
+            optimizer.add_param_group({"params": backbone_params, "lr": args.lr * 0.1})
+        checkpoints = (CheckpointManager(args.checkpoint_dir, keep_last=args.keep_last,
+                                         keep_every_epochs=args.keep_every_epochs) if args.checkpoint_dir else None)
+        rpn_model, _ = train_epochs(backbone, rpn_model, optimizer, train_loader, epochs=args.epochs,
+                                    top_k=args.top_k, precision=args.precision, device=device,
+                                    recall_every=args.recall_every, checkpoints=checkpoints,
+                                    save_steps=args.save_steps, profile=args.profile, trace_dir=args.trace_dir,
+                                    accumulation_steps=accumulation_steps)
+        print(evaluate_rpn(backbone, rpn_model, val_loader, top_k=args.top_k, precision=args.precision, device=device))
+        torch.save(rpn_model.state_dict(), "./final_model.pth")
+        if backbone_params:
+            torch.save(backbone.state_dict(), "./final_backbone.pth")
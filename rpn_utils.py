@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""Data and box helpers shared by the RPN tooling.
+
+Follows the conventions of the deployed pipeline
+(RPN+CBAM+ROI.ipynb / RPN+ROI+Classification_integration.ipynb):
+boxes and anchors are [x1, y1, x2, y2], images are (C, H, W) in [0, 1],
+offsets are [dy, dx, dh, dw].
+"""
+
+import os
+import time
+import contextlib
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+import ijson
+
+# Input image size (height, width)
+ISIZE = (720, 1280)
+
+# Global anchor parameters
+ratios = [0.5, 1, 2]
+anchor_scales = [4, 8, 16, 32, 64]
+
+# Class mapping (same for training & inference)
+name_to_id = {"traffic light": 0,
+    "traffic sign": 1,
+    "car": 2,
+    "person": 3,
+    "bus": 4,
+    "truck": 5,
+    "rider": 6,
+    "bike": 7,
+    "motor": 8,
+    "train": 9
+}
+
+# Classifier patch size and normalization (classification_model+train.ipynb)
+IMAGE_SIZE = (128, 128)
+PATCH_MEAN = [0.5, 0.5, 0.5]
+PATCH_STD = [0.5, 0.5, 0.5]
+
+
+def normalize_tensor(img):
+    """Normalize a tensor image (C, H, W) with values in [0,255]."""
+    img = img / 255.0
+    return img
+
+
+def extract_first_n_labels(json_file_path, n):
+    labels = []
+    with open(json_file_path, 'rb') as f:
+        parser = ijson.items(f, 'item')
+        for i, item in enumerate(parser):
+            if i >= n:
+                break
+            filtered_labels = [
+                {"category": li.get("category"), "box2d": li.get("box2d")}
+                for li in item.get("labels", []) if "box2d" in li
+            ]
+            labels.append({
+                "name": item.get("name"),
+                "timestamp": item.get("timestamp"),
+                "labels": filtered_labels
+            })
+    return labels
+
+
+def standardize_filename(path_or_name):
+    base = os.path.basename(path_or_name)
+    base, _ = os.path.splitext(base)
+    return base
+
+
+# -----------------------
+# Dataset
+# -----------------------
+
+class CustomDataset(torch.utils.data.Dataset):
+    def __init__(self, image_dir, labels, pt_dir='pt_files'):
+        self.image_dir = image_dir
+        self.pt_dir = pt_dir
+        os.makedirs(self.pt_dir, exist_ok=True)
+        self.image_files = sorted([
+            os.path.join(image_dir, f)
+            for f in os.listdir(image_dir)
+            if f.lower().endswith(('.jpg', '.png', '.jpeg'))
+        ])
+        self.label_dict = {}
+        for item in labels:
+            key = standardize_filename(item["name"])
+            self.label_dict[key] = item
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, idx):
+        image_path = self.image_files[idx]
+        pt_path = os.path.join(
+            self.pt_dir,
+            os.path.basename(image_path)
+            .replace('.jpg', '.pt')
+            .replace('.png', '.pt')
+            .replace('.jpeg', '.pt')
+        )
+        if os.path.exists(pt_path):
+            image_tensor = torch.load(pt_path)
+        else:
+            image = Image.open(image_path).convert('RGB')
+            if image.size != (ISIZE[1], ISIZE[0]):  # PIL: (width, height)
+                image = image.resize((ISIZE[1], ISIZE[0]))
+            image_tensor = transforms.PILToTensor()(image).float()
+            torch.save(image_tensor, pt_path)
+        image_tensor = normalize_tensor(image_tensor)
+
+        matched = self.label_dict.get(standardize_filename(image_path), None)
+        box_list = []
+        cat_list = []
+        if matched is not None and "labels" in matched:
+            for obj in matched["labels"]:
+                if "box2d" in obj:
+                    b2d = obj["box2d"]
+                    box_list.append([float(b2d["x1"]), float(b2d["y1"]),
+                                     float(b2d["x2"]), float(b2d["y2"])])
+                    cat_list.append(obj["category"])
+        if box_list:
+            boxes = torch.tensor(box_list, dtype=torch.float32)
+        else:
+            boxes = torch.zeros((0, 4), dtype=torch.float32)
+        labels = torch.ones((len(box_list),), dtype=torch.int64)
+
+        return {
+            "image": image_tensor,  # (C,H,W) in [0,1]
+            "boxes": boxes,         # shape (N,4) in [x1,y1,x2,y2]
+            "labels": labels,       # shape (N,)
+            "names": cat_list,
+            "index": idx,
+            "img_name": os.path.basename(image_path)
+        }
+
+
+def custom_collate_fn(batch):
+    images = [item["image"] for item in batch]
+    boxes  = [item["boxes"] for item in batch]
+    labels = [item["labels"] for item in batch]
+    names  = [item["names"] for item in batch]
+    idxs   = [item["index"] for item in batch]
+    img_ids = [item["img_name"] for item in batch]
+    return {
+        "images": torch.stack(images, dim=0),
+        "boxes": boxes,
+        "labels": labels,
+        "names": names,
+        "indices": idxs,
+        "img_ids": img_ids
+    }
+
+
+# -----------------------
+# Anchors & decoding
+# -----------------------
+
+def generate_anchor_grid_np(X_FM, Y_FM, ratios, scales, stride=None, base_size=16):
+    """
+    Return anchors as shape (N,4), each row [x1,y1,x2,y2].
+    Ordering matches the RPN head output: position-major, then ratio, then scale.
+
+    Without `stride` the cell size is ISIZE / feature size and anchors are
+    cell_size * scale (the original behaviour). With a backbone `stride`,
+    centres sit on that stride and anchors are base_size * scale pixels, so
+    anchor sizes stay the same whichever backbone produced the feature map.
+    """
+    H_IMG, W_IMG = ISIZE[0], ISIZE[1]
+    if stride is None:
+        sub_sampling_x = W_IMG / float(X_FM)
+        sub_sampling_y = H_IMG / float(Y_FM)
+        size_x, size_y = sub_sampling_x, sub_sampling_y
+    else:
+        sub_sampling_x = sub_sampling_y = float(stride)
+        size_x = size_y = float(base_size)
+
+    shift_x = np.arange(sub_sampling_x, (X_FM+1)*sub_sampling_x, sub_sampling_x)[:X_FM]
+    shift_y = np.arange(sub_sampling_y, (Y_FM+1)*sub_sampling_y, sub_sampling_y)[:Y_FM]
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+
+    centers = np.stack([
+        shift_x.ravel() - sub_sampling_x/2.0,
+        shift_y.ravel() - sub_sampling_y/2.0
+    ], axis=1)  # shape (total_positions,2) => (cx,cy)
+
+    ratio_grid, scale_grid = np.meshgrid(np.asarray(ratios, dtype=np.float64),
+                                         np.asarray(scales, dtype=np.float64), indexing='ij')
+    h = (size_y * scale_grid * np.sqrt(ratio_grid)).ravel()
+    w = (size_x * scale_grid * np.sqrt(1.0/ratio_grid)).ravel()
+
+    cx = centers[:, 0:1]
+    cy = centers[:, 1:2]
+    anchors = np.stack([cx - 0.5*w, cy - 0.5*h, cx + 0.5*w, cy + 0.5*h], axis=-1)
+    return anchors.reshape(-1, 4).astype(np.float32)
+
+
+def pred_bbox_to_xywh(bbox_offsets, anchors):
+    """
+    bbox_offsets: (N,4) predicted offsets [dy, dx, dh, dw]
+    anchors: (N,4) in [x1,y1,x2,y2]
+    return (N,4) boxes in [x1,y1,x2,y2]
+    """
+    anchors_np = anchors.detach().cpu().numpy() if isinstance(anchors, torch.Tensor) else np.asarray(anchors)
+    bbox_np    = bbox_offsets.detach().cpu().numpy()
+
+    anc_w = anchors_np[:,2] - anchors_np[:,0]
+    anc_h = anchors_np[:,3] - anchors_np[:,1]
+    anc_ctr_x = anchors_np[:,0] + 0.5*anc_w
+    anc_ctr_y = anchors_np[:,1] + 0.5*anc_h
+
+    ctr_y = bbox_np[:,0]*anc_h + anc_ctr_y
+    ctr_x = bbox_np[:,1]*anc_w + anc_ctr_x
+    h = np.exp(bbox_np[:,2])*anc_h
+    w = np.exp(bbox_np[:,3])*anc_w
+
+    out = np.zeros_like(bbox_np, dtype=np.float32)
+    out[:,0] = ctr_x - 0.5*w  # x1
+    out[:,1] = ctr_y - 0.5*h  # y1
+    out[:,2] = ctr_x + 0.5*w  # x2
+    out[:,3] = ctr_y + 0.5*h  # y2
+    return out
+
+
+def decode_boxes(pred_locs, anchors):
+    """
+    pred_locs: (..., 4) offsets [dy, dx, dh, dw], anchors: (..., 4) [x1,y1,x2,y2].
+    Same maths as pred_bbox_to_xywh, in torch on the offsets' device.
+    """
+    anc_w = anchors[..., 2] - anchors[..., 0]
+    anc_h = anchors[..., 3] - anchors[..., 1]
+    anc_ctr_x = anchors[..., 0] + 0.5*anc_w
+    anc_ctr_y = anchors[..., 1] + 0.5*anc_h
+
+    ctr_y = pred_locs[..., 0]*anc_h + anc_ctr_y
+    ctr_x = pred_locs[..., 1]*anc_w + anc_ctr_x
+    h = torch.exp(pred_locs[..., 2])*anc_h
+    w = torch.exp(pred_locs[..., 3])*anc_w
+    return torch.stack([ctr_x - 0.5*w, ctr_y - 0.5*h, ctr_x + 0.5*w, ctr_y + 0.5*h], dim=-1)
+
+
+def clip_boxes(boxes, image_size):
+    """Clamp (..., 4) [x1,y1,x2,y2] boxes to an (H, W) image."""
+    height, width = image_size
+    return torch.stack([boxes[..., 0].clamp(0, width), boxes[..., 1].clamp(0, height),
+                        boxes[..., 2].clamp(0, width), boxes[..., 3].clamp(0, height)], dim=-1)
+
+
+def decode_topk(pred_locs, objectness_score, anchors, top_k=400, image_size=None):
+    """
+    Select the top_k anchors of every image first, then decode (and clip
+    to image_size, if given) only those, on the scores' device.
+    top_k=None keeps every anchor.
+    Returns boxes (B,k,4) [x1,y1,x2,y2], scores (B,k) and anchor indices (B,k).
+    """
+    n = objectness_score.shape[1]
+    k = n if top_k is None else min(top_k, n)
+    scores, topk_inds = torch.topk(objectness_score, k=k, dim=1)
+    locs = torch.gather(pred_locs, 1, topk_inds.unsqueeze(-1).expand(-1, -1, 4))
+    boxes = decode_boxes(locs, anchors.to(pred_locs.device)[topk_inds])
+    if image_size is not None:
+        boxes = clip_boxes(boxes, image_size)
+    return boxes, scores, topk_inds
+
+
+def decode_above(pred_locs, objectness_score, anchors, score_thresh=0.5, image_size=None):
+    """
+    Decode only the anchors with objectness > score_thresh.
+    Returns a list with one (boxes (K_i,4), scores (K_i,)) pair per image.
+    """
+    b_idx, a_idx = (objectness_score > score_thresh).nonzero(as_tuple=True)
+    boxes = decode_boxes(pred_locs[b_idx, a_idx], anchors.to(pred_locs.device)[a_idx])
+    if image_size is not None:
+        boxes = clip_boxes(boxes, image_size)
+    counts = torch.bincount(b_idx, minlength=objectness_score.shape[0]).tolist()
+    return list(zip(boxes.split(counts), objectness_score[b_idx, a_idx].split(counts)))
+
+
+def topk_proposals(pred_locs, objectness_score, anchors, top_k=400):
+    """
+    Decode the top_k highest-scoring anchors of every image.
+    Returns a list of (k,4) NumPy arrays in [x1,y1,x2,y2].
+    """
+    boxes, _, _ = decode_topk(pred_locs, objectness_score, torch.as_tensor(anchors), top_k)
+    return list(boxes.detach().cpu().numpy())
+
+
+# -----------------------
+# IoU & proposal metrics
+# -----------------------
+
+def compute_iou_vectorized(boxes1, boxes2):
+    """boxes1 (N,4), boxes2 (M,4) in [x1,y1,x2,y2]. Return IoU matrix (N,M)."""
+    boxes1 = np.asarray(boxes1, dtype=np.float32).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float32).reshape(-1, 4)
+
+    inter_x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    inter_y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    inter_x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    inter_y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+
+    inter_w = np.maximum(inter_x2 - inter_x1, 0)
+    inter_h = np.maximum(inter_y2 - inter_y1, 0)
+    inter_area = inter_w*inter_h
+
+    area1 = (boxes1[:,2] - boxes1[:,0])*(boxes1[:,3] - boxes1[:,1])
+    area2 = (boxes2[:,2] - boxes2[:,0])*(boxes2[:,3] - boxes2[:,1])
+    union = area1[:,None] + area2[None,:] - inter_area
+    return inter_area / (union + 1e-6)
+
+
+def compute_recall_at_threshold(proposals, gt_boxes, iou_thresh=0.5):
+    """
+    Fraction of GT boxes whose best IoU among the proposals is >= iou_thresh.
+    """
+    if len(gt_boxes) == 0:
+        return 0.0
+    if len(proposals) == 0:
+        return 0.0
+    ious = compute_iou_vectorized(proposals, gt_boxes)  # (N, M)
+    best_ious = ious.max(axis=0)
+    return float(np.sum(best_ious >= iou_thresh)) / float(len(gt_boxes))
+
+
+# -----------------------
+# Prediction / GT matching
+# -----------------------
+
+def _pad_boxes(boxes_list, n_max):
+    padded = np.zeros((len(boxes_list), max(n_max, 1), 4), dtype=np.float32)
+    valid = np.zeros((len(boxes_list), max(n_max, 1)), dtype=bool)
+    for b, boxes in enumerate(boxes_list):
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        padded[b, :len(boxes)] = boxes
+        valid[b, :len(boxes)] = True
+    return padded, valid
+
+
+def batch_iou_matrix(pred_boxes_list, gt_boxes_list, pred_labels_list=None, gt_labels_list=None):
+    """
+    One padded IoU tensor (B, N_max, M_max) for a batch of images.
+    Padding pairs, and with labels given, pairs of different classes, are -1.
+    """
+    n_max = max((len(b) for b in pred_boxes_list), default=0)
+    m_max = max((len(b) for b in gt_boxes_list), default=0)
+    preds, pred_valid = _pad_boxes(pred_boxes_list, n_max)
+    gts, gt_valid = _pad_boxes(gt_boxes_list, m_max)
+
+    inter_w = np.maximum(np.minimum(preds[:, :, None, 2], gts[:, None, :, 2]) -
+                         np.maximum(preds[:, :, None, 0], gts[:, None, :, 0]), 0)
+    inter_h = np.maximum(np.minimum(preds[:, :, None, 3], gts[:, None, :, 3]) -
+                         np.maximum(preds[:, :, None, 1], gts[:, None, :, 1]), 0)
+    inter_area = inter_w*inter_h
+    area_p = (preds[..., 2] - preds[..., 0])*(preds[..., 3] - preds[..., 1])
+    area_g = (gts[..., 2] - gts[..., 0])*(gts[..., 3] - gts[..., 1])
+    ious = inter_area / (area_p[:, :, None] + area_g[:, None, :] - inter_area + 1e-6)
+
+    valid = pred_valid[:, :, None] & gt_valid[:, None, :]
+    if pred_labels_list is not None and gt_labels_list is not None:
+        # Labels may be class names or ids; compare them as ids
+        vocab = {}
+        pred_labels = np.full(pred_valid.shape, -1)
+        gt_labels = np.full(gt_valid.shape, -2)
+        for b, (pl, gl) in enumerate(zip(pred_labels_list, gt_labels_list)):
+            pred_labels[b, :len(pl)] = [vocab.setdefault(l, len(vocab)) for l in list(pl)]
+            gt_labels[b, :len(gl)] = [vocab.setdefault(l, len(vocab)) for l in list(gl)]
+        valid &= pred_labels[:, :, None] == gt_labels[:, None, :]
+    return np.where(valid, ious, -1.0).astype(np.float32)
+
+
+def greedy_match(ious, iou_threshold=0.5):
+    """
+    One-to-one matching with the semantics of match_predictions_to_ground_truth:
+    predictions in order each take their best still-unmatched GT, if that
+    IoU is >= iou_threshold (ties go to the lower GT index).
+
+    ious: (N, M) or (B, N, M) from batch_iou_matrix (-1 = not allowed).
+    Returns the matched GT index of every prediction, -1 when unmatched.
+
+    Instead of a loop over predictions this runs in rounds: in every round
+    all open predictions pick their best free GT, and the ones before the
+    first collision in each image are final.
+    """
+    single = ious.ndim == 2
+    if single:
+        ious = ious[None]
+    B, N, M = ious.shape
+    match = np.full((B, N), -1, dtype=np.int64)
+    if N == 0 or M == 0:
+        return match[0] if single else match
+
+    taken = np.zeros((B, M), dtype=bool)
+    open_preds = ious.max(axis=2) >= max(iou_threshold, 1e-12)
+    earlier = np.tril(np.ones((N, N), dtype=bool), k=-1)
+    positions = np.arange(N)
+    while open_preds.any():
+        available = np.where(taken[:, None, :], -1.0, ious)
+        best = available.argmax(axis=2)
+        best_iou = np.take_along_axis(available, best[..., None], axis=2)[..., 0]
+        open_preds &= best_iou >= max(iou_threshold, 1e-12)
+
+        collides = ((best[:, :, None] == best[:, None, :]) & open_preds[:, None, :] & earlier).any(axis=2) & open_preds
+        first_collision = np.where(collides.any(axis=1), collides.argmax(axis=1), N)
+        final = open_preds & (positions[None, :] < first_collision[:, None])
+
+        b_idx, p_idx = np.nonzero(final)
+        match[b_idx, p_idx] = best[b_idx, p_idx]
+        taken[b_idx, best[b_idx, p_idx]] = True
+        open_preds &= ~final
+    return match[0] if single else match
+
+
+def match_predictions_to_ground_truth(pred_boxes, gt_boxes, iou_threshold=0.5, pred_labels=None, gt_labels=None):
+    """
+    Match predicted boxes to ground truth boxes based on IoU, optionally
+    only within the same class. Returns {pred_index: gt_index}.
+    """
+    labels = None if pred_labels is None or gt_labels is None else ([pred_labels], [gt_labels])
+    ious = batch_iou_matrix([pred_boxes], [gt_boxes], *(labels or (None, None)))[0]
+    match = greedy_match(ious, iou_threshold)
+    return {int(i): int(match[i]) for i in np.nonzero(match >= 0)[0]}
+
+
+def compute_tp_fp_fn(matched_preds, num_pred, num_gt):
+    """Calculate TP, FP, FN from matched predictions."""
+    TP = len(matched_preds)
+    FP = num_pred - TP
+    FN = num_gt - TP
+    return TP, FP, FN
+
+
+def batch_tp_fp_fn(pred_boxes_list, gt_boxes_list, iou_threshold=0.5, pred_labels_list=None, gt_labels_list=None):
+    """
+    TP, FP, FN per image for a whole batch: one padded IoU tensor and one
+    greedy_match call. Returns three (B,) int arrays.
+    """
+    ious = batch_iou_matrix(pred_boxes_list, gt_boxes_list, pred_labels_list, gt_labels_list)
+    tp = (greedy_match(ious, iou_threshold) >= 0).sum(axis=1)
+    num_pred = np.array([len(b) for b in pred_boxes_list])
+    num_gt = np.array([len(b) for b in gt_boxes_list])
+    return tp, num_pred - tp, num_gt - tp
+
+
+# -----------------------
+# Precision
+# -----------------------
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def precision_autocast(precision="fp32", device=None):
+    """
+    Autocast context for a precision option: "bf16" runs convs/matmuls in
+    bfloat16 (CPU autocast on Xeons with AVX512-BF16/AMX, CUDA autocast on
+    GPUs), "fp32" is a no-op. Cast outputs back with .float() before losses
+    and box decoding.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', choose from {PRECISIONS}")
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    device_type = torch.device(device).type if device is not None else "cpu"
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+
+def measure_latency(module, example, n_warmup=2, n_iters=10):
+    """Mean forward latency of module(example) in milliseconds."""
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            module(example)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            module(example)
+    return (time.perf_counter() - start) / n_iters * 1000.0
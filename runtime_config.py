@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Persisted per-machine CPU thread / DataLoader worker settings.
+
+autotune.py measures a few short trial runs and saves the fastest
+(intra-op threads, inter-op threads, num_workers) per mode ("train" /
+"infer") here; the command-line entry points (rpn_training.py,
+detection.py, evaluation.py) apply them through apply_tuned_settings /
+tuned_num_workers, and fall back to the torch defaults when nothing was
+tuned. Library functions leave the process's thread settings alone
+(train_epochs only with autotuned=True).
+
+Settings are keyed by machine (architecture, CPU model, usable cores,
+torch version), so one file can be shared between machines and a setting
+tuned on one never leaks onto another. The file defaults to
+~/.cache/aps360/runtime_config.json; APS360_RUNTIME_CONFIG overrides it.
+"""
+
+import json
+import os
+import platform
+
+import torch
+
+DEFAULT_PATH = os.environ.get("APS360_RUNTIME_CONFIG",
+                              os.path.join(os.path.expanduser("~"), ".cache", "aps360", "runtime_config.json"))
+
+
+def usable_cores():
+    """Cores this process may run on (the affinity mask, e.g. a container's cpuset)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def machine_key():
+    cpu_model = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu_model = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")),
+                             cpu_model)
+    except OSError:
+        pass
+    return f"{platform.machine()}|{cpu_model}|{usable_cores()} cores|torch {torch.__version__}"
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_settings(mode, path=None):
+    """Tuned settings of `mode` for this machine, or None."""
+    return _read(path or DEFAULT_PATH).get(machine_key(), {}).get(mode)
+
+
+def save_settings(mode, settings, path=None):
+    """Store settings of `mode` for this machine (atomic replace; other machines' entries are kept)."""
+    path = path or DEFAULT_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    config = _read(path)
+    config.setdefault(machine_key(), {})[mode] = settings
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def clear_settings(mode=None, path=None):
+    """Forget this machine's settings (of one mode, or all)."""
+    path = path or DEFAULT_PATH
+    config = _read(path)
+    if mode is None:
+        config.pop(machine_key(), None)
+    else:
+        config.get(machine_key(), {}).pop(mode, None)
+    if config:
+        with open(path, "w") as f:
+            json.dump(config, f, indent=2)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def apply_tuned_settings(mode, path=None):
+    """
+    Set this process's intra- and inter-op thread counts to the tuned
+    settings of `mode`. Returns the settings (None if not tuned). The
+    inter-op count can only be changed before the first parallel op, so
+    call this early; later it is left alone with a warning.
+    """
+    settings = load_settings(mode, path)
+    if settings is None:
+        return None
+    torch.set_num_threads(settings["threads"])
+    if torch.get_num_interop_threads() != settings["interop_threads"]:
+        try:
+            torch.set_num_interop_threads(settings["interop_threads"])
+        except RuntimeError:
+            print(f"[WARNING] Inter-op threads already in use, keeping {torch.get_num_interop_threads()}")
+    print(f"[INFO] Tuned {mode} settings: threads={settings['threads']} "
+          f"interop={settings['interop_threads']} workers={settings['num_workers']}")
+    return settings
+
+
+def tuned_num_workers(mode, default, path=None):
+    """DataLoader num_workers tuned for `mode`, else default."""
+    settings = load_settings(mode, path)
+    return default if settings is None else settings["num_workers"]
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Synthetic BDD100K-shaped dataset for offline scale testing.
+
+Writes a labels JSON in the schema of bdd100k_labels_images_train.json
+(name, attributes, timestamp, labels with category / attributes / box2d /
+id, plus box-less poly2d lane and drivable-area entries that
+extract_first_n_labels filters out) and one image per entry, so
+extract_first_n_labels, CustomDataset and the training / benchmark tools
+run without Drive or network access.
+
+Images are a sky/road gradient with one filled rectangle per box, i.e.
+cheap to render but not blank, JPEG or PNG at the BDD frame size. With
+pt_dir the CustomDataset .pt cache is written as well (float32 (3, H, W)
+in [0, 255], ~11 MB per full-size frame). The box count per image is
+Poisson(boxes_per_image), clipped to [min_boxes, max_boxes]; categories
+follow the BDD100K train frequencies. Every image depends only on
+(seed, index), so runs with any number of workers are identical.
+
+Labels are always in ISIZE pixel coordinates, because CustomDataset
+resizes every image to ISIZE and uses the box2d values unchanged. A
+smaller image_size (cheaper files) only changes the rendered resolution.
+Boxes are drawn scaled to it, so after the resize they are where the
+labels say.
+
+Usage:
+    python synthetic_data.py --output-dir synthetic_bdd --n-images 10000 --boxes-per-image 20 --workers 8
+    python rpn_training.py --image-dir synthetic_bdd/images --pt-dir synthetic_bdd/pt \\
+        --labels-json synthetic_bdd/labels.json
+"""
+
+import argparse
+import json
+import os
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+from rpn_utils import ISIZE
+
+# Approximate BDD100K train box counts per category
+CATEGORY_COUNTS = {
+    "car": 714121, "traffic sign": 239961, "traffic light": 186301, "person": 91435, "truck": 30012,
+    "bus": 11688, "bike": 7227, "rider": 4522, "motor": 3002, "train": 136,
+}
+# Height / width of a typical box per category
+ASPECT_RATIOS = {
+    "car": 0.8, "traffic sign": 1.0, "traffic light": 2.0, "person": 2.5, "truck": 0.9,
+    "bus": 0.9, "bike": 1.2, "rider": 2.0, "motor": 1.2, "train": 0.6,
+}
+WEATHER = ["clear", "overcast", "partly cloudy", "rainy", "snowy", "foggy", "undefined"]
+SCENES = ["city street", "highway", "residential", "parking lot", "tunnel", "gas stations", "undefined"]
+TIMES_OF_DAY = ["daytime", "night", "dawn/dusk", "undefined"]
+COLORS = {category: tuple(int(c) for c in np.random.default_rng(i).integers(40, 255, 3))
+          for i, category in enumerate(CATEGORY_COUNTS)}
+
+
+# -----------------------
+# Labels
+# -----------------------
+
+def random_box(category, rng, image_size=ISIZE):
+    """box2d dict of a log-uniform height (2-60% of the frame) with the category's aspect ratio."""
+    H, W = image_size
+    height = np.exp(rng.uniform(np.log(0.02 * H), np.log(0.6 * H)))
+    width = min(height / ASPECT_RATIOS[category] * rng.uniform(0.8, 1.25), 0.9 * W)
+    height = min(height, 0.9 * H)
+    x1 = rng.uniform(0, W - width)
+    y1 = rng.uniform(0, H - height)
+    return {"x1": round(x1, 3), "y1": round(y1, 3), "x2": round(x1 + width, 3), "y2": round(y1 + height, 3)}
+
+
+def make_item(index, seed=0, boxes_per_image=10.0, min_boxes=0, max_boxes=100, poly_labels=True,
+              extension=".jpg"):
+    """One labels-JSON entry in ISIZE coordinates; deterministic in (seed, index)."""
+    rng = np.random.default_rng([seed, index])
+    categories = list(CATEGORY_COUNTS)
+    p = np.array(list(CATEGORY_COUNTS.values()), dtype=np.float64)
+    n_boxes = int(np.clip(rng.poisson(boxes_per_image), min_boxes, max_boxes))
+
+    labels = []
+    for label_id, category in enumerate(rng.choice(categories, size=n_boxes, p=p / p.sum())):
+        attributes = {"occluded": bool(rng.random() < 0.5), "truncated": bool(rng.random() < 0.1),
+                      "trafficLightColor": str(rng.choice(["green", "red", "yellow"])) if category == "traffic light"
+                      else "none"}
+        labels.append({"category": str(category), "attributes": attributes, "manualShape": True,
+                        "manualAttributes": True, "box2d": random_box(category, rng),
+                        "id": index * 1000 + label_id})
+    if poly_labels:
+        H, W = ISIZE
+        for category in ("drivable area", "lane"):
+            vertices = [[round(float(x), 3), round(float(y), 3)]
+                        for x, y in zip(rng.uniform(0, W, 4), rng.uniform(H / 2, H, 4))]
+            labels.append({"category": category, "attributes": {}, "manualShape": True, "manualAttributes": True,
+                           "poly2d": [{"vertices": vertices, "types": "LLLL", "closed": category != "lane"}],
+                           "id": index * 1000 + len(labels)})
+
+    return {
+        "name": f"{index:08x}-{int(rng.integers(2**32)):08x}{extension}",
+        "attributes": {"weather": str(rng.choice(WEATHER)), "scene": str(rng.choice(SCENES)),
+                       "timeofday": str(rng.choice(TIMES_OF_DAY))},
+        "timestamp": 10000,
+        "labels": labels,
+    }
+
+
+# -----------------------
+# Images
+# -----------------------
+
+def render_image(item, image_size=ISIZE):
+    """
+    Gradient background plus one filled rectangle per box2d (largest
+    first), with the ISIZE box coordinates scaled to image_size.
+    """
+    H, W = image_size
+    sx, sy = W / ISIZE[1], H / ISIZE[0]
+    rows = np.linspace(0, 1, H, dtype=np.float32)[:, None, None]
+    sky, road = np.array([135, 170, 210], np.float32), np.array([70, 70, 75], np.float32)
+    pixels = np.broadcast_to(sky * (1 - rows) + road * rows, (H, W, 3)).astype(np.uint8)
+    image = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+    boxes = [obj for obj in item["labels"] if "box2d" in obj]
+    boxes.sort(key=lambda obj: (obj["box2d"]["x2"] - obj["box2d"]["x1"]) * (obj["box2d"]["y2"] - obj["box2d"]["y1"]),
+               reverse=True)
+    for obj in boxes:
+        b = obj["box2d"]
+        draw.rectangle([b["x1"] * sx, b["y1"] * sy, b["x2"] * sx, b["y2"] * sy], fill=COLORS[obj["category"]],
+                       outline=(0, 0, 0))
+    return image
+
+
+def _write_image(job):
+    item, image_dir, pt_dir, image_size = job
+    path = os.path.join(image_dir, item["name"])
+    render_image(item, image_size).save(path, quality=90)
+    if pt_dir is not None:
+        # The tensor CustomDataset would cache: the decoded file, at ISIZE, PILToTensor().float()
+        image = Image.open(path).convert("RGB")
+        if image.size != (ISIZE[1], ISIZE[0]):
+            image = image.resize((ISIZE[1], ISIZE[0]))
+        tensor = torch.from_numpy(np.array(image)).permute(2, 0, 1).float().contiguous()
+        torch.save(tensor, os.path.join(pt_dir, os.path.splitext(item["name"])[0] + ".pt"))
+
+
+def generate_dataset(output_dir, n_images=1000, boxes_per_image=10.0, min_boxes=0, max_boxes=100,
+                     image_format="jpg", pt_dir=None, image_size=ISIZE, poly_labels=True, workers=0, seed=0):
+    """
+    Write output_dir/labels.json and output_dir/images/*; with pt_dir also
+    the .pt cache. image_format None writes the labels only. The JSON is
+    streamed entry by entry; with workers the pool is fed windows of
+    4 x workers x 16 jobs, so at most one window of entries is held in
+    memory. Returns (image_dir, labels_path).
+    """
+    image_dir = os.path.join(output_dir, "images")
+    labels_path = os.path.join(output_dir, "labels.json")
+    os.makedirs(image_dir, exist_ok=True)
+    if pt_dir is not None:
+        os.makedirs(pt_dir, exist_ok=True)
+    extension = "." + (image_format or "jpg")
+
+    def items():
+        for index in range(n_images):
+            yield make_item(index, seed, boxes_per_image, min_boxes, max_boxes, poly_labels, extension)
+
+    def jobs():
+        with open(labels_path, "w") as f:
+            f.write("[")
+            for index, item in enumerate(items()):
+                f.write((",\n" if index else "\n") + json.dumps(item))
+                if image_format is not None:
+                    yield item, image_dir, pt_dir, image_size
+            f.write("\n]\n")
+
+    start = time.perf_counter()
+    if workers:
+        # imap_unordered would drain the whole generator into its task queue
+        pending = jobs()
+        with Pool(workers) as pool:
+            while True:
+                window = list(islice(pending, 4 * workers * 16))
+                if not window:
+                    break
+                for _ in pool.imap_unordered(_write_image, window, chunksize=16):
+                    pass
+    else:
+        for job in jobs():
+            _write_image(job)
+    print(f"[INFO] Wrote {n_images} entries to {labels_path} in {time.perf_counter() - start:.1f}s")
+    return image_dir, labels_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic BDD100K-shaped dataset")
+    parser.add_argument("--output-dir", default="synthetic_bdd")
+    parser.add_argument("--n-images", type=int, default=1000)
+    parser.add_argument("--boxes-per-image", type=float, default=10.0, help="mean (Poisson) box2d count")
+    parser.add_argument("--min-boxes", type=int, default=0)
+    parser.add_argument("--max-boxes", type=int, default=100)
+    parser.add_argument("--format", choices=("jpg", "png", "none"), default="jpg")
+    parser.add_argument("--pt-dir", default=None, help="also write the CustomDataset .pt cache here")
+    parser.add_argument("--image-size", type=int, nargs=2, default=list(ISIZE), metavar=("H", "W"),
+                        help="rendered resolution; labels stay in ISIZE coordinates")
+    parser.add_argument("--no-poly", action="store_true", help="omit the lane / drivable-area entries")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.pt_dir and args.n_images * 3 * ISIZE[0] * ISIZE[1] * 4 > 100 * 2**30:
+        print(f"[WARNING] The .pt cache will take ~{args.n_images * 3 * ISIZE[0] * ISIZE[1] * 4 / 2**30:.0f} GB")
+    generate_dataset(args.output_dir, args.n_images, args.boxes_per_image, args.min_boxes, args.max_boxes,
+                     None if args.format == "none" else args.format, args.pt_dir, tuple(args.image_size),
+                     not args.no_poly, args.workers, args.seed)
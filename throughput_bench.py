@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""End-to-end throughput across intra-op threads, DataLoader workers and batch sizes.
+
+For every (mode, threads, workers, batch size) combination one fresh
+process loads a fixed image set through CustomDataset / DataLoader and
+runs either
+    infer: backbone -> RPN -> top-k proposals + recursive_nms -> classifier
+           (detection.detect_objects_batch; ROIClassifierHead by default,
+           or the ResNet18 crop classifier with --classifier crops)
+    train: rpn_training.train_step (backbone, anchor targets, RPN forward,
+           loss, backward; the classifier is not part of RPN training)
+and reports images/s, mean ms per batch for every stage (profiling.StageTimer,
+"data" is the DataLoader wait) and the peak RSS of the main process (over
+the whole run and over the timed batches only) and of its DataLoader
+workers. A fresh process per combination keeps the
+thread setting and the peak RSS of one run from leaking into the next.
+The first `warmup` batches are not timed.
+
+Usage:
+    python throughput_bench.py --threads 1 4 8 --workers 0 2 4 --batch-sizes 1 4 8 --n-images 64 \\
+        --output throughput.json
+    python synthetic_data.py --output-dir synthetic_bdd --n-images 256 && \\
+        python throughput_bench.py --image-dir synthetic_bdd/images --labels-json synthetic_bdd/labels.json \\
+        --pt-dir synthetic_bdd/pt
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import resource
+import time
+
+import torch
+
+from detection import detect_objects_batch
+from profiling import StageTimer
+from rpn_models import (EnhancedRPNWithROI, ObjectClassifier, ROIClassifierHead, build_vgg_backbone,
+                        set_activation_checkpointing)
+from rpn_training import train_step
+from rpn_utils import CustomDataset, custom_collate_fn, extract_first_n_labels
+
+MODES = ("infer", "train")
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size in MB (ru_maxrss is KB on Linux)."""
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def reset_peak_rss():
+    """Reset this process's RSS high-water mark (Linux); False if unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def rss_high_water_mb():
+    """Peak RSS since the last reset_peak_rss (VmHWM), else since process start."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def build_models(config):
+    """config["trainable_layers"] / ["activation_checkpointing"] (optional) apply to training."""
+    backbone = build_vgg_backbone(pretrained=config["pretrained"], trainable_layers=config.get("trainable_layers", 0))
+    rpn = EnhancedRPNWithROI()
+    if config["rpn_weights"]:
+        rpn.load_state_dict(torch.load(config["rpn_weights"], map_location="cpu"))
+    set_activation_checkpointing(backbone, rpn, enabled=config.get("activation_checkpointing", False))
+    classifier = roi_head = None
+    if config["classifier"] == "crops":
+        classifier = ObjectClassifier(pretrained=config["pretrained"]).eval()
+    else:
+        roi_head = ROIClassifierHead().eval()
+    return backbone, rpn, classifier, roi_head
+
+
+def run_config(config, mode, threads, workers, batch_size, interop_threads=None):
+    """
+    One measurement in the current process; returns the result dict.
+    interop_threads must be set before any inter-op work, i.e. in a fresh
+    process. config["max_batches"] (optional) caps the timed batches.
+    """
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    labels = extract_first_n_labels(config["labels_json"], config["n_labels"])
+    dataset = CustomDataset(config["image_dir"], labels, config["pt_dir"])
+    dataset = torch.utils.data.Subset(dataset, list(range(min(config["n_images"], len(dataset)))))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers,
+                                         collate_fn=custom_collate_fn)
+    backbone, rpn, classifier, roi_head = build_models(config)
+    device = torch.device("cpu")
+    if mode == "train":
+        rpn.train()
+        optimizer = torch.optim.Adam(rpn.parameters(), lr=1e-3)
+        backbone_params = [p for p in backbone.parameters() if p.requires_grad]
+        if backbone_params:
+            optimizer.add_param_group({"params": backbone_params, "lr": 1e-4})
+    else:
+        rpn.eval()
+
+    timer = StageTimer()
+    n_images, start = 0, None
+    for i, batch in enumerate(timer.iterate(loader)):
+        if i == config["warmup"]:
+            timer.reset()
+            reset_peak_rss()
+            start = time.perf_counter()
+        if mode == "train":
+            train_step(backbone, rpn, optimizer, batch, device, timer=timer)
+        else:
+            detect_objects_batch(batch["images"], backbone, rpn, classifier=classifier, roi_head=roi_head,
+                                 top_k=config["top_k"], timer=timer)
+        timer.end_step()
+        if start is not None:
+            n_images += batch["images"].shape[0]
+            if config.get("max_batches") and i - config["warmup"] + 1 >= config["max_batches"]:
+                break
+    if start is None:
+        raise ValueError(f"{len(dataset)} images give no batches after {config['warmup']} warm-up batch(es)")
+    elapsed = time.perf_counter() - start
+    timed_peak_rss_mb = rss_high_water_mb()
+    del loader  # joins the DataLoader workers, so RUSAGE_CHILDREN covers them
+
+    return {"mode": mode, "threads": threads, "interop_threads": torch.get_num_interop_threads(),
+            "workers": workers, "batch_size": batch_size,
+            "images": n_images, "seconds": elapsed, "images_per_sec": n_images / elapsed,
+            "stages_ms": {name: s["mean_ms"] for name, s in timer.summary().items()},
+            "stages_p95_ms": {name: s["p95_ms"] for name, s in timer.summary().items()},
+            "peak_rss_mb": peak_rss_mb(), "timed_peak_rss_mb": timed_peak_rss_mb,
+            "peak_worker_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+
+def _run_in_child(results, *args):
+    try:
+        results.put(run_config(*args))
+    except Exception as e:
+        results.put({"error": repr(e)})
+
+
+def run_isolated(config, mode, threads, workers, batch_size, interop_threads=None, start_method="spawn"):
+    """run_config in a fresh process; returns its result dict or {"error": ...}."""
+    context = mp.get_context(start_method)
+    results = context.Queue()
+    process = context.Process(target=_run_in_child,
+                              args=(results, config, mode, threads, workers, batch_size, interop_threads))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            if not process.is_alive():
+                result = {"error": f"process exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+
+def sweep(config, modes=MODES, threads=(1,), workers=(0,), batch_sizes=(1,), start_method="spawn"):
+    """Every combination in its own process; returns the result dicts."""
+    rows = []
+    for mode, n_threads, n_workers, batch_size in itertools.product(modes, threads, workers, batch_sizes):
+        print(f"[INFO] {mode}: threads={n_threads} workers={n_workers} batch={batch_size}")
+        result = run_isolated(config, mode, n_threads, n_workers, batch_size, start_method=start_method)
+        if "error" in result:
+            print(f"[WARNING] failed: {result['error']}")
+            continue
+        rows.append(result)
+    return rows
+
+
+def print_results(rows):
+    stages = sorted({name for row in rows for name in row["stages_ms"]})
+    header = f"{'mode':<6}{'thr':>4}{'iop':>4}{'wrk':>4}{'batch':>6}{'img/s':>8}{'RSS MB':>8}{'wrk MB':>8}"
+    print("\n" + header + "".join(f"{name[:11]:>12}" for name in stages) + "   (ms per batch)")
+    for row in rows:
+        line = (f"{row['mode']:<6}{row['threads']:>4}{row['interop_threads']:>4}{row['workers']:>4}"
+                f"{row['batch_size']:>6}{row['images_per_sec']:>8.2f}{row['peak_rss_mb']:>8.0f}{row['peak_worker_rss_mb']:>8.0f}")
+        print(line + "".join(f"{row['stages_ms'].get(name, 0.0):>12.1f}" for name in stages))
+    for mode in sorted({row["mode"] for row in rows}):
+        best = max((row for row in rows if row["mode"] == mode), key=lambda row: row["images_per_sec"])
+        print(f"[INFO] best {mode}: threads={best['threads']} workers={best['workers']} "
+              f"batch={best['batch_size']} ({best['images_per_sec']:.2f} img/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end throughput sweep (threads x workers x batch size)")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--pt-dir", default="trainA_testing2")
+    parser.add_argument("--labels-json", default="bdd100k_labels_images_train.json")
+    parser.add_argument("--n-labels", type=int, default=20000)
+    parser.add_argument("--n-images", type=int, default=64, help="size of the fixed image set")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--threads", type=int, nargs="+", default=[os.cpu_count()])
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--warmup", type=int, default=1, help="untimed batches per run")
+    parser.add_argument("--top-k", type=int, default=40)
+    parser.add_argument("--classifier", choices=("roi_head", "crops"), default="roi_head")
+    parser.add_argument("--rpn-weights", default=None)
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    config = {"image_dir": args.image_dir, "pt_dir": args.pt_dir, "labels_json": args.labels_json,
+              "n_labels": args.n_labels, "n_images": args.n_images, "warmup": args.warmup, "top_k": args.top_k,
+              "classifier": args.classifier, "rpn_weights": args.rpn_weights, "pretrained": True}
+    rows = sweep(config, args.modes, args.threads, args.workers, args.batch_sizes)
+    print_results(rows)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "cpu_count": os.cpu_count(), "torch": torch.__version__,
+                       "results": rows}, f, indent=2)
+        print(f"[INFO] Wrote {args.output}")
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Training metrics that do not stall the optimisation loop.
+
+TrainingMetrics sums the step losses as device tensors (no .item() per
+step, one host sync per epoch) and estimates training recall on every
+`recall_every`-th batch only. The recall itself (top-k decode, copy to
+the host, IoU against the GT boxes) runs on a background thread from
+detached outputs, so the next forward/backward/optimizer step does not
+wait for it. At most `max_pending` sampled batches are queued; beyond
+that update_recall blocks, which bounds the memory held by the queue.
+
+    metrics = TrainingMetrics(recall_every=10, top_k=20)
+    for batch in train_dl:
+        ...
+        metrics.update_losses(loss=loss, cls_loss=cls_loss, loc_loss=loc_loss)
+        metrics.update_recall(pred_locs, objectness_score, anchors, batch["boxes"])
+    summary = metrics.epoch_summary()   # {"loss": ..., "cls_loss": ..., "loc_loss": ..., "recall": ...}
+
+Losses are averaged per batch. With loss_per="sample" the sums are divided
+by the number of images instead (pass n_samples to update_losses), the
+normalisation of the notebook's training log (sum of batch losses /
+images).
+"""
+
+import queue
+import threading
+
+import numpy as np
+import torch
+
+from rpn_utils import compute_recall_at_threshold, decode_topk
+
+
+def topk_batch_recall(pred_locs, objectness_score, anchors, gt_boxes_list, top_k=20, iou_threshold=0.5):
+    """Mean recall@top_k over the images of a batch with GT boxes (None if none have any)."""
+    proposals, _, _ = decode_topk(pred_locs.float(), objectness_score.float(), torch.as_tensor(anchors), top_k)
+    proposals = proposals.cpu().numpy()
+    recalls = [compute_recall_at_threshold(props, np.asarray(gt), iou_threshold)
+               for props, gt in zip(proposals, gt_boxes_list) if len(gt) > 0]
+    return float(np.mean(recalls)) if recalls else None
+
+
+class TrainingMetrics:
+    """
+    Per-epoch loss means (device-side sums) and sampled recall computed on a
+    background thread. recall_fn(pred_locs, objectness_score, anchors,
+    gt_boxes_list) returns one batch recall or None; the default is
+    topk_batch_recall with top_k / iou_threshold. loss_per is "batch" or
+    "sample" (the denominator of the loss means).
+    """
+    def __init__(self, recall_every=10, top_k=20, iou_threshold=0.5, recall_fn=None, max_pending=4,
+                 loss_per="batch"):
+        if loss_per not in ("batch", "sample"):
+            raise ValueError(f"loss_per must be 'batch' or 'sample', got {loss_per!r}")
+        self.loss_per = loss_per
+        self.recall_every = max(int(recall_every), 1)
+        self.top_k = top_k
+        self.iou_threshold = iou_threshold
+        self.recall_fn = recall_fn or (lambda locs, scores, anchors, gts: topk_batch_recall(
+            locs, scores, anchors, gts, self.top_k, self.iou_threshold))
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._error = None
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        self.reset()
+
+    def reset(self):
+        """Start a new epoch."""
+        self._loss_sums = {}
+        self._n_batches = 0
+        self._n_samples = 0
+        self._batch_index = 0
+        with self._lock:
+            self._recalls = []
+
+    def update_losses(self, n_samples=None, **losses):
+        """Add this step's (detached) loss tensors; no host sync. n_samples: images in the batch."""
+        if self.loss_per == "sample":
+            if n_samples is None:
+                raise ValueError("loss_per='sample' needs n_samples")
+            self._n_samples += int(n_samples)
+        for name, value in losses.items():
+            value = value.detach().float()
+            self._loss_sums[name] = self._loss_sums[name] + value if name in self._loss_sums else value.clone()
+        self._n_batches += 1
+
+    def update_recall(self, pred_locs, objectness_score, anchors, gt_boxes_list):
+        """Queue this batch for recall if it is a sampled one (every recall_every-th)."""
+        sampled = self._batch_index % self.recall_every == 0
+        self._batch_index += 1
+        if not sampled:
+            return
+        gt_boxes_list = [gt.cpu().numpy() if isinstance(gt, torch.Tensor) else np.asarray(gt) for gt in gt_boxes_list]
+        self._queue.put((pred_locs.detach(), objectness_score.detach(), anchors, gt_boxes_list))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                with torch.no_grad():
+                    recall = self.recall_fn(*item)
+                if recall is not None:
+                    with self._lock:
+                        self._recalls.append(recall)
+            except Exception as e:  # surfaced in epoch_summary
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def epoch_summary(self):
+        """Wait for the queued recall work, sync the loss sums once, return the epoch means."""
+        state = self.state_dict()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("training metric computation failed") from error
+        n = max(state["n_samples"] if self.loss_per == "sample" else state["n_batches"], 1)
+        summary = {name: total / n for name, total in state["loss_sums"].items()}
+        summary["recall"] = float(np.mean(state["recalls"])) if state["recalls"] else 0.0
+        summary["recall_batches"] = len(state["recalls"])
+        self.reset()
+        return summary
+
+    def state_dict(self):
+        """Partial-epoch state for checkpointing (waits for queued recall work)."""
+        self._queue.join()
+        with self._lock:
+            recalls = list(self._recalls)
+        return {"loss_sums": {name: total.item() for name, total in self._loss_sums.items()},
+                "n_batches": self._n_batches, "n_samples": self._n_samples, "batch_index": self._batch_index,
+                "recalls": recalls}
+
+    def load_state_dict(self, state, device=None):
+        self._loss_sums = {name: torch.tensor(total, device=device) for name, total in state["loss_sums"].items()}
+        self._n_batches = state["n_batches"]
+        self._n_samples = state.get("n_samples", 0)
+        self._batch_index = state["batch_index"]
+        with self._lock:
+            self._recalls = list(state["recalls"])
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
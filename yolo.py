@@ -14,6 +14,7 @@ import cv2
 import os
 import time
 from google.colab.patches import cv2_imshow  # For displaying images in Colab
+from yolo_runner import filter_detections, output_layer_names
 
 # Mount Google Drive (if your images are stored in Google Drive)
 from google.colab import drive
@@ -38,6 +39,9 @@ configPath = 'yolov3.cfg'
 print("[INFO] loading YOLO from disk...")
 net = cv2.dnn.readNetFromDarknet(configPath, weightsPath)
 
+# Determine only the *output* layer names that we need from YOLO (once per network)
+ln = output_layer_names(net)
+
 # Define confidence and threshold values
 confidence_threshold = 0.5
 nms_threshold = 0.3
@@ -59,12 +63,6 @@ for image_name in os.listdir(image_dir):
 
     (H, W) = image.shape[:2]
 
-    ln = net.getLayerNames()
-    if len(net.getUnconnectedOutLayers().shape) == 1:
-      ln = [ln[i - 1] for i in net.getUnconnectedOutLayers()]  # Reshape to (N,)
-    else:
-      ln = [ln[i[0] - 1] for i in net.getUnconnectedOutLayers()]  # Expected behaviour
-
     # Construct a blob from the input image and perform a forward pass
     blob = cv2.dnn.blobFromImage(image, 1 / 255.0, (416, 416), swapRB=True, crop=False)
     net.setInput(blob)
@@ -74,34 +72,11 @@ for image_name in os.listdir(image_dir):
 
     print(f"[INFO] YOLO took {end - start:.6f} seconds for {image_name}")
 
-    # Initialize lists to store detected bounding boxes, confidences, and class IDs
-    boxes = []
-    confidences = []
-    classIDs = []
-
-    # Loop over each of the layer outputs
-    for output in layerOutputs:
-        # Loop over each of the detections
-        for detection in output:
-            # Extract the class ID and confidence of the current object detection
-            scores = detection[5:]
-            classID = np.argmax(scores)
-            confidence = scores[classID]
-
-            # Filter out weak predictions
-            if confidence > confidence_threshold:
-                # Scale the bounding box coordinates back relative to the image size
-                box = detection[0:4] * np.array([W, H, W, H])
-                (centerX, centerY, width, height) = box.astype("int")
-
-                # Derive the top-left corner of the bounding box
-                x = int(centerX - (width / 2))
-                y = int(centerY - (height / 2))
-
-                # Update our lists
-                boxes.append([x, y, int(width), int(height)])
-                confidences.append(float(confidence))
-                classIDs.append(classID)
+    # Filter out weak predictions in one vectorized pass over all layer outputs;
+    # boxes are [x, y, w, h] scaled back to the image size
+    start = time.time()
+    boxes, confidences, classIDs = filter_detections(layerOutputs, [(H, W)], confidence_threshold)[0]
+    print(f"[INFO] Post-processing took {time.time() - start:.6f} seconds")
 
     # Apply non-maxima suppression to suppress weak, overlapping bounding boxes
     idxs = cv2.dnn.NMSBoxes(boxes, confidences, confidence_threshold, nms_threshold)
@@ -225,6 +200,9 @@ configPath = 'yolov3.cfg'
 print("[INFO] loading YOLO from disk...")
 net = cv2.dnn.readNetFromDarknet(configPath, weightsPath)
 
+# Determine only the *output* layer names that we need from YOLO (once per network)
+ln = output_layer_names(net)
+
 # Define confidence and threshold values
 confidence_threshold = 0.5
 nms_threshold = 0.3
@@ -260,54 +238,30 @@ def extract_first_n_labels(json_file_path, n):
 json_file_path = '/content/drive/MyDrive/Project/bdd100k_labels_images_train.json'
 first_100_labels = extract_first_n_labels(json_file_path, 100)
 
-# Function to calculate Intersection over Union (IoU)
-def calculate_iou(box1, box2):
-    """
-    Calculate Intersection over Union (IoU) between two bounding boxes.
-    Each box is in the format [x1, y1, x2, y2].
-    """
-    # Calculate intersection coordinates
-    x1 = max(box1[0], box2[0])
-    y1 = max(box1[1], box2[1])
-    x2 = min(box1[2], box2[2])
-    y2 = min(box1[3], box2[3])
-
-    # Calculate intersection area
-    intersection_area = max(0, x2 - x1) * max(0, y2 - y1)
-
-    # Calculate areas of the boxes
-    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-
-    # Calculate IoU
-    iou = intersection_area / (box1_area + box2_area - intersection_area)
-    return iou
+from rpn_utils import compute_iou_vectorized
 
 # Function to calculate accuracy
 def calculate_accuracy(predicted_labels, ground_truth_labels, iou_threshold=0.5):
     """
-    Calculate accuracy by comparing predicted labels with ground truth labels.
+    Calculate accuracy by comparing predicted labels with ground truth labels:
+    the fraction of ground truth boxes hit by a prediction of the same class
+    with IoU >= iou_threshold. One IoU matrix per image instead of a loop
+    over every (ground truth, prediction) pair.
     """
-    correct = 0
     total = len(ground_truth_labels)
+    if total == 0 or not predicted_labels:
+        return 0
 
-    for gt in ground_truth_labels:
-        gt_class = gt['category']
-        gt_box = [gt['box2d']['x1'], gt['box2d']['y1'], gt['box2d']['x2'], gt['box2d']['y2']]
-
-        for pred in predicted_labels:
-            pred_class, pred_box = pred
+    gt_classes = np.array([gt['category'] for gt in ground_truth_labels])
+    gt_boxes = np.array([[gt['box2d']['x1'], gt['box2d']['y1'], gt['box2d']['x2'], gt['box2d']['y2']]
+                         for gt in ground_truth_labels])
+    pred_classes = np.array([pred_class for pred_class, _ in predicted_labels])
+    pred_boxes = np.array([pred_box for _, pred_box in predicted_labels])
 
-            # Check if the predicted class matches the ground truth class
-            if pred_class == gt_class:
-                # Calculate IoU
-                iou = calculate_iou(gt_box, pred_box)
-                if iou >= iou_threshold:
-                    correct += 1
-                    break  # Only count one correct detection per ground truth
-
-    accuracy = correct / total if total > 0 else 0
-    return accuracy
+    ious = compute_iou_vectorized(gt_boxes, pred_boxes)  # (num_gt, num_pred)
+    hits = (ious >= iou_threshold) & (gt_classes[:, None] == pred_classes[None, :])
+    correct = int(hits.any(axis=1).sum())
+    return correct / total
 
 # Initialize variables to accumulate accuracy
 total_accuracy = 0.0
@@ -327,10 +281,6 @@ for item in first_100_labels:
 
     (H, W) = image.shape[:2]
 
-    # Determine only the *output* layer names that we need from YOLO
-    ln = net.getLayerNames()
-    ln = [ln[i - 1] for i in net.getUnconnectedOutLayers().flatten()]
-
     # Construct a blob from the input image and perform a forward pass
     blob = cv2.dnn.blobFromImage(image, 1 / 255.0, (416, 416), swapRB=True, crop=False)
     net.setInput(blob)
@@ -340,34 +290,11 @@ for item in first_100_labels:
 
     print(f"[INFO] YOLO took {end - start:.6f} seconds for {image_name}")
 
-    # Initialize lists to store detected bounding boxes, confidences, and class IDs
-    boxes = []
-    confidences = []
-    classIDs = []
-
-    # Loop over each of the layer outputs
-    for output in layerOutputs:
-        # Loop over each of the detections
-        for detection in output:
-            # Extract the class ID and confidence of the current object detection
-            scores = detection[5:]
-            classID = np.argmax(scores)
-            confidence = scores[classID]
-
-            # Filter out weak predictions
-            if confidence > confidence_threshold:
-                # Scale the bounding box coordinates back relative to the image size
-                box = detection[0:4] * np.array([W, H, W, H])
-                (centerX, centerY, width, height) = box.astype("int")
-
-                # Derive the top-left corner of the bounding box
-                x = int(centerX - (width / 2))
-                y = int(centerY - (height / 2))
-
-                # Update our lists
-                boxes.append([x, y, int(width), int(height)])
-                confidences.append(float(confidence))
-                classIDs.append(classID)
+    # Filter out weak predictions in one vectorized pass over all layer outputs;
+    # boxes are [x, y, w, h] scaled back to the image size
+    start = time.time()
+    boxes, confidences, classIDs = filter_detections(layerOutputs, [(H, W)], confidence_threshold)[0]
+    print(f"[INFO] Post-processing took {time.time() - start:.6f} seconds")
 
     # Apply non-maxima suppression to suppress weak, overlapping bounding boxes
     idxs = cv2.dnn.NMSBoxes(boxes, confidences, confidence_threshold, nms_threshold)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Batched YOLOv3 (OpenCV dnn) inference with vectorized post-processing.
+
+Importable version of the detection loop in yolo.py. The output layer
+names are resolved once per network, images go through
+cv2.dnn.blobFromImages in batches, and the confidence filter is a single
+argmax/threshold over the concatenated outputs of all YOLO layers
+instead of a Python loop over every row. Only the surviving detections
+reach cv2.dnn.NMSBoxes. Boxes are [x, y, w, h] ints like in yolo.py, so
+results are identical to the per-row loop (loop_filter_detections).
+
+Usage:
+    python yolo_runner.py --image-dir trainA_original_700 --batch-size 8 --n-images 64 --check
+"""
+
+import argparse
+import os
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+STAGES = ("preprocess", "forward", "filter", "nms")
+
+
+def output_layer_names(net):
+    """Names of the unconnected (YOLO) output layers, for any OpenCV version."""
+    ln = net.getLayerNames()
+    return [ln[i - 1] for i in np.asarray(net.getUnconnectedOutLayers()).flatten()]
+
+
+def filter_detections(layer_outputs, image_sizes, confidence_threshold=0.5):
+    """
+    Vectorized confidence filter.
+
+    Args:
+        layer_outputs: net.forward(output_layers) for a batch of N images,
+            each (rows, 5 + classes) for N=1 or (N, rows, 5 + classes)
+        image_sizes: N (H, W) pairs
+
+    Returns one (boxes, confidences, class_ids) tuple per image, with boxes
+    as [x, y, w, h] int lists scaled to that image.
+    """
+    n = len(image_sizes)
+    dets = np.concatenate([out.reshape(n, -1, out.shape[-1]) for out in layer_outputs], axis=1)
+    class_scores = dets[..., 5:]
+    class_ids = class_scores.argmax(axis=-1)
+    confidences = np.take_along_axis(class_scores, class_ids[..., None], axis=-1)[..., 0]
+    keep = confidences > confidence_threshold
+
+    results = []
+    for i, (H, W) in enumerate(image_sizes):
+        box = (dets[i, keep[i], :4] * np.array([W, H, W, H])).astype("int")
+        x = (box[:, 0] - box[:, 2] / 2).astype("int")
+        y = (box[:, 1] - box[:, 3] / 2).astype("int")
+        boxes = np.stack([x, y, box[:, 2], box[:, 3]], axis=1)
+        results.append((boxes.tolist(), confidences[i, keep[i]].astype(float).tolist(), class_ids[i, keep[i]].tolist()))
+    return results
+
+
+def loop_filter_detections(layer_outputs, W, H, confidence_threshold=0.5):
+    """Reference: the per-row loop of yolo.py for one image."""
+    boxes, confidences, classIDs = [], [], []
+    for output in layer_outputs:
+        for detection in output.reshape(-1, output.shape[-1]):
+            scores = detection[5:]
+            classID = np.argmax(scores)
+            confidence = scores[classID]
+            if confidence > confidence_threshold:
+                box = detection[0:4] * np.array([W, H, W, H])
+                (centerX, centerY, width, height) = box.astype("int")
+                x = int(centerX - (width / 2))
+                y = int(centerY - (height / 2))
+                boxes.append([x, y, int(width), int(height)])
+                confidences.append(float(confidence))
+                classIDs.append(classID)
+    return boxes, confidences, classIDs
+
+
+def apply_nms(boxes, confidences, class_ids, confidence_threshold=0.5, nms_threshold=0.3):
+    """cv2.dnn.NMSBoxes on one image; returns the kept detections."""
+    if not boxes:
+        return [], [], []
+    idxs = np.asarray(cv2.dnn.NMSBoxes(boxes, confidences, confidence_threshold, nms_threshold)).flatten()
+    return [boxes[i] for i in idxs], [confidences[i] for i in idxs], [class_ids[i] for i in idxs]
+
+
+# -----------------------
+# Runner
+# -----------------------
+
+class YoloRunner:
+    """
+    YOLOv3 from darknet cfg/weights. detect() takes a list of BGR images
+    (any sizes) and returns, per image, a dict with "boxes" ([x, y, w, h]),
+    "confidences" and "class_ids" after NMS. Time per stage is accumulated
+    in self.timings (seconds per batch).
+    """
+    def __init__(self, config_path="yolov3.cfg", weights_path="yolov3.weights", input_size=(416, 416),
+                 confidence_threshold=0.5, nms_threshold=0.3):
+        self.net = cv2.dnn.readNetFromDarknet(config_path, weights_path)
+        self.output_layers = output_layer_names(self.net)
+        self.input_size = input_size
+        self.confidence_threshold = confidence_threshold
+        self.nms_threshold = nms_threshold
+        self.timings = defaultdict(list)
+
+    def detect(self, images):
+        start = time.perf_counter()
+        blob = cv2.dnn.blobFromImages(images, 1 / 255.0, self.input_size, swapRB=True, crop=False)
+        t_blob = time.perf_counter()
+        self.net.setInput(blob)
+        layer_outputs = self.net.forward(self.output_layers)
+        t_forward = time.perf_counter()
+        filtered = filter_detections(layer_outputs, [image.shape[:2] for image in images], self.confidence_threshold)
+        t_filter = time.perf_counter()
+        results = []
+        for boxes, confidences, class_ids in filtered:
+            boxes, confidences, class_ids = apply_nms(boxes, confidences, class_ids,
+                                                      self.confidence_threshold, self.nms_threshold)
+            results.append({"boxes": boxes, "confidences": confidences, "class_ids": class_ids})
+        t_nms = time.perf_counter()
+
+        for stage, seconds in zip(STAGES, (t_blob - start, t_forward - t_blob, t_filter - t_forward, t_nms - t_filter)):
+            self.timings[stage].append(seconds)
+        self.timings["images"].append(len(images))
+        return results
+
+    def detect_loop(self, image):
+        """Reference: one image through the old per-image path (blobFromImage + per-row loop)."""
+        (H, W) = image.shape[:2]
+        blob = cv2.dnn.blobFromImage(image, 1 / 255.0, self.input_size, swapRB=True, crop=False)
+        self.net.setInput(blob)
+        layer_outputs = self.net.forward(output_layer_names(self.net))
+        boxes, confidences, class_ids = loop_filter_detections(layer_outputs, W, H, self.confidence_threshold)
+        boxes, confidences, class_ids = apply_nms(boxes, confidences, class_ids,
+                                                  self.confidence_threshold, self.nms_threshold)
+        return {"boxes": boxes, "confidences": confidences, "class_ids": [int(c) for c in class_ids]}
+
+    def print_timings(self):
+        n_images = sum(self.timings["images"])
+        if n_images == 0:
+            return
+        print(f"\n{'stage':<12}{'ms/img':>9}{'share':>8}")
+        total = sum(sum(self.timings[stage]) for stage in STAGES)
+        for stage in STAGES:
+            seconds = sum(self.timings[stage])
+            print(f"{stage:<12}{seconds / n_images * 1000.0:>9.2f}{seconds / total:>8.1%}")
+        print(f"{'total':<12}{total / n_images * 1000.0:>9.2f}   ({n_images / total:.1f} img/s)")
+
+
+def load_images(image_dir, n_images=None):
+    names = sorted(n for n in os.listdir(image_dir) if n.lower().endswith(IMAGE_EXTENSIONS))
+    images = []
+    for name in names[:n_images]:
+        image = cv2.imread(os.path.join(image_dir, name))
+        if image is None:
+            print(f"[WARNING] Could not load image: {name}")
+            continue
+        images.append((name, image))
+    return images
+
+
+def check_parity(runner, images):
+    """Batched runner vs the old per-image loop on the same images."""
+    batched = runner.detect([image for _, image in images])
+    mismatches = [name for (name, image), result in zip(images, batched) if runner.detect_loop(image) != result]
+    print(f"[INFO] Parity {'OK' if not mismatches else 'FAILED'} on {len(images)} images"
+          + (f": {mismatches[:5]}" if mismatches else ""))
+    return not mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched YOLOv3 inference with per-stage timing")
+    parser.add_argument("--image-dir", default="trainA_original_700")
+    parser.add_argument("--config", default="yolov3.cfg")
+    parser.add_argument("--weights", default="yolov3.weights")
+    parser.add_argument("--labels", default="coco.names")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--n-images", type=int, default=64)
+    parser.add_argument("--confidence-threshold", type=float, default=0.5)
+    parser.add_argument("--nms-threshold", type=float, default=0.3)
+    parser.add_argument("--check", action="store_true", help="compare with the per-image loop first")
+    args = parser.parse_args()
+
+    print("[INFO] loading YOLO from disk...")
+    runner = YoloRunner(args.config, args.weights, confidence_threshold=args.confidence_threshold,
+                        nms_threshold=args.nms_threshold)
+    LABELS = open(args.labels).read().strip().split("\n")
+    images = load_images(args.image_dir, args.n_images)
+
+    if args.check:
+        check_parity(runner, images[:args.batch_size])
+        runner.timings.clear()
+
+    for start in range(0, len(images), args.batch_size):
+        batch = images[start:start + args.batch_size]
+        for (name, _), result in zip(batch, runner.detect([image for _, image in batch])):
+            labels = [f"{LABELS[c]}: {conf:.4f}" for c, conf in zip(result["class_ids"], result["confidences"])]
+            print([name, *labels])
+    runner.print_timings()